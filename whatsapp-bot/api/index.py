@@ -1,22 +1,39 @@
 import telegram
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, ContextTypes, BasePersistence, PersistenceInput, BaseRateLimiter
 import logging
-import requests
+import httpx  # Shared async HTTP client with connection pooling
 import json
-import yt_dlp  # For YouTube downloads
 import os  # For file operations
+import sys
 import tempfile  # For temporary file creation
 import random  # For PIN generation
 import string  # For PIN generation
 import asyncio  # For async operations
+import threading
+import time  # For rate limiting and leases
+import csv  # For broadcast number lists
+import io
+import shutil
+import mimetypes
+import re
+import hashlib
+import base64
+import math
+import zlib
+import hmac
+import types
+import copy
+import functools
+import bisect
+import contextlib
+import contextvars
+from collections import OrderedDict, Counter, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import sqlite3  # Local stand-in for the broadcast queue
 
-# Firebase Admin SDK imports
-import firebase_admin
-from firebase_admin import credentials, firestore
-
-# Google Gemini API import
-import google.generativeai as genai
+# yt_dlp, firebase_admin and google.generativeai are imported on first use (see the
+# accessors below): together they add well over a second to a cold start.
 
 # Configure logging for Vercel environment
 logging.basicConfig(
@@ -27,164 +44,3071 @@ logger = logging.getLogger(__name__)
 
 # --- Bot Configuration ---
 BOT_TOKEN = os.environ.get('BOT_TOKEN')  
+# Alternative Bot API endpoint (a local Bot API server or the load-test fake), e.g. http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL')
 SEND_MESSAGE_API_URL = os.environ.get('SEND_MESSAGE_API_URL', "https://typical-gracia-pdbot-aed22ab6.koyeb.app/send-message")
+# Optional gateway endpoint that accepts {"messages": [{"number", "message"}, ...]} and answers {"results": [...]}
+SEND_MESSAGE_BATCH_URL = os.environ.get('SEND_MESSAGE_BATCH_URL')
+SEND_MESSAGE_BATCH_SIZE = int(os.environ.get('SEND_MESSAGE_BATCH_SIZE', 50))
+SEND_MESSAGE_BATCH_WINDOW = float(os.environ.get('SEND_MESSAGE_BATCH_WINDOW', 0.05))  # seconds
+SEND_MESSAGE_MAX_RETRIES = int(os.environ.get('SEND_MESSAGE_MAX_RETRIES', 3))
+
+# --- HTTP Client Configuration ---
+HTTP_MAX_CONNECTIONS = int(os.environ.get('HTTP_MAX_CONNECTIONS', 50))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', 10))
+HTTP_POOL_TIMEOUT = 10.0  # seconds to wait for a free Bot API connection
+HTTP_RETRY_BASE_DELAY = 0.5  # seconds
+HTTP_RETRY_MAX_DELAY = 8.0  # seconds
+HTTP_RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+# A WhatsApp send is not idempotent, so it is only retried when the gateway cannot have accepted it:
+# the connection was never made, or the gateway refused it outright with 429/503.
+HTTP_SEND_RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+HTTP_SEND_RETRYABLE_STATUS_CODES = {429, 503}
+HTTP_MAX_RETRY_AFTER = 30  # seconds; a longer Retry-After fails the send instead of holding the request
+
+# --- Download Configuration ---
+# Telegram's cloud Bot API accepts uploads up to 50 MB; a local Bot API server (TELEGRAM_API_BASE_URL)
+# accepts up to 2000 MB.
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 50 * 1024 * 1024))
+# Downloads that can't be resumed or transcoded are spooled in memory up to this size; larger ones spill to disk.
+DOWNLOAD_SPOOL_MAX_MEMORY = int(os.environ.get('DOWNLOAD_SPOOL_MAX_MEMORY', 32 * 1024 * 1024))
+DOWNLOAD_MIN_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_MAX_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_PROGRESS_INTERVAL = 3  # seconds between progress message edits
+# Origins that honour Range requests are fetched over this many connections at once, each range
+# resuming where it stopped after a dropped connection.
+DOWNLOAD_PARALLEL_CONNECTIONS = int(os.environ.get('DOWNLOAD_PARALLEL_CONNECTIONS', 4))
+DOWNLOAD_PARALLEL_MIN_SIZE = int(os.environ.get('DOWNLOAD_PARALLEL_MIN_SIZE', 8 * 1024 * 1024))  # smaller files use one
+DOWNLOAD_RANGE_RETRIES = 3  # resumes per range before the download fails
+DOWNLOAD_CACHE_TTL = int(os.environ.get('DOWNLOAD_CACHE_TTL', 7 * 24 * 3600))  # seconds
+DOWNLOAD_CACHE_MAX_ENTRIES = int(os.environ.get('DOWNLOAD_CACHE_MAX_ENTRIES', 1000))
+YT_DOWNLOAD_FORMAT = 'best[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best'
+YT_AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio'
+YT_MAX_HEIGHT = 720
+YT_PROBE_CACHE_TTL = int(os.environ.get('YT_PROBE_CACHE_TTL', 30 * 60))  # stream URLs expire after a few hours
+YT_PROBE_CACHE_MAX_ENTRIES = 64
+
+# --- Transcoding Configuration ---
+# Media over MAX_UPLOAD_SIZE is re-encoded or split into parts with ffmpeg (installed by vercel.json)
+# instead of being rejected. TRANSCODE_MAX_INPUT_SIZE then becomes the download limit for media.
+# Off by default on Vercel (which sets VERCEL=1): a function has 512 MB of /tmp for the input and its
+# parts, about 1 GB of memory and no maxDuration set in vercel.json, so there it is meant for the
+# ASGI server or the workers. If it is enabled on Vercel anyway, inputs are capped so the input and
+# its parts fit in /tmp.
+ON_VERCEL = bool(os.environ.get('VERCEL'))
+TRANSCODE_ENABLED = os.environ.get('TRANSCODE_ENABLED', 'false' if ON_VERCEL else 'true').lower() in ('1', 'true', 'yes')
+FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
+TRANSCODE_CONCURRENCY = int(os.environ.get('TRANSCODE_CONCURRENCY', 1))  # ffmpeg processes per instance; x264 uses every core
+TRANSCODE_PRESET = os.environ.get('TRANSCODE_PRESET', 'superfast')  # libx264 preset, software only
+TRANSCODE_MAX_INPUT_SIZE = int(os.environ.get('TRANSCODE_MAX_INPUT_SIZE', (200 if ON_VERCEL else 500) * 1024 * 1024))  # largest media downloaded for transcoding
+TRANSCODE_MIN_VIDEO_BITRATE = 300_000  # bits/s; a video that would need less is split into parts instead
+TRANSCODE_AUDIO_BITRATE = 96_000  # bits/s
+TRANSCODE_MIN_AUDIO_BITRATE = 48_000  # bits/s; audio-only files that would need less are split
+TRANSCODE_SIZE_MARGIN = 0.93  # share of the size budget aimed for; covers container overhead and rate-control overshoot
+TRANSCODE_MAX_PARTS = int(os.environ.get('TRANSCODE_MAX_PARTS', 10))
+TRANSCODE_TIMEOUT = float(os.environ.get('TRANSCODE_TIMEOUT', 240))  # seconds per ffmpeg run
+
+# --- Job Queue Configuration ---
+# When YT_JOB_QUEUE is set, /yt_download only enqueues a job; `python api/index.py yt-worker`
+# running on a long-lived host downloads and delivers it.
+YT_JOB_QUEUE = os.environ.get('YT_JOB_QUEUE', '').lower() in ('1', 'true', 'yes')
+YT_WORKER_CONCURRENCY = int(os.environ.get('YT_WORKER_CONCURRENCY', 2))
+YT_WORKER_POLL_INTERVAL = float(os.environ.get('YT_WORKER_POLL_INTERVAL', 2))  # seconds
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 15 * 60))
+JOB_MAX_ATTEMPTS = 2
+JOB_QUEUE_SQLITE_PATH = os.environ.get('JOB_QUEUE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'job_queue.db'))
+
+# --- Webhook Configuration ---
+# WEBHOOK_MODE: 'inline' processes the update before answering Telegram; 'background' answers first
+# and processes on the same (long-lived) instance; 'queue' answers first and leaves the update to
+# `python api/index.py update-worker`.
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'inline')
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')  # secret_token passed to setWebhook
+UPDATE_WORKER_CONCURRENCY = int(os.environ.get('UPDATE_WORKER_CONCURRENCY', 8))
+UPDATE_DEDUP_TTL = 24 * 3600  # seconds; expired processed_updates documents are deleted by sweep_processed_updates
+UPDATE_DEDUP_MAX_ENTRIES = 10000
+SERVER_SHUTDOWN_TIMEOUT = float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', 110))  # seconds to drain in-flight updates
+# Vercel Cron sends it as 'Authorization: Bearer <secret>'; /api/sweep and /api/broadcasts refuse every
+# request while it is unset.
+CRON_SECRET = os.environ.get('CRON_SECRET')
+
+# --- AI Configuration ---
+TELEGRAM_MESSAGE_LIMIT = 4096  # characters per text message
+# Seconds between edits of a streamed answer. Telegram allows about one message per second in a
+# private chat and 20 per minute in a group.
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get('AI_STREAM_EDIT_INTERVAL', 1.0))
+AI_STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get('AI_STREAM_GROUP_EDIT_INTERVAL', 3.0))
+AI_STREAM_CURSOR = ' ▌'
+AI_CACHE_TTL = int(os.environ.get('AI_CACHE_TTL', 24 * 3600))  # seconds
+AI_CACHE_MAX_ENTRIES = int(os.environ.get('AI_CACHE_MAX_ENTRIES', 500))
+# Minimum cosine similarity for answering a query from a differently worded cached one; 0 disables.
+AI_CACHE_SIMILARITY = float(os.environ.get('AI_CACHE_SIMILARITY', 0))
+AI_EMBEDDING_DIMENSIONS = 2048
+# /ai_chat sessions: history beyond the token budget is folded into a rolling summary.
+AI_CHAT_CONTEXT_TOKENS = int(os.environ.get('AI_CHAT_CONTEXT_TOKENS', 3000))
+AI_CHAT_SUMMARY_WORDS = 150
+# The /ai_chat conversation ends after AI_CHAT_IDLE_TTL seconds without a message, and its session is
+# deleted by sweep_idle_ai_sessions.
+AI_CHAT_IDLE_TTL = int(os.environ.get('AI_CHAT_IDLE_TTL', 30 * 60))
+AI_CHAT_SWEEP_BATCH_SIZE = 500  # chat documents per batched write, Firestore's per-batch maximum
+
+# --- Send Scheduler Configuration ---
+# Outbound Bot API calls are paced per chat and globally (Telegram allows about one message per
+# second in a chat, 20 per minute in a group and 30 per second overall) and RetryAfter is honoured.
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))  # messages per second
+TELEGRAM_CHAT_RATE = 1.0  # messages per second in a private chat
+TELEGRAM_GROUP_RATE_PER_MINUTE = 20
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_MAX_RETRY_AFTER = float(os.environ.get('TELEGRAM_MAX_RETRY_AFTER', 30))  # longer flood waits fail the call
+TELEGRAM_MAX_RETRIES = 3
+# Status messages are only posted once a command has run this long, then edited in place.
+STATUS_GRACE_PERIOD = float(os.environ.get('STATUS_GRACE_PERIOD', 1.0))  # seconds
+STATUS_EDIT_INTERVAL = 1.0  # seconds
+
+# --- Broadcast Configuration ---
+# Only these Telegram user IDs may use /broadcast; nobody can while it is unset.
+BROADCAST_ADMIN_IDS = {int(i) for i in os.environ.get('BROADCAST_ADMIN_IDS', '').split(',') if i.strip()}
+# /broadcast only queues the sends. On Vercel, Cron calls GET /api/broadcasts every minute (see vercel.json;
+# a Hobby plan only allows daily crons), which delivers for up to BROADCAST_CRON_TIME_BUDGET seconds;
+# on a long-lived host `python api/index.py broadcast-worker` delivers them as they come.
+# The default stays inside Vercel's default function timeout; a drain cut off mid-send leaves its recipients
+# to be reported as interrupted, so raise it only together with the function's maxDuration.
+BROADCAST_CRON_TIME_BUDGET = float(os.environ.get('BROADCAST_CRON_TIME_BUDGET', 8))  # seconds
+BROADCAST_WORKER_CONCURRENCY = int(os.environ.get('BROADCAST_WORKER_CONCURRENCY', 2))  # broadcasts drained at once
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 5))
+BROADCAST_RATE_PER_SECOND = float(os.environ.get('BROADCAST_RATE_PER_SECOND', 5))
+BROADCAST_TIME_BUDGET = float(os.environ.get('BROADCAST_TIME_BUDGET', 50))  # seconds per job, well inside JOB_LEASE_SECONDS
+BROADCAST_LEASE_SECONDS = 120
+BROADCAST_MAX_RECIPIENTS = int(os.environ.get('BROADCAST_MAX_RECIPIENTS', 10000))
+BROADCAST_SQLITE_PATH = os.environ.get('BROADCAST_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'broadcast_queue.db'))
+
+# --- Governor Configuration ---
+# The rate limits are per process. The concurrency limits queue fairly within a process under the ASGI
+# server; on serverless instances they are shared through Firestore leases instead (see ResourceGovernor).
+# Requests per minute (with a small burst) for heavy commands, per user and per chat.
+GOVERNOR_USER_RATE_PER_MINUTE = float(os.environ.get('GOVERNOR_USER_RATE_PER_MINUTE', 6))
+GOVERNOR_USER_BURST = 3
+GOVERNOR_CHAT_RATE_PER_MINUTE = float(os.environ.get('GOVERNOR_CHAT_RATE_PER_MINUTE', 20))
+GOVERNOR_CHAT_BURST = 10
+GOVERNOR_USER_MAX_ACTIVE = int(os.environ.get('GOVERNOR_USER_MAX_ACTIVE', 2))  # running + queued jobs per user
+GOVERNOR_MAX_WAITING = int(os.environ.get('GOVERNOR_MAX_WAITING', 20))  # queued jobs per class
+# Jobs of each class that may run at once (per process under the ASGI server, across all serverless
+# instances otherwise); override with e.g. GOVERNOR_LIMITS=youtube=1,url=4
+GOVERNOR_CLASS_LIMITS = {'youtube': 2, 'url': 3, 'ai': 8, 'whatsapp': 10}
+GOVERNOR_CLASS_LIMITS.update({name.strip(): int(limit) for name, limit in
+                              (item.split('=') for item in os.environ.get('GOVERNOR_LIMITS', '').split(',') if item.strip())})
+GOVERNOR_LEASE_SECONDS = int(os.environ.get('GOVERNOR_LEASE_SECONDS', 600))  # a shared lease outlives the longest invocation
+
+# --- Observability Configuration ---
+# Fraction of INFO/DEBUG log records kept (warnings and errors are always logged).
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1.0))
+# /api/metrics answers only 'Authorization: Bearer <METRICS_SECRET>' and refuses everything while it is unset.
+METRICS_SECRET = os.environ.get('METRICS_SECRET')
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds
+# Appends every incoming update as a JSON line, building a corpus for `python -m bench.replay`.
+RECORD_UPDATES_PATH = os.environ.get('RECORD_UPDATES_PATH')
+
+# --- Persistence Configuration ---
+PERSISTENCE_SQLITE_PATH = os.environ.get('PERSISTENCE_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'bot_state.db'))
+# Download counts and usage counters are written behind: buffered, coalesced per document and committed
+# as one batch once WRITE_BUFFER_MAX_WRITES documents are pending or WRITE_BUFFER_FLUSH_INTERVAL seconds
+# after the first buffered write. A serverless instance keeps them across warm invocations and commits
+# them at the end of the first invocation past either threshold; counts still buffered when an idle
+# instance is recycled are lost.
+WRITE_BUFFER_MAX_WRITES = min(int(os.environ.get('WRITE_BUFFER_MAX_WRITES', 200)), 500)  # Firestore allows 500 per batch
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.environ.get('WRITE_BUFFER_FLUSH_INTERVAL', 5))  # seconds
+
+# --- PIN Configuration ---
+PIN_POOL_SIZE = int(os.environ.get('PIN_POOL_SIZE', 0))  # 0 disables pre-reserved PINs
+PIN_MAX_ATTEMPTS = 10
+PIN_RESERVATION_TTL = 24 * 3600  # seconds before an unused pre-reserved PIN is swept
+# Uploads expire after UPLOAD_TTL seconds (0 keeps them forever) or, if UPLOAD_MAX_DOWNLOADS is set,
+# after that many downloads. Expired documents are deleted by sweep_expired_uploads.
+UPLOAD_TTL = int(os.environ.get('UPLOAD_TTL', 30 * 24 * 3600))
+UPLOAD_MAX_DOWNLOADS = int(os.environ.get('UPLOAD_MAX_DOWNLOADS', 0))
+# Per-user limits on live uploads, kept as counters in upload_quotas/{user_id}; 0 disables either.
+UPLOAD_USER_MAX_FILES = int(os.environ.get('UPLOAD_USER_MAX_FILES', 50))
+UPLOAD_USER_MAX_BYTES = int(os.environ.get('UPLOAD_USER_MAX_BYTES', 1024 * 1024 * 1024))
+UPLOAD_SWEEP_BATCH_SIZE = 200  # deletions per batch; each may add a quota write, within Firestore's 500
+UPLOAD_SWEEP_TIME_BUDGET = float(os.environ.get('UPLOAD_SWEEP_TIME_BUDGET', 50))  # seconds per invocation
+PROCESSED_UPDATES_SWEEP_BATCH_SIZE = 500  # plain deletions, Firestore's per-batch maximum
+FILE_CACHE_TTL = int(os.environ.get('FILE_CACHE_TTL', 600))  # seconds
+FILE_CACHE_NEGATIVE_TTL = int(os.environ.get('FILE_CACHE_NEGATIVE_TTL', 60))  # seconds
+FILE_CACHE_MAX_ENTRIES = int(os.environ.get('FILE_CACHE_MAX_ENTRIES', 5000))
+HOT_PINS_COUNT = 100
+HOT_PINS_PERSIST_EVERY = 200  # lookups between writes of the hot-PIN index
 
 # --- Firebase Initialization ---
 firebase_service_account_key_json = os.environ.get('FIREBASE_SERVICE_ACCOUNT_KEY')
-db = None
-if firebase_service_account_key_json:
+
+@functools.lru_cache(maxsize=None)
+def get_firestore():
+    """Initializes Firebase on first use and returns the Firestore client, or None if unavailable."""
+    if not firebase_service_account_key_json:
+        logger.error("FIREBASE_SERVICE_ACCOUNT_KEY not found in Vercel Environment Variables. Firebase will not be initialized.")
+        return None
     try:
+        import firebase_admin
+        from firebase_admin import credentials, firestore
         if not firebase_admin._apps:
             cred = credentials.Certificate(json.loads(firebase_service_account_key_json))
             firebase_admin.initialize_app(cred)
         db = firestore.client()
         logger.info("Firebase initialized successfully.")
+        return db
     except Exception as e:
         logger.error(f"Failed to initialize Firebase: {e}")
-else:
-    logger.error("FIREBASE_SERVICE_ACCOUNT_KEY not found in Vercel Environment Variables. Firebase will not be initialized.")
+        return None
 
 # --- Gemini AI Initialization ---
 gemini_api_key = os.environ.get('GEMINI_API_KEY')
-gemini_model = None
-if gemini_api_key:
+
+@functools.lru_cache(maxsize=None)
+def get_gemini_model():
+    """Configures Gemini on first use and returns the model, or None if unavailable."""
+    if not gemini_api_key:
+        logger.error("GEMINI_API_KEY not found in Vercel Environment Variables. Gemini AI will not be initialized.")
+        return None
     try:
+        import google.generativeai as genai
         genai.configure(api_key=gemini_api_key)
         gemini_model = genai.GenerativeModel('gemini-1.5-flash')
         logger.info("Gemini AI model initialized successfully.")
+        return gemini_model
     except Exception as e:
         logger.error(f"Failed to initialize Gemini AI: {e}")
-else:
-    logger.error("GEMINI_API_KEY not found in Vercel Environment Variables. Gemini AI will not be initialized.")
+        return None
 
 APP_ID = "telegram_vercel_bot_app"
-FILES_COLLECTION = db.collection(f"artifacts/{APP_ID}/public/data/files") if db else None
+
+@functools.lru_cache(maxsize=None)
+def get_collection(name: str):
+    """Returns artifacts/{APP_ID}/public/data/{name} (e.g. 'files'), or None if Firestore is unavailable."""
+    db = get_firestore()
+    return db.collection(f"artifacts/{APP_ID}/public/data/{name}") if db else None
 
 # --- Conversation States ---
 SENDMSG_ASK_NUMBER, SENDMSG_ASK_MESSAGE = range(2)
-YT_ASK_URL = range(2, 3)
-UPLOAD_WAIT_FILE = range(3, 4)
-GETFILE_ASK_PIN = range(4, 5)
-AI_ASK_QUERY = range(5, 6)
-DOWNLOAD_ASK_URL = range(6, 7)
+YT_ASK_URL = 2
+UPLOAD_WAIT_FILE = 3
+GETFILE_ASK_PIN = 4
+AI_ASK_QUERY = 5
+DOWNLOAD_ASK_URL = 6
+BROADCAST_ASK_NUMBERS, BROADCAST_ASK_MESSAGE = range(7, 9)
+AI_CHAT = 9
 
 # --- Helper Functions ---
 def generate_pin(length=6):
     characters = string.ascii_uppercase + string.digits
     return ''.join(random.choice(characters) for i in range(length))
 
-async def is_pin_unique(pin: str) -> bool:
-    if not FILES_COLLECTION:
-        logger.error("Firestore not initialized, cannot check PIN uniqueness.")
+async def create_with_unique_pin(collection, data: dict, length=6) -> str:
+    """Stores data under a fresh PIN. document(pin).create fails if the PIN is taken, so the
+    write itself is the uniqueness check and concurrent uploads can never overwrite each other."""
+    from google.api_core.exceptions import AlreadyExists
+    for attempt in range(PIN_MAX_ATTEMPTS):
+        pin = generate_pin(length)
+        try:
+            await external_call('firestore', 'pin_create', collection.document(pin).create, dict(data, pin=pin))
+            return pin
+        except AlreadyExists:
+            logger.warning(f"PIN collision on {pin} (attempt {attempt + 1}/{PIN_MAX_ATTEMPTS}).")
+    raise RuntimeError(f"Could not allocate a unique PIN after {PIN_MAX_ATTEMPTS} attempts.")
+
+class PinPool:
+    """Keeps PINs reserved ahead of time (placeholder documents with 'reserved': True) so uploads
+    don't wait on allocation. Reserved placeholders are never served by /get_file, and ones left
+    unused for PIN_RESERVATION_TTL are swept like expired uploads."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._pins = []  # (pin, reserved_at)
+        self._refilling = False
+
+    def take(self):
+        pin = None
+        while self._pins and pin is None:
+            pin, reserved_at = self._pins.pop()
+            # Leaves a margin so the sweeper never deletes a placeholder that is about to be used.
+            if time.time() - reserved_at > PIN_RESERVATION_TTL / 2:
+                pin = None
+        if len(self._pins) < self.size // 2 and not self._refilling and get_collection('files'):
+            asyncio.ensure_future(self.refill())
+        return pin
+
+    async def refill(self) -> None:
+        self._refilling = True
+        try:
+            missing = self.size - len(self._pins)
+            reserved_at = time.time()
+            placeholder = {'reserved': True, 'reserved_at': reserved_at, 'expires_at': reserved_at + PIN_RESERVATION_TTL}
+            pins = await asyncio.gather(
+                *(create_with_unique_pin(get_collection('files'), placeholder) for _ in range(missing)),
+                return_exceptions=True,
+            )
+            self._pins.extend((pin, reserved_at) for pin in pins if isinstance(pin, str))
+        finally:
+            self._refilling = False
+
+pin_pool = PinPool(PIN_POOL_SIZE)
+
+async def store_file_metadata(file_metadata: dict) -> str:
+    """Stores upload metadata under a new PIN and returns the PIN."""
+    pin = pin_pool.take() if pin_pool.size else None
+    if pin:
+        # The PIN is already ours, so overwriting the placeholder is safe. It is written before the
+        # PIN is announced, so /get_file on any instance finds the upload.
+        await external_call('firestore', 'files_set', get_collection('files').document(pin).set, dict(file_metadata, pin=pin))
+    else:
+        pin = await create_with_unique_pin(get_collection('files'), file_metadata)
+    file_metadata_cache.put(pin, dict(file_metadata, pin=pin))
+    return pin
+
+# --- Upload Expiry and Quotas ---
+def upload_expired(metadata: dict) -> bool:
+    expires_at = metadata.get('expires_at')
+    return expires_at is not None and expires_at <= time.time()
+
+def _quota_ref(user_id: int):
+    return get_collection('upload_quotas').document(str(user_id))
+
+def _reserve_upload_quota(user_id: int, size: int) -> bool:
+    """Counts one more live upload of `size` bytes against the user, unless that exceeds a limit.
+    The update-time precondition makes concurrent uploads by the same user retry instead of both passing."""
+    from firebase_admin import firestore
+    from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+    ref = _quota_ref(user_id)
+    for _ in range(PIN_MAX_ATTEMPTS):
+        snapshot = ref.get()
+        usage = snapshot.to_dict() if snapshot.exists else {}
+        if UPLOAD_USER_MAX_FILES and usage.get('files', 0) + 1 > UPLOAD_USER_MAX_FILES:
+            return False
+        if UPLOAD_USER_MAX_BYTES and usage.get('bytes', 0) + size > UPLOAD_USER_MAX_BYTES:
+            return False
+        try:
+            if snapshot.exists:
+                ref.update({'files': firestore.Increment(1), 'bytes': firestore.Increment(size)},
+                           option=get_firestore().write_option(last_update_time=snapshot.update_time))
+            else:
+                ref.create({'files': 1, 'bytes': size})
+            return True
+        except (AlreadyExists, FailedPrecondition):
+            continue
+    raise RuntimeError(f"Could not update the upload quota of user {user_id} after {PIN_MAX_ATTEMPTS} attempts.")
+
+async def reserve_upload_quota(user_id: int, size: int) -> bool:
+    if not (UPLOAD_USER_MAX_FILES or UPLOAD_USER_MAX_BYTES) or not get_collection('upload_quotas'):
+        return True
+    return await external_call('firestore', 'quota_reserve', _reserve_upload_quota, user_id, size)
+
+async def release_upload_quota(user_id: int, size: int) -> None:
+    from firebase_admin import firestore
+    if not (UPLOAD_USER_MAX_FILES or UPLOAD_USER_MAX_BYTES) or not get_collection('upload_quotas'):
+        return
+    try:
+        await external_call('firestore', 'quota_release', _quota_ref(user_id).set,
+                            {'files': firestore.Increment(-1), 'bytes': firestore.Increment(-size)}, merge=True)
+    except Exception as e:
+        logger.warning(f"Could not release the upload quota of user {user_id}: {e}")
+
+def _claim_limited_download(pin: str) -> bool:
+    """Counts a download of an upload with max_downloads, refusing once the limit is reached. The last
+    allowed download expires the document, so the sweeper deletes it."""
+    from google.api_core.exceptions import FailedPrecondition
+    ref = get_collection('files').document(pin)
+    for _ in range(PIN_MAX_ATTEMPTS):
+        snapshot = ref.get()
+        metadata = snapshot.to_dict() if snapshot.exists else None
+        if not metadata or metadata.get('reserved') or upload_expired(metadata):
+            return False
+        downloads = metadata.get('downloads', 0)
+        if downloads >= metadata['max_downloads']:
+            return False
+        fields = {'downloads': downloads + 1}
+        if downloads + 1 >= metadata['max_downloads']:
+            fields['expires_at'] = time.time()
+        try:
+            ref.update(fields, option=get_firestore().write_option(last_update_time=snapshot.update_time))
+            return True
+        except FailedPrecondition:
+            continue
+    return False
+
+async def claim_download(pin: str, metadata: dict) -> bool:
+    """Records a download of `pin`; False if the upload has expired or used up its downloads."""
+    if upload_expired(metadata):
+        return False
+    ref = get_collection('files').document(pin)
+    if metadata.get('max_downloads'):
+        if not await external_call('firestore', 'files_claim', _claim_limited_download, pin):
+            return False
+    else:
+        write_buffer.increment(ref, {'downloads': 1}, must_exist=True)
+    record_usage({'downloads': 1, 'download_bytes': metadata.get('file_size') or 0})
+    return True
+
+def _sweep_expired_batch(now: float) -> list:
+    """Deletes up to UPLOAD_SWEEP_BATCH_SIZE expired uploads and placeholders in one batched write and
+    gives their owners' quota back. Returns the deleted PINs."""
+    from firebase_admin import firestore
+    db = get_firestore()
+    snapshots = list(get_collection('files').where('expires_at', '<', now).limit(UPLOAD_SWEEP_BATCH_SIZE).get())
+    if not snapshots:
+        return []
+    batch = db.batch()
+    released = {}  # user_id -> [files, bytes]
+    for snapshot in snapshots:
+        # Fails the whole batch if a document changed since the query (a download, a concurrent
+        # sweep), so quota counters are never given back twice.
+        batch.delete(snapshot.reference, option=db.write_option(last_update_time=snapshot.update_time))
+        metadata = snapshot.to_dict()
+        if metadata.get('uploaded_by') is not None:
+            usage = released.setdefault(metadata['uploaded_by'], [0, 0])
+            usage[0] += 1
+            usage[1] += metadata.get('file_size') or 0
+    if get_collection('upload_quotas'):
+        for user_id, (files, size) in released.items():
+            batch.set(_quota_ref(user_id), {'files': firestore.Increment(-files), 'bytes': firestore.Increment(-size)}, merge=True)
+    batch.commit()
+    return [snapshot.id for snapshot in snapshots]
+
+async def sweep_expired_uploads(time_budget: float = UPLOAD_SWEEP_TIME_BUDGET) -> int:
+    """Deletes expired uploads batch by batch until none are left or the time budget is spent."""
+    if not get_collection('files'):
+        return 0
+    deadline = time.monotonic() + time_budget
+    deleted = failures = 0
+    while time.monotonic() < deadline:
+        try:
+            pins = await external_call('firestore', 'files_sweep', _sweep_expired_batch, time.time())
+        except Exception as e:
+            # Usually a document that changed under the batch; the next query sees its new state.
+            failures += 1
+            logger.warning(f"Upload sweep batch failed ({failures}/{PIN_MAX_ATTEMPTS}): {e}")
+            if failures >= PIN_MAX_ATTEMPTS:
+                break
+            await asyncio.sleep(_retry_delay(failures))
+            continue
+        for pin in pins:
+            file_metadata_cache.invalidate(pin)
+        deleted += len(pins)
+        if len(pins) < UPLOAD_SWEEP_BATCH_SIZE:
+            break
+    logger.info(f"Upload sweep deleted {deleted} expired documents.")
+    return deleted
+
+def _sweep_processed_updates_batch(now: float) -> int:
+    db = get_firestore()
+    snapshots = list(get_collection('processed_updates').where('expires_at', '<', now).limit(PROCESSED_UPDATES_SWEEP_BATCH_SIZE).get())
+    if snapshots:
+        batch = db.batch()
+        for snapshot in snapshots:
+            batch.delete(snapshot.reference)
+        batch.commit()
+    return len(snapshots)
+
+async def sweep_processed_updates(time_budget: float = UPLOAD_SWEEP_TIME_BUDGET) -> int:
+    """Deletes processed_updates markers older than UPDATE_DEDUP_TTL, batch by batch until none are
+    left or the time budget is spent."""
+    if not get_collection('processed_updates'):
+        return 0
+    deadline = time.monotonic() + time_budget
+    deleted = 0
+    while time.monotonic() < deadline:
+        try:
+            count = await external_call('firestore', 'processed_updates_sweep', _sweep_processed_updates_batch, time.time())
+        except Exception as e:
+            logger.warning(f"Processed updates sweep batch failed: {e}")
+            break
+        deleted += count
+        if count < PROCESSED_UPDATES_SWEEP_BATCH_SIZE:
+            break
+    logger.info(f"Processed updates sweep deleted {deleted} expired markers.")
+    return deleted
+
+class TokenBucket:
+    """Token bucket rate limiter. Only uses the monotonic clock, so it is safe to share across event loops."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
         return False
-    query = FILES_COLLECTION.where('pin', '==', pin).limit(1)
-    docs = await asyncio.to_thread(query.get)
-    return len(docs) == 0
 
-async def generate_unique_pin(length=6) -> str:
+    async def acquire(self, tokens: float = 1) -> None:
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def wait_time(self, tokens: float = 1) -> float:
+        self._refill()
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+class LRUCache:
+    """In-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key) -> None:
+        self._entries.pop(key, None)
+
+    def items(self) -> list:
+        """Unexpired (key, value) pairs, least recently used first."""
+        now = time.monotonic()
+        return [(key, value) for key, (value, expires_at) in self._entries.items() if expires_at >= now]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# --- Metrics ---
+# Latency histograms, error counts and byte counters for handlers and external calls, exported in
+# the Prometheus text format by GET /api/metrics. Each process (or warm Vercel instance) counts its own.
+def _labels(labels: dict) -> str:
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+class Metrics:
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}  # (kind, op) -> [count per bucket..., +Inf count, sum]
+        self.errors = Counter()  # (kind, op)
+        self.bytes = Counter()  # (kind, op, direction)
+
+    def observe(self, kind: str, op: str, seconds: float) -> None:
+        histogram = self.histograms.get((kind, op))
+        if histogram is None:
+            histogram = self.histograms[(kind, op)] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def add_bytes(self, kind: str, op: str, direction: str, count: int) -> None:
+        self.bytes[(kind, op, direction)] += count
+
+    @contextlib.contextmanager
+    def timer(self, kind: str, op: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.errors[(kind, op)] += 1
+            raise
+        finally:
+            self.observe(kind, op, time.perf_counter() - started)
+
+    def render(self, gauges: dict = None) -> str:
+        lines = ['# TYPE bot_call_duration_seconds histogram']
+        for (kind, op), histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                cumulative += count
+                lines.append(f"bot_call_duration_seconds_bucket{_labels({'kind': kind, 'op': op, 'le': bound})} {cumulative}")
+            lines.append(f"bot_call_duration_seconds_sum{_labels({'kind': kind, 'op': op})} {histogram[-1]:.6f}")
+            lines.append(f"bot_call_duration_seconds_count{_labels({'kind': kind, 'op': op})} {cumulative}")
+        lines.append('# TYPE bot_call_errors_total counter')
+        for (kind, op), count in sorted(self.errors.items()):
+            lines.append(f"bot_call_errors_total{_labels({'kind': kind, 'op': op})} {count}")
+        lines.append('# TYPE bot_bytes_total counter')
+        for (kind, op, direction), count in sorted(self.bytes.items()):
+            lines.append(f"bot_bytes_total{_labels({'kind': kind, 'op': op, 'direction': direction})} {count}")
+        lines.append('# TYPE bot_stat gauge')
+        for component, stats in (gauges or {}).items():
+            for stat, value in stats.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"bot_stat{_labels({'component': component, 'stat': stat})} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def instrumented(kind: str, op: str = None):
+    """Decorator timing an async function under kind/op (op defaults to the function name)."""
+    def decorator(fn):
+        name = op or fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with metrics.timer(kind, name):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def external_call(kind: str, op: str, fn, *args, **kwargs):
+    """Runs a blocking client call (Firestore, yt-dlp, ...) on a worker thread, timed under kind/op."""
+    with metrics.timer(kind, op):
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+class LogSampler(logging.Filter):
+    """Keeps a LOG_SAMPLE_RATE fraction of INFO and DEBUG records."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or self.rate >= 1 or random.random() < self.rate
+
+if LOG_SAMPLE_RATE < 1:
+    logger.addFilter(LogSampler(LOG_SAMPLE_RATE))
+    logging.getLogger('httpx').addFilter(LogSampler(LOG_SAMPLE_RATE))
+
+# --- Write-Behind Buffer ---
+# Counters nobody reads back within the same update (download counts, usage counters) are buffered
+# instead of committed one round-trip at a time. Increments to the same document add up, and everything
+# pending is committed together in batches of at most WRITE_BUFFER_MAX_WRITES documents. Anything another
+# instance may read as soon as the user is told about it, like upload metadata, is written directly.
+def _field_parent(data: dict, field_path: str) -> tuple:
+    """Returns the map holding a dotted field path's last part, creating nested maps as needed, and that part."""
+    *parents, leaf = field_path.split('.')
+    for parent in parents:
+        data = data.setdefault(parent, {})
+    return data, leaf
+
+class DocumentPath:
+    """A document of one of the app's collections (see get_collection), resolved to a Firestore reference
+    only when it is committed, so buffering a counter doesn't set up the Firestore client."""
+
+    def __init__(self, collection: str, doc_id: str):
+        self.collection = collection
+        self.doc_id = doc_id
+        self.path = f"artifacts/{APP_ID}/public/data/{collection}/{doc_id}"
+
+    def resolve(self):
+        collection = get_collection(self.collection)
+        return collection.document(self.doc_id) if collection is not None else None
+
+class WriteBuffer:
+    """Coalesces Firestore counter increments per document and commits them in batches, on size, on a timer or
+    when flush() is awaited. Writes from a failed commit stay pending for the next flush."""
+
+    def __init__(self, max_writes: int, interval: float):
+        self.max_writes = max_writes
+        self.interval = interval
+        self._pending = {}  # document path -> {'ref', 'counts', 'must_exist'}
+        self._pending_since = None  # time.monotonic() of the oldest pending write
+        self._timer = None
+        self._timer_loop = None
+        self._flushes = set()
+        self.buffered = 0
+        self.committed = 0
+        self.batches = 0
+        self.failed_batches = 0
+
+    def _entry(self, ref) -> dict:
+        self.buffered += 1
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        entry = self._pending.get(ref.path)
+        if entry is None:
+            entry = self._pending[ref.path] = {'ref': ref, 'counts': Counter(), 'must_exist': True}
+        return entry
+
+    def increment(self, ref, counts: dict, must_exist: bool = False) -> None:
+        """Buffers Increment transforms of the (dotted) field paths in `counts`. With must_exist the
+        document is updated, so counts for a document deleted in the meantime are dropped rather than
+        recreating it; otherwise it is created as needed."""
+        entry = self._entry(ref)
+        entry['counts'].update(counts)
+        entry['must_exist'] = entry['must_exist'] and must_exist
+        self._schedule()
+
+    def _schedule(self) -> None:
+        loop = asyncio.get_running_loop()
+        if len(self._pending) >= self.max_writes and not any(task.get_loop() is loop for task in self._flushes):
+            self._start_flush()
+        elif self._timer is None or self._timer_loop is not loop:
+            self._timer = loop.call_later(self.interval, self._start_flush)
+            self._timer_loop = loop
+
+    def _start_flush(self) -> None:
+        task = asyncio.ensure_future(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    def take(self, limit: int) -> list:
+        """Removes and returns up to `limit` pending writes that can't fail on a missing document, for
+        a batch committed elsewhere to carry; give them back with restore() if that commit fails."""
+        taken = []
+        for path, entry in list(self._pending.items()):
+            if len(taken) >= limit:
+                break
+            if not entry['must_exist']:
+                taken.append(self._pending.pop(path))
+        return taken
+
+    def restore(self, entries: list) -> None:
+        if entries and not self._pending:
+            self._pending_since = time.monotonic()
+        for entry in entries:
+            # Counts buffered since the failed commit add up with it.
+            path = entry['ref'].path
+            newer = self._pending.get(path)
+            if newer is not None:
+                entry['counts'].update(newer['counts'])
+                entry['must_exist'] = entry['must_exist'] and newer['must_exist']
+            self._pending[path] = entry
+        if self._pending and self._timer is None:
+            # Retried on the timer rather than straight away, so a Firestore outage isn't hammered.
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.interval, self._start_flush)
+            self._timer_loop = loop
+
+    @staticmethod
+    def add_to_batch(batch, entries: list) -> None:
+        from firebase_admin import firestore
+        for entry in entries:
+            ref = entry['ref'].resolve() if isinstance(entry['ref'], DocumentPath) else entry['ref']
+            if entry['must_exist']:
+                batch.update(ref, {field_path: firestore.Increment(amount) for field_path, amount in entry['counts'].items()})
+            else:
+                # set(merge=True) takes nested maps rather than field paths
+                fields = {}
+                for field_path, amount in entry['counts'].items():
+                    parent, leaf = _field_parent(fields, field_path)
+                    parent[leaf] = firestore.Increment(amount)
+                batch.set(ref, fields, merge=True)
+
+    def _commit(self, entries: list) -> None:
+        db = get_firestore()
+        if db is None:
+            logger.warning(f"Dropping {len(entries)} buffered writes: Firestore is unavailable.")
+            return
+        batch = db.batch()
+        self.add_to_batch(batch, entries)
+        batch.commit()
+
+    def due(self) -> bool:
+        """Whether max_writes documents are pending or the oldest pending write has waited `interval` seconds."""
+        return bool(self._pending) and (len(self._pending) >= self.max_writes
+                                        or time.monotonic() - self._pending_since >= self.interval)
+
+    async def flush(self) -> None:
+        """Commits every pending write, and waits for flushes already started on this loop."""
+        from google.api_core.exceptions import NotFound
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        loop = asyncio.get_running_loop()
+        running = [task for task in self._flushes if task.get_loop() is loop and task is not asyncio.current_task()]
+        entries = list(self._pending.values())
+        self._pending = {}
+        for start in range(0, len(entries), self.max_writes):
+            chunk = entries[start:start + self.max_writes]
+            try:
+                await external_call('firestore', 'buffer_commit', self._commit, chunk)
+                self.committed += len(chunk)
+                self.batches += 1
+                continue
+            except NotFound:
+                # A batch is all-or-nothing, so one document deleted since it was counted (an upload
+                # swept after its download) fails the rest too; those are retried one at a time.
+                pass
+            except Exception as e:
+                logger.error(f"Failed to commit {len(chunk)} buffered writes, keeping them for the next flush: {e}")
+                self.failed_batches += 1
+                self.restore(chunk)
+                continue
+            for entry in chunk:
+                try:
+                    await external_call('firestore', 'buffer_commit', self._commit, [entry])
+                    self.committed += 1
+                except NotFound:
+                    logger.warning(f"Dropping buffered counts for deleted document {entry['ref'].path}.")
+                except Exception as e:
+                    logger.error(f"Failed to commit the buffered write to {entry['ref'].path}, keeping it for the next flush: {e}")
+                    self.restore([entry])
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'buffered': self.buffered,
+            'committed': self.committed,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+        }
+
+write_buffer = WriteBuffer(WRITE_BUFFER_MAX_WRITES, WRITE_BUFFER_FLUSH_INTERVAL)
+
+def record_usage(counts: dict) -> None:
+    """Adds `counts` (e.g. {'commands.start': 1}) to today's usage/{YYYY-MM-DD} document (UTC)."""
+    write_buffer.increment(DocumentPath('usage', time.strftime('%Y-%m-%d', time.gmtime())), counts)
+
+def counted(command: str):
+    """Decorator counting each call of a command's callback in today's usage document."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            record_usage({f'commands.{command}': 1})
+            return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# --- File Metadata Cache ---
+_MISSING = object()
+
+class FileMetadataCache:
+    """Read-through cache of PIN -> file metadata in front of the files collection.
+
+    Invalid PINs are cached separately with a short TTL, so brute-force guessing neither
+    reaches Firestore nor evicts real entries. The most requested PINs are written to a
+    small stats document and preloaded with one get_all on a cold instance.
+    """
+
+    def __init__(self):
+        self.memory = LRUCache(FILE_CACHE_MAX_ENTRIES, FILE_CACHE_TTL)
+        self.negative = LRUCache(FILE_CACHE_MAX_ENTRIES, FILE_CACHE_NEGATIVE_TTL)
+        self.request_counts = Counter()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self._warmed = False
+        self._lookups_since_persist = 0
+
+    @property
+    def collection(self):
+        return get_collection('files')
+
+    @property
+    def hot_pins_doc(self):
+        stats_collection = get_collection('stats')
+        return stats_collection.document('hot_pins') if stats_collection else None
+
+    async def get(self, pin: str):
+        if not self._warmed:
+            self._warmed = True
+            asyncio.ensure_future(self.warm())
+
+        metadata = self.memory.get(pin, _MISSING)
+        if metadata is not _MISSING:
+            self.hits += 1
+        elif self.negative.get(pin):
+            self.negative_hits += 1
+            return None
+        else:
+            self.misses += 1
+            started = time.perf_counter()
+            doc = await external_call('firestore', 'files_get', self.collection.document(pin).get)
+            self.lookup_seconds += time.perf_counter() - started
+            metadata = doc.to_dict() if doc.exists else None
+            if not metadata or metadata.get('reserved'):
+                self.negative.set(pin, True)
+                return None
+            self.memory.set(pin, metadata)
+        if upload_expired(metadata):
+            self.memory.pop(pin)
+            self.negative.set(pin, True)
+            return None
+
+        self.request_counts[pin] += 1
+        self._lookups_since_persist += 1
+        if self._lookups_since_persist >= HOT_PINS_PERSIST_EVERY and self.hot_pins_doc:
+            self._lookups_since_persist = 0
+            asyncio.ensure_future(self.persist_hot_pins())
+        return metadata
+
+    def put(self, pin: str, metadata: dict) -> None:
+        from firebase_admin import firestore
+        self.negative.pop(pin)
+        self.memory.set(pin, {key: value for key, value in metadata.items() if value is not firestore.SERVER_TIMESTAMP})
+
+    def invalidate(self, pin: str) -> None:
+        self.memory.pop(pin)
+
+    async def warm(self) -> None:
+        if not self.hot_pins_doc:
+            return
+        try:
+            doc = await external_call('firestore', 'hot_pins_get', self.hot_pins_doc.get)
+            pins = (doc.to_dict() or {}).get('pins', []) if doc.exists else []
+            if not pins:
+                return
+            refs = [self.collection.document(pin) for pin in pins]
+            snapshots = await external_call('firestore', 'files_get_all', lambda: list(get_firestore().get_all(refs)))
+            for snapshot in snapshots:
+                metadata = snapshot.to_dict() if snapshot.exists else None
+                if metadata and not metadata.get('reserved') and not upload_expired(metadata) and self.memory.get(snapshot.id, _MISSING) is _MISSING:
+                    self.memory.set(snapshot.id, metadata)
+            logger.info(f"Warmed file metadata cache with {len(snapshots)} hot PINs.")
+        except Exception as e:
+            logger.warning(f"Failed to warm file metadata cache: {e}")
+
+    async def persist_hot_pins(self) -> None:
+        pins = [pin for pin, _ in self.request_counts.most_common(HOT_PINS_COUNT)]
+        try:
+            await external_call('firestore', 'hot_pins_set', self.hot_pins_doc.set, {'pins': pins, 'updated_at': time.time()})
+        except Exception as e:
+            logger.warning(f"Failed to persist hot PIN index: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0.0,
+            'avg_firestore_ms': round(self.lookup_seconds / self.misses * 1000, 1) if self.misses else 0.0,
+            'entries': len(self.memory),
+        }
+
+file_metadata_cache = FileMetadataCache()
+
+# --- Conversation Persistence ---
+# State lives in one document per chat (conversation states of every user in it) and one per
+# user (user_data). Documents are read afresh by every update that needs them, since another instance
+# may have moved a conversation on since this one last saw it; writes are staged and committed
+# together by flush() at the end of the update, so a state transition is one batch write.
+_DELETE = object()
+# The state documents read for the update being processed (see load_update)
+_update_documents = contextvars.ContextVar('update_documents', default={})
+
+def _apply_patch(target: dict, patch: dict) -> None:
+    for key, value in patch.items():
+        if value is _DELETE:
+            target.pop(key, None)
+        elif isinstance(value, dict):
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            _apply_patch(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+def _combine_patches(first: dict, second: dict) -> None:
+    for key, value in second.items():
+        if isinstance(value, dict) and isinstance(first.get(key), dict):
+            _combine_patches(first[key], value)
+        else:
+            first[key] = value
+
+def _firestore_patch(patch: dict) -> dict:
+    from firebase_admin import firestore
+    return {key: firestore.DELETE_FIELD if value is _DELETE else _firestore_patch(value) if isinstance(value, dict) else value
+            for key, value in patch.items()}
+
+class FirestoreStateStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, doc_id: str):
+        doc = self.collection.document(doc_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def get_many(self, doc_ids: list) -> dict:
+        snapshots = get_firestore().get_all([self.collection.document(doc_id) for doc_id in doc_ids])
+        return {snapshot.id: snapshot.to_dict() for snapshot in snapshots if snapshot.exists}
+
+    def commit(self, writes: dict, buffered: list = ()) -> None:
+        batch = get_firestore().batch()
+        for doc_id, (patch, replace) in writes.items():
+            if replace:
+                batch.set(self.collection.document(doc_id), patch)
+            else:
+                batch.set(self.collection.document(doc_id), _firestore_patch(patch), merge=True)
+        WriteBuffer.add_to_batch(batch, buffered)
+        batch.commit()
+
+class SqliteStateStore:
+    """Local stand-in for FirestoreStateStore."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS bot_state (id TEXT PRIMARY KEY, data TEXT)')
+
+    def get(self, doc_id: str):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM bot_state WHERE id = ?', (doc_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_many(self, doc_ids: list) -> dict:
+        return {doc_id: data for doc_id in doc_ids for data in [self.get(doc_id)] if data is not None}
+
+    def commit(self, writes: dict) -> None:
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for doc_id, (patch, replace) in writes.items():
+                data = {}
+                if not replace:
+                    row = self.conn.execute('SELECT data FROM bot_state WHERE id = ?', (doc_id,)).fetchone()
+                    data = json.loads(row[0]) if row else {}
+                _apply_patch(data, patch)
+                self.conn.execute('INSERT OR REPLACE INTO bot_state (id, data) VALUES (?, ?)', (doc_id, json.dumps(data)))
+            self.conn.execute('COMMIT')
+
+def reaches_conversation(update: Update, application: Application) -> bool:
+    """Whether a handler of one of the application's persistent ConversationHandlers (an entry point,
+    state handler or fallback) would take the update, whatever state its conversation is in. Only these
+    handlers read or change conversation states and user_data."""
+    for group in application.handlers.values():
+        for handler in group:
+            if not (isinstance(handler, ConversationHandler) and handler.persistent):
+                continue
+            candidates = [*handler.entry_points, *handler.fallbacks]
+            candidates.extend(candidate for handlers in handler.states.values() for candidate in handlers)
+            if any(candidate.check_update(update) not in (None, False) for candidate in candidates):
+                return True
+    return False
+
+class BotPersistence(BasePersistence):
+    """Stores conversation states and user_data so multi-step flows survive moving between instances."""
+
+    def __init__(self):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False))
+        self._store = None
+        self._pending = {}
+        # user_id -> user_data as last loaded or staged, so update_persistence() only writes the
+        # user_data an update changed (it is handed every user PTB has seen, loaded or not).
+        self._user_data = {}
+        # (chat_id, user_id) -> {conversation name: state} as last loaded or staged, so a handler that
+        # stays in its state writes nothing.
+        self._states = {}
+
+    @property
+    def store(self):
+        if self._store is None:
+            collection = get_collection('bot_state')
+            self._store = FirestoreStateStore(collection) if collection else SqliteStateStore(PERSISTENCE_SQLITE_PATH)
+        return self._store
+
+    async def _load(self, doc_id: str) -> dict:
+        """Reads the stored document, with writes staged but not yet flushed applied on top."""
+        documents = _update_documents.get()
+        if doc_id in documents:
+            data = copy.deepcopy(documents[doc_id]) or {}
+        else:
+            data = await external_call('state_store', 'get', self.store.get, doc_id) or {}
+        pending = self._pending.get(doc_id)
+        if pending is not None:
+            patch, replace = pending
+            if replace:
+                data = {}
+            _apply_patch(data, patch)
+        return data
+
+    def _stage(self, doc_id: str, patch: dict, replace: bool = False) -> None:
+        pending = self._pending.get(doc_id)
+        patch = copy.deepcopy(patch, {id(_DELETE): _DELETE})
+        if replace or pending is None:
+            self._pending[doc_id] = (patch, replace)
+        elif pending[1]:
+            _apply_patch(pending[0], patch)
+        else:
+            _combine_patches(pending[0], patch)
+
+    async def get_chat_user_field(self, chat_id: int, user_id: int, name: str):
+        return copy.deepcopy((await self._load(f"chat_{chat_id}")).get(name, {}).get(str(user_id)))
+
+    def set_chat_user_field(self, chat_id: int, user_id: int, name: str, value, **chat_fields) -> None:
+        """Stages a user's entry in a field of the chat's state document (None deletes it), along with
+        any top-level `chat_fields`."""
+        self._stage(f"chat_{chat_id}", {name: {str(user_id): _DELETE if value is None else value}, **chat_fields})
+
+    async def load_update(self, update: Update, application: Application) -> None:
+        """Reads the chat and user documents of an update in one round-trip and sets the update's
+        conversation states in the application's ConversationHandlers from them, so nothing an earlier
+        update left in memory on this instance is trusted. user_data follows in refresh_user_data.
+        Updates no conversation would take (/start, /broadcast_status) read nothing."""
+        chat, user = update.effective_chat, update.effective_user
+        if not reaches_conversation(update, application):
+            _update_documents.set({})
+            return
+        doc_ids = ([f"chat_{chat.id}"] if chat and user else []) + ([f"user_{user.id}"] if user else [])
+        documents = await external_call('state_store', 'get_many', self.store.get_many, doc_ids) if doc_ids else {}
+        _update_documents.set({doc_id: documents.get(doc_id) for doc_id in doc_ids})
+        if not (chat and user):
+            return
+        key = (chat.id, user.id)
+        states = (await self._load(f"chat_{chat.id}")).get('conversations', {})
+        loaded = {}
+        # PTB 21 keeps each persistent ConversationHandler's states in a TrackingDict; loading through
+        # update_no_track and .data keeps them from being written back as changes.
+        for name, conversations in application._conversation_handler_conversations.items():
+            state = states.get(name, {}).get(str(user.id))
+            if state is None:
+                conversations.data.pop(key, None)
+            else:
+                conversations.update_no_track({key: state})
+                loaded[name] = state
+        if loaded:
+            self._states[key] = loaded
+        else:
+            self._states.pop(key, None)
+
+    # Called once, when the Application is initialized; each update's states are set by load_update,
+    # so no stored chat is read here.
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def get_user_data(self) -> dict:
+        return {}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None:
+        states = self._states.setdefault(key, {})
+        if states.get(name) == new_state:
+            return
+        if new_state is None:
+            states.pop(name, None)
+            if not states:
+                del self._states[key]
+        else:
+            states[name] = new_state
+        chat_id, user_id = key
+        self._stage(f"chat_{chat_id}", {'conversations': {name: {str(user_id): _DELETE if new_state is None else new_state}}})
+
+    def _remember_user_data(self, user_id: int, data: dict) -> None:
+        if data:
+            self._user_data[user_id] = copy.deepcopy(data)
+        else:
+            self._user_data.pop(user_id, None)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if data == self._user_data.get(user_id, {}):
+            return
+        self._remember_user_data(user_id, data)
+        self._stage(f"user_{user_id}", {'user_data': data}, replace=True)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_data.pop(user_id, None)
+        self._stage(f"user_{user_id}", {}, replace=True)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        # Only updates that reach a conversation have the user's document loaded (see load_update);
+        # the handlers of the others don't use user_data.
+        if f"user_{user_id}" not in _update_documents.get():
+            return
+        stored = (await self._load(f"user_{user_id}")).get('user_data', {})
+        self._remember_user_data(user_id, stored)
+        user_data.clear()
+        user_data.update(copy.deepcopy(stored))
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        writes, self._pending = self._pending, {}
+        if not writes:
+            return
+        # Buffered counters ride along in the same batch instead of a round-trip of their own.
+        buffered = write_buffer.take(WRITE_BUFFER_MAX_WRITES - len(writes)) if isinstance(self.store, FirestoreStateStore) else []
+        try:
+            if buffered:
+                await external_call('state_store', 'commit', self.store.commit, writes, buffered)
+                write_buffer.committed += len(buffered)
+            else:
+                await external_call('state_store', 'commit', self.store.commit, writes)
+        except Exception as e:
+            logger.error(f"Failed to persist bot state for {list(writes)}: {e}")
+            for doc_id, write in writes.items():
+                self._pending.setdefault(doc_id, write)
+            if buffered:
+                write_buffer.restore(buffered)
+
+bot_persistence = BotPersistence()
+
+# --- Shared HTTP Client ---
+# One pooled client per event loop. Vercel may run each invocation on a fresh loop,
+# so the client (and everything bound to it) is rebuilt when the running loop changes.
+_http_client = None
+_http_client_loop = None
+_host_semaphores = {}
+_send_batcher = None
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client, _http_client_loop, _send_batcher
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(20, connect=5),
+        )
+        _http_client_loop = loop
+        _host_semaphores.clear()
+        _send_batcher = None
+    return _http_client
+
+def _host_semaphore(url: str) -> asyncio.Semaphore:
+    host = httpx.URL(url).host
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+    return semaphore
+
+def _retry_delay(attempt: int) -> float:
+    # Full jitter: spreads retries from concurrent callers instead of synchronising them.
+    return random.uniform(0, min(HTTP_RETRY_MAX_DELAY, HTTP_RETRY_BASE_DELAY * 2 ** attempt))
+
+def _retry_after(response: httpx.Response):
+    """Seconds from a Retry-After header given in seconds, or None if absent or an HTTP date."""
+    try:
+        return max(0.0, float(response.headers.get('Retry-After', '')))
+    except ValueError:
+        return None
+
+async def post_json_with_retry(url: str, payload: dict, max_retries: int = SEND_MESSAGE_MAX_RETRIES) -> dict:
+    """POSTs JSON through the shared client. Only failures the gateway cannot have acted on are retried
+    (connection errors, 429 and 503, honouring Retry-After); a timeout or 5xx after the request was
+    sent may mean the message went out, so it is raised rather than sent twice."""
+    client = get_http_client()
+    op = 'send_batch' if url == SEND_MESSAGE_BATCH_URL else 'send'
+    attempt = 0
     while True:
-        pin = generate_pin(length)
-        if await is_pin_unique(pin):
-            return pin
-        await asyncio.sleep(0.1)
+        try:
+            with metrics.timer('whatsapp', op):
+                async with _host_semaphore(url):
+                    response = await client.post(url, json=payload)
+                metrics.add_bytes('whatsapp', op, 'sent', len(response.request.content))
+                metrics.add_bytes('whatsapp', op, 'received', len(response.content))
+                response.raise_for_status()
+            return response.json()
+        except (HTTP_SEND_RETRYABLE_ERRORS + (httpx.HTTPStatusError,)) as e:
+            delay = _retry_delay(attempt)
+            if isinstance(e, httpx.HTTPStatusError):
+                if e.response.status_code not in HTTP_SEND_RETRYABLE_STATUS_CODES:
+                    raise
+                retry_after = _retry_after(e.response)
+                if retry_after is not None:
+                    if retry_after > HTTP_MAX_RETRY_AFTER:
+                        raise
+                    delay = retry_after
+            if attempt >= max_retries:
+                raise
+            attempt += 1
+            logger.warning(f"POST to {url} failed ({e!r}), retry {attempt}/{max_retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+class SendMessageBatcher:
+    """Groups sends issued within a short window into a single request to SEND_MESSAGE_BATCH_URL."""
+
+    def __init__(self, url: str, max_size: int = SEND_MESSAGE_BATCH_SIZE, window: float = SEND_MESSAGE_BATCH_WINDOW):
+        self.url = url
+        self.max_size = max_size
+        self.window = window
+        self._pending = []
+        self._timer = None
+
+    async def submit(self, number: str, message_text: str) -> bool:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({"number": number, "message": message_text}, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: list) -> None:
+        try:
+            api_response = await post_json_with_retry(self.url, {"messages": [payload for payload, _ in batch]})
+            results = api_response.get("results") or []
+        except Exception as e:
+            logger.error(f"Batch message API call failed for {len(batch)} messages: {e}. URL: {self.url}")
+            results = []
+        for index, (payload, future) in enumerate(batch):
+            result = results[index] if index < len(results) else {}
+            ok = isinstance(result, dict) and result.get("status") == "success"
+            if not ok:
+                logger.warning(f"Failed to send batched message to {payload['number']}. API Response: {result}")
+            if not future.done():
+                future.set_result(ok)
+
+def get_send_batcher():
+    global _send_batcher
+    if not SEND_MESSAGE_BATCH_URL:
+        return None
+    get_http_client()  # resets the batcher if the event loop changed
+    if _send_batcher is None:
+        _send_batcher = SendMessageBatcher(SEND_MESSAGE_BATCH_URL)
+    return _send_batcher
 
 # --- Send Message API Function ---
 async def send_message_via_api(number: str, message_text: str) -> bool:
-    logger.info(f"Attempting to send message to number: {number} with text: {message_text[:50]}...")
-    payload = {"number": number, "message": message_text}
-    headers = {"Content-Type": "application/json"}
+    logger.info(f"Attempting to send a {len(message_text)}-character message to number: {number}...")
+
+    batcher = get_send_batcher()
+    if batcher:
+        return await batcher.submit(number, message_text)
 
+    payload = {"number": number, "message": message_text}
     try:
-        response = requests.post(SEND_MESSAGE_API_URL, json=payload, headers=headers, timeout=20)
-        response.raise_for_status()
-        api_response = response.json()
-        
+        api_response = await post_json_with_retry(SEND_MESSAGE_API_URL, payload)
+
         if api_response.get("status") == "success": 
             logger.info(f"Message sent successfully to {number}. API Response: {api_response}")
             return True
         else:
             logger.warning(f"Failed to send message to {number}. API Response: {api_response}")
             return False
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         logger.error(f"Message API call timed out for number: {number}. URL: {SEND_MESSAGE_API_URL}")
         return False
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Message API call failed for number {number}: {e}. URL: {SEND_MESSAGE_API_URL}")
         return False
     except ValueError as e:
-        logger.error(f"Failed to decode JSON response from Message API: {e}. Response content: {response.text}")
+        logger.error(f"Failed to decode JSON response from Message API: {e}")
         return False
     except Exception as e:
         logger.error(f"An unexpected error occurred during message API call: {e}")
         return False
 
+# --- Broadcast Queue ---
+# Each recipient moves pending -> sending -> sent/failed. A recipient left in 'sending'
+# after its lease expires may or may not have been delivered, so it is marked
+# 'interrupted' instead of being retried: resuming a job never sends a duplicate.
+
+def normalize_number(value: str) -> str:
+    return value.strip().replace(' ', '').replace('-', '').lstrip('+')
+
+def is_valid_number(number: str) -> bool:
+    return number.isdigit() and len(number) >= 10
+
+def parse_broadcast_recipients(text: str) -> list:
+    """Parses a plain number list or a CSV (with a header row when it has extra columns) into recipient dicts."""
+    rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+    recipients = {}
+    if rows and not is_valid_number(normalize_number(rows[0][0])):
+        header = [cell.strip().lower() for cell in rows[0]]
+        number_column = header.index('number') if 'number' in header else 0
+        for row in rows[1:]:
+            if number_column >= len(row):
+                continue
+            number = normalize_number(row[number_column])
+            if is_valid_number(number):
+                recipients[number] = {key: value.strip() for key, value in zip(header, row) if key}
+                recipients[number]['number'] = number
+    else:
+        for row in rows:
+            for cell in row:
+                for token in cell.split():
+                    number = normalize_number(token)
+                    if is_valid_number(number):
+                        recipients.setdefault(number, {'number': number})
+    return list(recipients.values())
+
+class _TemplateValues(dict):
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+def render_broadcast_message(template: str, recipient: dict) -> str:
+    try:
+        return template.format_map(_TemplateValues(recipient))
+    except (ValueError, IndexError):
+        return template
+
+class FirestoreBroadcastStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def _recipients(self, job_id: str):
+        return self.collection.document(job_id).collection('recipients')
+
+    def _create_job(self, owner_id: int, template: str, recipients: list) -> str:
+        from firebase_admin import firestore
+        db = get_firestore()
+        job_ref = self.collection.document()
+        job_ref.set({
+            'owner_id': owner_id,
+            'template': template,
+            'total': len(recipients),
+            'sent': 0,
+            'failed': 0,
+            'created_at': firestore.SERVER_TIMESTAMP,
+        })
+        for start in range(0, len(recipients), 500):
+            batch = db.batch()
+            for recipient in recipients[start:start + 500]:
+                batch.set(self._recipients(job_ref.id).document(recipient['number']),
+                          {'number': recipient['number'], 'vars': recipient, 'status': 'pending'})
+            batch.commit()
+        return job_ref.id
+
+    def _get_job(self, job_id: str):
+        doc = self.collection.document(job_id).get()
+        return dict(doc.to_dict(), id=job_id) if doc.exists else None
+
+    def _claim(self, job_id: str, limit: int) -> list:
+        claimed = []
+        for snapshot in self._recipients(job_id).where('status', '==', 'pending').limit(limit).get():
+            try:
+                # Precondition on update_time makes the claim fail if another worker got there first.
+                snapshot.reference.update({'status': 'sending', 'claimed_at': time.time()},
+                                          option=get_firestore().write_option(last_update_time=snapshot.update_time))
+            except Exception:
+                continue
+            claimed.append(snapshot.to_dict()['vars'])
+        return claimed
+
+    def _finish(self, job_id: str, number: str, status: str) -> None:
+        from firebase_admin import firestore
+        batch = get_firestore().batch()
+        batch.update(self._recipients(job_id).document(number), {'status': status})
+        batch.update(self.collection.document(job_id), {'sent' if status == 'sent' else 'failed': firestore.Increment(1)})
+        batch.commit()
+
+    def _recover_stale(self, job_id: str, lease: float) -> int:
+        recovered = 0
+        for snapshot in self._recipients(job_id).where('status', '==', 'sending').get():
+            if (snapshot.get('claimed_at') or 0) < time.time() - lease:
+                self._finish(job_id, snapshot.id, 'interrupted')
+                recovered += 1
+        return recovered
+
+    def _failures(self, job_id: str, limit: int) -> list:
+        query = self._recipients(job_id).where('status', 'in', ['failed', 'interrupted']).limit(limit)
+        return [(snapshot.id, snapshot.get('status')) for snapshot in query.get()]
+
+    def _next_claimable_at(self, job_id: str, lease: float):
+        if self._recipients(job_id).where('status', '==', 'pending').limit(1).get():
+            return time.time()
+        claimed = [snapshot.get('claimed_at') or 0 for snapshot in self._recipients(job_id).where('status', '==', 'sending').get()]
+        return min(claimed) + lease if claimed else None
+
+    async def create_job(self, owner_id: int, template: str, recipients: list) -> str:
+        return await external_call('broadcast_store', 'create_job', self._create_job, owner_id, template, recipients)
+
+    async def get_job(self, job_id: str):
+        return await external_call('broadcast_store', 'get_job', self._get_job, job_id)
+
+    async def claim(self, job_id: str, limit: int) -> list:
+        return await external_call('broadcast_store', 'claim', self._claim, job_id, limit)
+
+    async def finish(self, job_id: str, number: str, status: str) -> None:
+        await external_call('broadcast_store', 'finish', self._finish, job_id, number, status)
+
+    async def recover_stale(self, job_id: str, lease: float) -> int:
+        return await external_call('broadcast_store', 'recover_stale', self._recover_stale, job_id, lease)
+
+    async def failures(self, job_id: str, limit: int = 20) -> list:
+        return await external_call('broadcast_store', 'failures', self._failures, job_id, limit)
+
+    async def next_claimable_at(self, job_id: str, lease: float):
+        """When a recipient of the job can next be claimed: now while any are pending, otherwise when the
+        earliest lease of those being sent expires; None once no recipient is left."""
+        return await external_call('broadcast_store', 'next_claimable_at', self._next_claimable_at, job_id, lease)
+
+class SqliteBroadcastStore(FirestoreBroadcastStore):
+    """Local stand-in for FirestoreBroadcastStore, used when Firestore is not configured."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(
+                'CREATE TABLE IF NOT EXISTS broadcast_jobs (id TEXT PRIMARY KEY, owner_id INTEGER, template TEXT,'
+                ' total INTEGER, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, created_at REAL);'
+                'CREATE TABLE IF NOT EXISTS broadcast_recipients (job_id TEXT, number TEXT, vars TEXT, status TEXT,'
+                ' claimed_at REAL, PRIMARY KEY (job_id, number));'
+                'CREATE INDEX IF NOT EXISTS broadcast_recipients_status ON broadcast_recipients (job_id, status);'
+            )
+
+    def _create_job(self, owner_id: int, template: str, recipients: list) -> str:
+        job_id = generate_pin(12)
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('INSERT INTO broadcast_jobs (id, owner_id, template, total, created_at) VALUES (?, ?, ?, ?, ?)',
+                              (job_id, owner_id, template, len(recipients), time.time()))
+            self.conn.executemany("INSERT OR IGNORE INTO broadcast_recipients VALUES (?, ?, ?, 'pending', NULL)",
+                                  [(job_id, r['number'], json.dumps(r)) for r in recipients])
+            self.conn.execute('COMMIT')
+        return job_id
+
+    def _get_job(self, job_id: str):
+        with self.lock:
+            row = self.conn.execute('SELECT owner_id, template, total, sent, failed FROM broadcast_jobs WHERE id = ?', (job_id,)).fetchone()
+        if not row:
+            return None
+        return dict(zip(('owner_id', 'template', 'total', 'sent', 'failed'), row), id=job_id)
+
+    def _claim(self, job_id: str, limit: int) -> list:
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute("SELECT number, vars FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' LIMIT ?",
+                                     (job_id, limit)).fetchall()
+            self.conn.executemany("UPDATE broadcast_recipients SET status = 'sending', claimed_at = ? WHERE job_id = ? AND number = ?",
+                                  [(time.time(), job_id, number) for number, _ in rows])
+            self.conn.execute('COMMIT')
+        return [json.loads(vars_json) for _, vars_json in rows]
+
+    def _finish(self, job_id: str, number: str, status: str) -> None:
+        counter = 'sent' if status == 'sent' else 'failed'
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.execute('UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND number = ?', (status, job_id, number))
+            self.conn.execute(f'UPDATE broadcast_jobs SET {counter} = {counter} + 1 WHERE id = ?', (job_id,))
+            self.conn.execute('COMMIT')
+
+    def _recover_stale(self, job_id: str, lease: float) -> int:
+        with self.lock:
+            rows = self.conn.execute("SELECT number FROM broadcast_recipients WHERE job_id = ? AND status = 'sending' AND claimed_at < ?",
+                                     (job_id, time.time() - lease)).fetchall()
+        for (number,) in rows:
+            self._finish(job_id, number, 'interrupted')
+        return len(rows)
+
+    def _failures(self, job_id: str, limit: int) -> list:
+        with self.lock:
+            return self.conn.execute("SELECT number, status FROM broadcast_recipients WHERE job_id = ? AND status IN ('failed', 'interrupted') LIMIT ?",
+                                     (job_id, limit)).fetchall()
+
+    def _next_claimable_at(self, job_id: str, lease: float):
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM broadcast_recipients WHERE job_id = ? AND status = 'pending' LIMIT 1", (job_id,)).fetchone():
+                return time.time()
+            (oldest,) = self.conn.execute("SELECT MIN(claimed_at) FROM broadcast_recipients WHERE job_id = ? AND status = 'sending'",
+                                          (job_id,)).fetchone()
+        return oldest + lease if oldest is not None else None
+
+_broadcast_store = None
+# Shared across every drain in this instance so concurrent jobs don't multiply the gateway rate.
+_broadcast_bucket = TokenBucket(BROADCAST_RATE_PER_SECOND, BROADCAST_RATE_PER_SECOND)
+
+def get_broadcast_store():
+    global _broadcast_store
+    if _broadcast_store is None:
+        if get_collection('broadcasts'):
+            _broadcast_store = FirestoreBroadcastStore(get_collection('broadcasts'))
+        else:
+            logger.warning(f"Firestore not initialized, using local SQLite broadcast queue at {BROADCAST_SQLITE_PATH}.")
+            _broadcast_store = SqliteBroadcastStore(BROADCAST_SQLITE_PATH)
+    return _broadcast_store
+
+async def drain_broadcast(job_id: str, on_progress=None, time_budget: float = BROADCAST_TIME_BUDGET):
+    """Sends pending recipients of a job until the queue is empty or the time budget runs out. Returns the job."""
+    store = get_broadcast_store()
+    job = await store.get_job(job_id)
+    if not job:
+        return None
+
+    recovered = await store.recover_stale(job_id, BROADCAST_LEASE_SECONDS)
+    if recovered:
+        logger.warning(f"Broadcast {job_id}: marked {recovered} stale in-flight recipients as interrupted.")
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + time_budget
+    semaphore = asyncio.Semaphore(BROADCAST_WORKERS)
+
+    async def deliver(recipient: dict) -> None:
+        async with semaphore:
+            await _broadcast_bucket.acquire()
+            try:
+                ok = await send_message_via_api(recipient['number'], render_broadcast_message(job['template'], recipient))
+            except Exception as e:
+                logger.error(f"Broadcast {job_id}: unexpected error sending to {recipient['number']}: {e}")
+                ok = False
+            await store.finish(job_id, recipient['number'], 'sent' if ok else 'failed')
+
+    while loop.time() < deadline:
+        recipients = await store.claim(job_id, BROADCAST_WORKERS * 4)
+        if not recipients:
+            break
+        await asyncio.gather(*(deliver(recipient) for recipient in recipients))
+        if on_progress:
+            await on_progress(await store.get_job(job_id))
+    return await store.get_job(job_id)
+
+def format_broadcast_progress(job: dict) -> str:
+    done = job['sent'] + job['failed']
+    return (f"Broadcast `{job['id']}`: {done}/{job['total']} සම්පූර්ණයි "
+            f"(✅ {job['sent']} | ❌ {job['failed']} | ⏳ {job['total'] - done})")
+
+# --- Background Job Queue ---
+# Jobs move pending -> running -> done/failed. A job whose worker died (lease expired)
+# goes back to pending until it has been attempted JOB_MAX_ATTEMPTS times. A job enqueued with a
+# delay is 'waiting' until release_due() finds its available_at has passed and makes it pending.
+class FirestoreJobQueue:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def _enqueue(self, kind: str, payload: dict, delay: float) -> str:
+        job_ref = self.collection.document()
+        job = {'kind': kind, 'payload': payload, 'status': 'pending', 'attempts': 0, 'created_at': time.time()}
+        if delay > 0:
+            job.update(status='waiting', available_at=time.time() + delay)
+        job_ref.set(job)
+        return job_ref.id
+
+    def _claim(self, kind: str, limit: int) -> list:
+        claimed = []
+        query = self.collection.where('kind', '==', kind).where('status', '==', 'pending').limit(limit)
+        for snapshot in query.get():
+            job = snapshot.to_dict()
+            try:
+                snapshot.reference.update({'status': 'running', 'claimed_at': time.time(), 'attempts': job['attempts'] + 1},
+                                          option=get_firestore().write_option(last_update_time=snapshot.update_time))
+            except Exception:
+                continue
+            claimed.append(dict(job, id=snapshot.id))
+        return claimed
+
+    def _finish(self, job_id: str, status: str) -> None:
+        self.collection.document(job_id).update({'status': status, 'finished_at': time.time()})
+
+    def _recover_stale(self, kind: str, lease: float) -> int:
+        recovered = 0
+        for snapshot in self.collection.where('kind', '==', kind).where('status', '==', 'running').get():
+            job = snapshot.to_dict()
+            if job.get('claimed_at', 0) < time.time() - lease:
+                status = 'pending' if job.get('attempts', 0) < JOB_MAX_ATTEMPTS else 'failed'
+                snapshot.reference.update({'status': status})
+                recovered += 1
+        return recovered
+
+    def _release_due(self, kind: str) -> int:
+        released = 0
+        for snapshot in self.collection.where('kind', '==', kind).where('status', '==', 'waiting').get():
+            if (snapshot.get('available_at') or 0) <= time.time():
+                snapshot.reference.update({'status': 'pending'})
+                released += 1
+        return released
+
+    async def enqueue(self, kind: str, payload: dict, delay: float = 0.0) -> str:
+        """Queues a job, claimable straight away or, with a delay, once release_due() runs after it."""
+        return await external_call('job_queue', 'enqueue', self._enqueue, kind, payload, delay)
+
+    async def claim(self, kind: str, limit: int) -> list:
+        return await external_call('job_queue', 'claim', self._claim, kind, limit)
+
+    async def finish(self, job_id: str, status: str) -> None:
+        await external_call('job_queue', 'finish', self._finish, job_id, status)
+
+    async def recover_stale(self, kind: str, lease: float = JOB_LEASE_SECONDS) -> int:
+        return await external_call('job_queue', 'recover_stale', self._recover_stale, kind, lease)
+
+    async def release_due(self, kind: str) -> int:
+        return await external_call('job_queue', 'release_due', self._release_due, kind)
+
+class SqliteJobQueue(FirestoreJobQueue):
+    """Local stand-in for FirestoreJobQueue; the webhook and the worker must share the host."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.executescript(
+                'CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, payload TEXT, status TEXT,'
+                ' attempts INTEGER DEFAULT 0, created_at REAL, claimed_at REAL, finished_at REAL, available_at REAL);'
+                'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (kind, status);'
+            )
+            # Queues created before delayed jobs lack the column.
+            with contextlib.suppress(sqlite3.OperationalError):
+                self.conn.execute('ALTER TABLE jobs ADD COLUMN available_at REAL')
+
+    def _enqueue(self, kind: str, payload: dict, delay: float) -> str:
+        job_id = generate_pin(12)
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT INTO jobs (id, kind, payload, status, created_at, available_at) VALUES (?, ?, ?, ?, ?, ?)',
+                              (job_id, kind, json.dumps(payload), 'waiting' if delay > 0 else 'pending', now, now + delay))
+        return job_id
+
+    def _claim(self, kind: str, limit: int) -> list:
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            rows = self.conn.execute("SELECT id, payload, attempts FROM jobs WHERE kind = ? AND status = 'pending' ORDER BY created_at LIMIT ?",
+                                     (kind, limit)).fetchall()
+            self.conn.executemany("UPDATE jobs SET status = 'running', claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+                                  [(time.time(), job_id) for job_id, _, _ in rows])
+            self.conn.execute('COMMIT')
+        return [{'id': job_id, 'kind': kind, 'payload': json.loads(payload), 'attempts': attempts} for job_id, payload, attempts in rows]
+
+    def _finish(self, job_id: str, status: str) -> None:
+        with self.lock:
+            self.conn.execute('UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?', (status, time.time(), job_id))
+
+    def _recover_stale(self, kind: str, lease: float) -> int:
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            cutoff = time.time() - lease
+            failed = self.conn.execute("UPDATE jobs SET status = 'failed' WHERE kind = ? AND status = 'running' AND claimed_at < ? AND attempts >= ?",
+                                       (kind, cutoff, JOB_MAX_ATTEMPTS)).rowcount
+            retried = self.conn.execute("UPDATE jobs SET status = 'pending' WHERE kind = ? AND status = 'running' AND claimed_at < ?",
+                                        (kind, cutoff)).rowcount
+            self.conn.execute('COMMIT')
+        return failed + retried
+
+    def _release_due(self, kind: str) -> int:
+        with self.lock:
+            return self.conn.execute("UPDATE jobs SET status = 'pending' WHERE kind = ? AND status = 'waiting' AND available_at <= ?",
+                                     (kind, time.time())).rowcount
+
+_job_queue = None
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        if get_collection('jobs'):
+            _job_queue = FirestoreJobQueue(get_collection('jobs'))
+        else:
+            logger.warning(f"Firestore not initialized, using local SQLite job queue at {JOB_QUEUE_SQLITE_PATH}.")
+            _job_queue = SqliteJobQueue(JOB_QUEUE_SQLITE_PATH)
+    return _job_queue
+
 # --- AI API Function ---
-async def ask_gemini_ai(query: str) -> str:
-    if not gemini_model:
-        return "AI සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න."
-    
+AI_UNAVAILABLE_TEXT = "AI සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න."
+AI_ERROR_TEXT = "AI ප්‍රතිචාරයක් ලබාගැනීමේ දෝෂයක් සිදුවිය. කරුණාකර පසුව උත්සාහ කරන්න."
+
+async def generate_gemini_stream(query: str, usage: dict, history: list = None):
+    """Yields Gemini's answer to `query` piece by piece and records the token count in `usage`.
+    With `history`, the query is sent as the next message of a chat that starts from it."""
+    gemini_model = get_gemini_model()
     logger.info(f"Asking AI: {query[:100]}...")
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    def generate() -> None:
+        # The SDK's stream is a blocking iterator, so it is drained on a worker thread.
+        try:
+            if history is None:
+                stream = gemini_model.generate_content(query, stream=True)
+            else:
+                stream = gemini_model.start_chat(history=history).send_message(query, stream=True)
+            for chunk in stream:
+                metadata = getattr(chunk, 'usage_metadata', None)
+                if metadata and metadata.total_token_count:
+                    usage['tokens'] = metadata.total_token_count
+                loop.call_soon_threadsafe(chunks.put_nowait, chunk.text)
+        except Exception as e:
+            loop.call_soon_threadsafe(chunks.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    generator = asyncio.ensure_future(asyncio.to_thread(generate))
+    op = 'generate' if history is None else 'chat'
+    started = time.perf_counter()
+    try:
+        with metrics.timer('gemini', op):
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if started is not None:
+                    metrics.observe('gemini', f'{op}_first_chunk', time.perf_counter() - started)
+                    started = None
+                metrics.add_bytes('gemini', op, 'received', len(chunk.encode('utf-8')))
+                yield chunk
+    finally:
+        await generator
+
+# --- AI Answer Cache ---
+def normalize_query(query: str) -> str:
+    return ' '.join(query.casefold().split()).rstrip('?!.। ')
+
+def embed_query(text: str) -> dict:
+    """Unit-length hashed bag of words and character trigrams; cheap enough to compute per query."""
+    features = Counter(text.split())
+    features.update(text[i:i + 3] for i in range(len(text) - 2))
+    vector = Counter()
+    for feature, count in features.items():
+        vector[zlib.crc32(feature.encode('utf-8')) % AI_EMBEDDING_DIMENSIONS] += count
+    norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+    return {index: value / norm for index, value in vector.items()}
+
+def cosine_similarity(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+class SharedAnswer:
+    """One upstream Gemini stream that any number of identical queries read as it arrives."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.failed = False
+        self.followers = 0
+        self.changed = asyncio.Event()
+
+    def add(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._wake()
+
+    def close(self) -> None:
+        self.done = True
+        self._wake()
+
+    def _wake(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def read(self):
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                return
+            await self.changed.wait()
+
+class AnswerCache:
+    """Gemini answers keyed on the normalized query, with identical in-flight queries sharing one
+    upstream call. With AI_CACHE_SIMILARITY set, an exact miss falls back to the most similar
+    cached query in memory."""
+
+    def __init__(self, max_entries: int = AI_CACHE_MAX_ENTRIES, ttl: int = AI_CACHE_TTL,
+                 similarity: float = AI_CACHE_SIMILARITY):
+        self.ttl = ttl
+        self.similarity = similarity
+        self.memory = LRUCache(max_entries, ttl)
+        self.inflight = {}
+        self._tasks = set()
+        self.hits = 0
+        self.similar_hits = 0
+        self.remote_hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    @property
+    def collection(self):
+        return get_collection('ai_cache')
+
+    def _doc(self, key: str):
+        return self.collection.document(hashlib.sha256(key.encode()).hexdigest())
+
+    def _remember(self, key: str, entry: dict, ttl: float = None) -> None:
+        if self.similarity:
+            entry = dict(entry, vector=embed_query(key))
+        self.memory.set(key, entry, ttl=ttl)
+
+    def _most_similar(self, key: str):
+        vector = embed_query(key)
+        best, best_score = None, self.similarity
+        for _, entry in self.memory.items():
+            score = cosine_similarity(vector, entry['vector'])
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    async def get(self, key: str):
+        entry = self.memory.get(key)
+        if entry is None and self.collection:
+            try:
+                doc = await external_call('firestore', 'ai_cache_get', self._doc(key).get)
+                entry = doc.to_dict() if doc.exists else None
+            except Exception as e:
+                logger.warning(f"AI cache lookup failed: {e}")
+                entry = None
+            if entry and entry.get('expires_at', 0) > time.time():
+                self._remember(key, entry, ttl=entry['expires_at'] - time.time())
+                self.remote_hits += 1
+            else:
+                entry = None
+        if entry is None and self.similarity:
+            entry = self._most_similar(key)
+            if entry:
+                self.similar_hits += 1
+        if entry is None:
+            return None
+        self.hits += 1
+        self.saved_tokens += entry.get('tokens', 0)
+        return entry
+
+    async def put(self, key: str, answer: str, tokens: int) -> None:
+        entry = {'answer': answer, 'tokens': tokens, 'expires_at': time.time() + self.ttl}
+        self._remember(key, entry)
+        if self.collection:
+            try:
+                await external_call('firestore', 'ai_cache_set', self._doc(key).set, entry)
+            except Exception as e:
+                logger.warning(f"Failed to store AI cache entry: {e}")
+
+    def shared_answer(self, key: str, query: str) -> SharedAnswer:
+        """Joins the in-flight upstream call for `key`, or starts one."""
+        shared = self.inflight.get(key)
+        if shared is not None:
+            shared.followers += 1
+            self.coalesced += 1
+            return shared
+        self.misses += 1
+        shared = self.inflight[key] = SharedAnswer()
+        # Runs independently of the requesting handler so the other readers get the whole answer.
+        task = asyncio.ensure_future(self._fill(key, query, shared))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return shared
+
+    async def _fill(self, key: str, query: str, shared: SharedAnswer) -> None:
+        usage = {}
+        try:
+            async for chunk in generate_gemini_stream(query, usage):
+                shared.add(chunk)
+        except Exception as e:
+            logger.error(f"Error calling Gemini AI: {e}")
+            shared.failed = True
+            shared.add(f"\n\n{AI_ERROR_TEXT}" if ''.join(shared.chunks).strip() else AI_ERROR_TEXT)
+        finally:
+            self.inflight.pop(key, None)
+            shared.close()
+        if not shared.failed:
+            answer = ''.join(shared.chunks)
+            tokens = usage.get('tokens') or estimate_tokens(query) + estimate_tokens(answer)
+            self.saved_tokens += tokens * shared.followers
+            if answer.strip():
+                await self.put(key, answer, tokens)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            'hits': self.hits,
+            'similar_hits': self.similar_hits,
+            'remote_hits': self.remote_hits,
+            'coalesced': self.coalesced,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'saved_tokens': self.saved_tokens,
+            'entries': len(self.memory),
+        }
+
+answer_cache = AnswerCache()
+
+async def cached_gemini_answer(query: str):
+    """Returns the complete answer to `query` when it needs no generating (a cache hit, or the AI being
+    unavailable), otherwise None."""
+    if not get_gemini_model():
+        return AI_UNAVAILABLE_TEXT
+    entry = await answer_cache.get(normalize_query(query))
+    return entry['answer'] if entry else None
+
+async def generate_gemini_ai(query: str):
+    """Yields Gemini's answer to `query` piece by piece, shared with identical queries in flight."""
+    async for chunk in answer_cache.shared_answer(normalize_query(query), query).read():
+        yield chunk
+
+async def stream_gemini_ai(query: str):
+    """Yields the answer to `query` piece by piece, from the answer cache or as Gemini generates it."""
+    answer = await cached_gemini_answer(query)
+    if answer is not None:
+        yield answer
+        return
+    async for chunk in generate_gemini_ai(query):
+        yield chunk
+
+async def ask_gemini_ai(query: str) -> str:
+    return ''.join([chunk async for chunk in stream_gemini_ai(query)])
+
+# --- AI Reply Streaming ---
+def split_message_text(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> tuple:
+    """Splits `text` into a head of at most `limit` characters and the rest, cutting at a paragraph,
+    line or word boundary in the second half of the head where there is one."""
+    if len(text) <= limit:
+        return text, ''
+    for separator in ('\n\n', '\n', ' '):
+        cut = text.rfind(separator, limit // 2, limit)
+        if cut > 0:
+            return text[:cut], text[cut:].lstrip()
+    return text[:limit], text[limit:]
+
+class StreamingReply:
+    """Shows a growing answer by editing a message at most once per `interval`, continuing in a new
+    message whenever the text outgrows Telegram's message limit."""
+
+    def __init__(self, message: telegram.Message, interval: float):
+        self.message = message  # placeholder that becomes the first part of the answer
+        self.chat = message.chat
+        self.interval = interval
+        self.text = ''
+        self.shown = None
+        self.next_edit = 0.0
+        self.first_shown_at = None
+
+    async def append(self, chunk: str) -> None:
+        self.text += chunk
+        while len(self.text) > TELEGRAM_MESSAGE_LIMIT - len(AI_STREAM_CURSOR):
+            head, self.text = split_message_text(self.text, TELEGRAM_MESSAGE_LIMIT - len(AI_STREAM_CURSOR))
+            await self.show(head, final=True)
+            self.message, self.shown = None, None
+        await self.show(self.text + AI_STREAM_CURSOR)
+
+    async def finish(self) -> None:
+        if self.text.strip():
+            await self.show(self.text, final=True)
+        elif self.message is not None and self.shown is None:
+            await self.show("AI ප්‍රතිචාරයක් ලැබුණේ නැත. කරුණාකර වෙනත් ආකාරයකින් විමසන්න.", final=True)
+
+    async def show(self, text: str, final: bool = False) -> None:
+        """Edits (or, after a split, sends) the current message; non-final updates are skipped
+        while the edit interval is pending. RetryAfter is handled by the bot's SendScheduler."""
+        if not text.strip() or text == self.shown:
+            return
+        wait = self.next_edit - time.monotonic()
+        if wait > 0:
+            if not final:
+                return
+            await asyncio.sleep(wait)
+        try:
+            if self.message is None:
+                self.message = await self.chat.send_message(text)
+            else:
+                await self.message.edit_text(text)
+        except telegram.error.BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+        self.shown = text
+        self.next_edit = time.monotonic() + self.interval
+        if self.first_shown_at is None:
+            self.first_shown_at = time.monotonic()
+
+# --- Outbound Send Scheduler ---
+class SendScheduler(BaseRateLimiter):
+    """PTB rate limiter for every Bot API call the Application's bot makes.
+
+    Calls that post to a chat wait their turn in that chat (FIFO) for a token from its bucket and
+    then for one from the global bucket. A RetryAfter pauses all calls for the requested time and the
+    call is retried, unless the wait would exceed TELEGRAM_MAX_RETRY_AFTER.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = LRUCache(10000, 600)
+        self.paused_until = 0.0
+        self.loop = None
+        self.chat_locks = {}  # chat_id -> (lock, callers using it)
+        self.calls = Counter()  # endpoint -> calls
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.retry_afters = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Group and channel IDs are negative.
+            group = isinstance(chat_id, int) and chat_id < 0
+            rate = TELEGRAM_GROUP_RATE_PER_MINUTE / 60 if group else TELEGRAM_CHAT_RATE
+            bucket = TokenBucket(rate, TELEGRAM_CHAT_BURST)
+        self.chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    async def _wait_turn(self, chat_id) -> None:
+        # Locks belong to the running loop; a new loop (a new Vercel invocation) starts afresh.
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.chat_locks.clear()
+            self.loop = loop
+        started = time.monotonic()
+        lock, users = self.chat_locks.get(chat_id, (asyncio.Lock(), 0))
+        self.chat_locks[chat_id] = (lock, users + 1)
+        try:
+            async with lock:
+                for bucket in (self._chat_bucket(chat_id), self.global_bucket):
+                    while True:
+                        wait = max(self.paused_until - time.monotonic(), bucket.wait_time())
+                        if wait <= 0 and bucket.try_acquire():
+                            break
+                        await asyncio.sleep(max(wait, 0.01))
+        finally:
+            lock, users = self.chat_locks[chat_id]
+            if users == 1:
+                del self.chat_locks[chat_id]
+            else:
+                self.chat_locks[chat_id] = (lock, users - 1)
+        waited = time.monotonic() - started
+        if waited > 0.01:
+            self.throttled += 1
+            self.throttled_seconds += waited
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        self.calls[endpoint] += 1
+        chat_id = data.get('chat_id')
+        paced = chat_id is not None and endpoint.startswith(('send', 'edit', 'copy', 'forward')) and endpoint != 'sendChatAction'
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            if paced:
+                await self._wait_turn(chat_id)
+            elif self.paused_until > time.monotonic():
+                await asyncio.sleep(self.paused_until - time.monotonic())
+            try:
+                return await callback(*args, **kwargs)
+            except telegram.error.RetryAfter as e:
+                self.retry_afters += 1
+                retry_after = float(e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
+                if attempt == TELEGRAM_MAX_RETRIES or retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                    raise
+                # Flood control applies to the whole bot, so every call waits it out.
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                logger.warning(f"{endpoint} hit flood control; retrying after {retry_after}s.")
+
+    def stats(self) -> dict:
+        return {
+            'calls': sum(self.calls.values()),
+            'throttled': self.throttled,
+            'throttled_seconds': round(self.throttled_seconds, 2),
+            'retry_afters': self.retry_afters,
+        }
+
+send_scheduler = SendScheduler()
+
+class StatusMessage:
+    """A command's progress shown in one message that is edited in place.
+
+    Nothing is posted for the first STATUS_GRACE_PERIOD seconds, so quick commands only send their
+    result, and texts superseded before they could be shown are dropped instead of sent.
+    """
+
+    def __init__(self, bot: telegram.Bot, chat_id: int, grace: float = STATUS_GRACE_PERIOD):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message = None
+        self.text = None
+        self.shown = None
+        self.next_show = time.monotonic() + grace
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def set(self, text: str) -> None:
+        self.text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._show_later())
+
+    async def _show_later(self) -> None:
+        await asyncio.sleep(max(0.0, self.next_show - time.monotonic()))
+        await self._show()
+
+    async def _show(self) -> None:
+        async with self._lock:
+            text = self.text
+            if text is None or text == self.shown:
+                return
+            try:
+                if self.message is None:
+                    self.message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                else:
+                    await self.message.edit_text(text)
+            except telegram.error.TelegramError as e:
+                logger.warning(f"Could not update status message: {e}")
+                return
+            self.shown = text
+            self.next_show = time.monotonic() + STATUS_EDIT_INTERVAL
+
+    async def finish(self, text: str, quiet: bool = False) -> None:
+        """Shows the final text at once; with quiet=True only if a status is already on screen
+        (e.g. a success note after the result itself was sent)."""
+        if self._task is not None and not self._task.done():
+            # Only a post or edit already in flight is waited for; a pending one is superseded.
+            if not self._lock.locked():
+                self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+        if quiet and self.message is None:
+            return
+        self.text = text
+        await self._show()
+
+# --- Download Cache ---
+# Maps a normalized URL (or YouTube video ID + format) to the Telegram file_id of the first
+# successful upload, so repeat requests are answered by re-sending the file_id.
+_TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid')
+_YOUTUBE_ID_PATTERN = re.compile(r'(?:v=|youtu\.be/|shorts/|embed/|live/)([A-Za-z0-9_-]{11})')
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.startswith(_TRACKING_PARAMS))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', urlencode(query), ''))
+
+def youtube_video_id(url: str):
+    match = _YOUTUBE_ID_PATTERN.search(url)
+    return match.group(1) if match else None
+
+def sent_file(message: telegram.Message) -> tuple:
+    """Returns (file_id, file_type) of a sent message's attachment, file_type keying STORED_FILE_SENDERS."""
+    for file_type in ('document', 'video', 'audio', 'animation'):
+        attachment = getattr(message, file_type)
+        if attachment:
+            return attachment.file_id, file_type
+    return None, None
+
+class DownloadCache:
+    def __init__(self, max_entries: int = DOWNLOAD_CACHE_MAX_ENTRIES, ttl: int = DOWNLOAD_CACHE_TTL):
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries, ttl)
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+
+    @property
+    def collection(self):
+        return get_collection('download_cache')
+
+    def _doc(self, key: str):
+        return self.collection.document(hashlib.sha256(key.encode()).hexdigest())
+
+    async def get(self, key: str):
+        entry = self.memory.get(key)
+        if entry:
+            self.hits += 1
+            return entry
+        if self.collection:
+            try:
+                doc = await external_call('firestore', 'download_cache_get', self._doc(key).get)
+                entry = doc.to_dict() if doc.exists else None
+            except Exception as e:
+                logger.warning(f"Download cache lookup failed for {key}: {e}")
+                entry = None
+            if entry and entry.get('expires_at', 0) > time.time():
+                self.memory.set(key, entry, ttl=entry['expires_at'] - time.time())
+                self.hits += 1
+                self.remote_hits += 1
+                return entry
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, sent: tuple, caption: str) -> None:
+        """Caches the (file_id, file_type) pair returned by sent_file."""
+        file_id, file_type = sent
+        if not file_id:
+            return
+        entry = {'key': key, 'file_id': file_id, 'file_type': file_type, 'caption': caption, 'expires_at': time.time() + self.ttl}
+        self.memory.set(key, entry)
+        if self.collection:
+            try:
+                await external_call('firestore', 'download_cache_set', self._doc(key).set, entry)
+            except Exception as e:
+                logger.warning(f"Failed to store download cache entry for {key}: {e}")
+
+    async def invalidate(self, key: str) -> None:
+        self.memory.pop(key)
+        if self.collection:
+            try:
+                await external_call('firestore', 'download_cache_delete', self._doc(key).delete)
+            except Exception as e:
+                logger.warning(f"Failed to delete download cache entry for {key}: {e}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'remote_hits': self.remote_hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            'entries': len(self.memory),
+        }
+
+download_cache = DownloadCache()
+
+async def send_cached_download(bot: telegram.Bot, chat_id: int, cache_key: str) -> bool:
+    cached = await download_cache.get(cache_key)
+    if not cached:
+        return False
+    # A file_id only works with the send method of its type (sendDocument rejects an audio file_id).
+    method, argument = STORED_FILE_SENDERS.get(cached.get('file_type'), STORED_FILE_SENDERS['document'])
+    try:
+        await getattr(bot, method)(chat_id=chat_id, caption=cached.get('caption'), **{argument: cached['file_id']})
+    except telegram.error.BadRequest as e:
+        logger.warning(f"Cached file_id for {cache_key} was rejected, downloading again: {e}")
+        await download_cache.invalidate(cache_key)
+        return False
+    logger.info(f"Served {cache_key} from download cache.")
+    return True
+
+# --- Media Transcoding ---
+# Brings media over MAX_UPLOAD_SIZE under it: re-encoded at the bitrate its duration allows when that
+# still looks acceptable, otherwise cut into numbered parts by stream copy (no re-encode). At most
+# TRANSCODE_CONCURRENCY ffmpeg encodes run per instance; the rest wait their turn.
+MEDIA_EXTENSIONS = {'.mp4', '.m4v', '.mkv', '.mov', '.webm', '.avi', '.flv', '.ts', '.3gp',
+                    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.wav', '.flac'}
+
+class TranscodeError(Exception):
+    pass
+
+@functools.lru_cache(maxsize=None)
+def transcoding_available() -> bool:
+    return TRANSCODE_ENABLED and shutil.which(FFMPEG_PATH) is not None
+
+def is_media_file(filename: str, content_type: str = None) -> bool:
+    content_type = (content_type or mimetypes.guess_type(filename)[0] or '').split(';')[0]
+    return content_type.startswith(('video/', 'audio/')) or os.path.splitext(filename)[1].lower() in MEDIA_EXTENSIONS
+
+def _video_height_for(bitrate: int) -> int:
+    # Fewer pixels at low bitrates look better than blocky 720p.
+    if bitrate >= 1_500_000:
+        return YT_MAX_HEIGHT
+    return 480 if bitrate >= 700_000 else 360
+
+class MediaTranscoder:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.loop = None
+        self.semaphore = None
+        self.waiting = 0
+        self.runs = Counter()  # op -> ffmpeg runs
+        self.failures = 0
+
+    def _slot(self) -> asyncio.Semaphore:
+        # Bound to the running loop; a new loop (a new Vercel invocation) starts afresh.
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            self.loop = loop
+        return self.semaphore
+
+    async def _ffmpeg(self, op: str, *args) -> tuple:
+        """Runs ffmpeg and returns (returncode, stderr text)."""
+        self.runs[op] += 1
+        with metrics.timer('ffmpeg', op):
+            process = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, '-hide_banner', '-nostdin', *args,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), TRANSCODE_TIMEOUT)
+            except BaseException:
+                process.kill()
+                await process.wait()
+                raise
+        return process.returncode, stderr.decode('utf-8', 'replace')
+
+    async def _run(self, op: str, *args) -> None:
+        self.waiting += 1
+        queued = True
+        try:
+            async with self._slot():
+                self.waiting -= 1
+                queued = False
+                returncode, stderr = await self._ffmpeg(op, *args)
+        finally:
+            if queued:
+                self.waiting -= 1
+        if returncode != 0:
+            self.failures += 1
+            raise TranscodeError(f"ffmpeg {op} exited with {returncode}: {stderr.strip()[-300:]}")
+
+    async def probe(self, path: str) -> dict:
+        """Duration and stream types from ffmpeg's input summary (ffmpeg exits 1 without an output)."""
+        _, stderr = await self._ffmpeg('probe', '-i', path)
+        match = re.search(r'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)', stderr)
+        streams = re.findall(r'Stream #\S+.*?: (Video|Audio):(?! mjpeg| png)', stderr)
+        return {
+            'duration': int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3)) if match else None,
+            'video': 'Video' in streams,
+            'audio': 'Audio' in streams,
+        }
+
+    async def encode(self, path: str, output: str, duration: float, max_size: int, video: bool,
+                     preset: str = TRANSCODE_PRESET) -> str:
+        """Re-encodes `path` to an average bitrate that fits `duration` into max_size."""
+        budget = max_size * TRANSCODE_SIZE_MARGIN * 8 / duration  # bits/s for all streams
+        for _ in range(2):
+            if video:
+                bitrate = int(budget - TRANSCODE_AUDIO_BITRATE)
+                # maxrate/bufsize keep one-pass rate control from overshooting the budget.
+                args = ['-map', '0:v:0', '-map', '0:a:0?',
+                        '-c:v', 'libx264', '-preset', preset, '-pix_fmt', 'yuv420p',
+                        '-b:v', str(bitrate), '-maxrate', str(bitrate), '-bufsize', str(bitrate * 2),
+                        '-vf', f"scale=-2:'min({_video_height_for(bitrate)},ih)'",
+                        '-c:a', 'aac', '-b:a', str(TRANSCODE_AUDIO_BITRATE), '-ac', '2', '-movflags', '+faststart']
+            else:
+                args = ['-vn', '-c:a', 'aac', '-b:a', str(int(min(budget, 2 * TRANSCODE_AUDIO_BITRATE)))]
+            await self._run('encode', '-y', '-i', path, *args, output)
+            size = os.path.getsize(output)
+            if size <= max_size:
+                return output
+            logger.warning(f"Encode of {path} overshot ({size / (1024*1024):.2f} MB), retrying at a lower bitrate.")
+            budget *= max_size / size * TRANSCODE_SIZE_MARGIN
+        raise TranscodeError(f"could not encode {path} under {max_size} bytes")
+
+    async def split(self, path: str, stem: str, work_dir: str, duration: float, max_size: int) -> list:
+        """Cuts `path` into numbered parts by stream copy; a part that still ends up too large
+        (cuts land on keyframes) is re-encoded on its own."""
+        size = os.path.getsize(path)
+        count = math.ceil(size / (max_size * TRANSCODE_SIZE_MARGIN))
+        if count > TRANSCODE_MAX_PARTS:
+            raise TranscodeError(f"{path} would need {count} parts (limit {TRANSCODE_MAX_PARTS})")
+        ext = os.path.splitext(path)[1] or '.mp4'
+        length = duration / count
+        parts = []
+        for index in range(count):
+            part = os.path.join(work_dir, f"{stem}.part{index + 1}of{count}{ext}")
+            await self._run('split', '-y', '-ss', f'{index * length:.3f}', '-i', path, '-t', f'{length:.3f}',
+                            '-map', '0', '-c', 'copy', '-avoid_negative_ts', 'make_zero', part)
+            if os.path.getsize(part) > max_size:
+                probe = await self.probe(part)
+                encoded = os.path.join(work_dir, f"{stem}.part{index + 1}of{count}.enc{'.mp4' if probe['video'] else '.m4a'}")
+                part = await self.encode(part, encoded, probe['duration'] or length, max_size, probe['video'])
+            parts.append(part)
+        return parts
+
+    async def fit(self, path: str, work_dir: str, max_size: int = MAX_UPLOAD_SIZE) -> list:
+        """Returns the file(s) to send instead of `path`, each at most max_size bytes."""
+        size = os.path.getsize(path)
+        if size <= max_size:
+            return [path]
+        probe = await self.probe(path)
+        duration = probe['duration']
+        if not duration or not (probe['video'] or probe['audio']):
+            raise TranscodeError(f"{path} is not media ffmpeg can read")
+        stem = os.path.splitext(os.path.basename(path))[0]
+        budget = max_size * TRANSCODE_SIZE_MARGIN * 8 / duration
+        if probe['video'] and budget - TRANSCODE_AUDIO_BITRATE >= TRANSCODE_MIN_VIDEO_BITRATE:
+            output = await self.encode(path, os.path.join(work_dir, f"{stem}.small.mp4"), duration, max_size, True)
+        elif not probe['video'] and budget >= TRANSCODE_MIN_AUDIO_BITRATE:
+            output = await self.encode(path, os.path.join(work_dir, f"{stem}.small.m4a"), duration, max_size, False)
+        else:
+            parts = await self.split(path, stem, work_dir, duration, max_size)
+            logger.info(f"Split {path} ({size / (1024*1024):.2f} MB, {duration:.0f}s) into {len(parts)} parts.")
+            return parts
+        logger.info(f"Transcoded {path} from {size / (1024*1024):.2f} MB to {os.path.getsize(output) / (1024*1024):.2f} MB.")
+        return [output]
+
+    def stats(self) -> dict:
+        return {
+            'available': int(transcoding_available()),
+            'concurrency': self.concurrency,
+            'waiting': self.waiting,
+            'failures': self.failures,
+            **{f'{op}_runs': count for op, count in self.runs.items()},
+        }
+
+transcoder = MediaTranscoder(TRANSCODE_CONCURRENCY)
+
+async def send_media_parts(bot: telegram.Bot, chat_id: int, paths: list, caption: str, audio_only: bool = False):
+    """Uploads each file in `paths`, numbering the captions when there are several; returns the last message."""
+    sent_message = None
+    for number, path in enumerate(paths, 1):
+        part_caption = f"{caption} ({number}/{len(paths)})" if len(paths) > 1 else caption
+        size = os.path.getsize(path)
+        with open(path, 'rb') as media_file, metrics.timer('telegram', 'upload'):
+            if audio_only:
+                sent_message = await bot.send_audio(chat_id=chat_id, audio=media_file, caption=part_caption)
+            else:
+                sent_message = await bot.send_document(chat_id=chat_id, document=media_file, caption=part_caption)
+        metrics.add_bytes('telegram', 'upload', 'sent', size)
+    return sent_message
+
+# --- External URL Download Function ---
+class DownloadTooLarge(Exception):
+    pass
+
+def _filename_from_response(url: str, response: httpx.Response) -> str:
+    filename = None
+    if "Content-Disposition" in response.headers:
+        filename = response.headers["Content-Disposition"].split("filename=")[-1].strip('"\'')
+    if not filename:
+        filename = os.path.basename(url.split('?')[0])
+        if not filename:
+            filename = "downloaded_file"
+    return filename
+
+def _chunk_size_for(total_size: int) -> int:
+    # ~100 reads per file, clamped: small files finish in a few reads, big ones avoid per-chunk overhead.
+    if not total_size:
+        return 256 * 1024
+    return max(DOWNLOAD_MIN_CHUNK_SIZE, min(DOWNLOAD_MAX_CHUNK_SIZE, total_size // 100))
+
+class DownloadIntegrityError(Exception):
+    """The origin sent something other than the bytes it promised (changed file, bad range, checksum)."""
+
+class DownloadProgress:
+    """Byte counter shared by the ranges of one download; updates the status message now and then."""
+
+    def __init__(self, status: StatusMessage, total_size: int):
+        self.status = status
+        self.total_size = total_size
+        self.downloaded = 0
+        self.last_edit = time.monotonic()
+
+    async def add(self, size: int) -> None:
+        self.downloaded += size
+        if time.monotonic() - self.last_edit < DOWNLOAD_PROGRESS_INTERVAL:
+            return
+        self.last_edit = time.monotonic()
+        if self.total_size:
+            progress = f'{self.downloaded / self.total_size:.0%}'
+        else:
+            progress = f'{self.downloaded / (1024*1024):.1f} MB'
+        self.status.set(f'File එක download කරමින් සිටී... {progress}')
+
+class RangeFile:
+    """Fixed-size download target on disk that ranges fill out of order. The MD5 of the file is taken
+    as the filled prefix grows: bytes written at the front are hashed as they arrive, and later ranges
+    are read back in chunks once the prefix reaches them."""
+
+    def __init__(self, path: str, size: int):
+        self.size = size
+        self.file = open(path, 'w+b')
+        self.file.truncate(size)
+        self.digest = hashlib.md5()
+        self.hashed = 0
+        self.filled = {}  # range start -> end of the bytes written so far from it
+        self.hash_lock = asyncio.Lock()
+
+    async def write(self, start: int, offset: int, chunk: bytes) -> None:
+        await asyncio.to_thread(os.pwrite, self.file.fileno(), chunk, offset)
+        self.filled[start] = offset + len(chunk)
+        async with self.hash_lock:
+            if offset == self.hashed:
+                self.digest.update(chunk)
+                self.hashed += len(chunk)
+            await self._hash_filled()
+
+    async def _hash_filled(self) -> None:
+        while self.hashed < self.size:
+            start = max((start for start in self.filled if start <= self.hashed), default=None)
+            if start is None or self.filled[start] <= self.hashed:
+                return
+            size = min(DOWNLOAD_MAX_CHUNK_SIZE, self.filled[start] - self.hashed)
+            chunk = await asyncio.to_thread(os.pread, self.file.fileno(), size, self.hashed)
+            self.digest.update(chunk)
+            self.hashed += len(chunk)
+
+    def md5(self) -> str:
+        """Base64 MD5 of the whole file, once every range is written."""
+        if self.hashed != self.size:
+            raise DownloadIntegrityError(f'hashed {self.hashed} of {self.size} bytes')
+        return base64.b64encode(self.digest.digest()).decode()
+
+    def close(self) -> None:
+        self.file.close()
+
+def _content_range(response: httpx.Response):
+    """Parses `Content-Range: bytes start-end/total` into (start, total); total is None when unknown."""
+    match = re.fullmatch(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('content-range', '').strip())
+    if not match:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), (int(total) if total != '*' else None)
+
+def _expected_md5(response: httpx.Response):
+    """Whole-file MD5 (base64) advertised by the origin, if any."""
+    # GCS sends the object's hash on range responses too; Content-MD5 only describes a full body.
+    for part in response.headers.get('x-goog-hash', '').split(','):
+        name, _, value = part.strip().partition('=')
+        if name == 'md5' and value:
+            return value + '=' * (-len(value) % 4)
+    if response.status_code == 200:
+        return response.headers.get('content-md5')
+    return None
+
+async def _download_range(url: str, validator: dict, sink: RangeFile, start: int, end: int,
+                          total_size: int, progress: DownloadProgress, response: httpx.Response = None) -> None:
+    """Fills sink[start:end+1], resuming from the last byte received when the connection drops.
+
+    `response` is an already-open response whose body starts at `start` (the probe); later attempts
+    ask for the remainder with If-Range, so a file that changed meanwhile fails instead of being mixed.
+    """
+    client = get_http_client()
+    offset = start
+    failures = 0
+    while offset <= end:
+        try:
+            if response is None:
+                request = client.build_request('GET', url, headers={**validator, 'Range': f'bytes={offset}-{end}'}, timeout=30)
+                response = await client.send(request, stream=True, follow_redirects=True)
+            try:
+                response.raise_for_status()
+                range_start, range_total = _content_range(response)
+                if response.status_code != 206 or range_start != offset or range_total not in (None, total_size):
+                    raise DownloadIntegrityError(f'origin answered bytes={offset}-{end} with {response.status_code} {response.headers.get("content-range")}')
+                async for chunk in response.aiter_bytes(_chunk_size_for(end + 1 - start)):
+                    chunk = chunk[:end + 1 - offset]
+                    await sink.write(start, offset, chunk)
+                    offset += len(chunk)
+                    await progress.add(len(chunk))
+                    if offset > end:
+                        break
+            finally:
+                await response.aclose()
+                response = None
+            if offset <= end:
+                raise httpx.ReadError(f'connection closed at byte {offset} of range {start}-{end}')
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            failures += 1
+            metrics.errors[('http', 'download_range')] += 1
+            retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in HTTP_RETRYABLE_STATUS_CODES
+            if not retryable or failures > DOWNLOAD_RANGE_RETRIES:
+                raise
+            logger.warning(f"Range {start}-{end} of {url} failed at byte {offset} ({e}); resuming.")
+            await asyncio.sleep(_retry_delay(failures))
+
+async def download_ranges(url: str, probe: httpx.Response, total_size: int, progress: DownloadProgress, path: str) -> str:
+    """Downloads a Range-capable file to `path` over up to DOWNLOAD_PARALLEL_CONNECTIONS connections
+    and returns its MD5 (base64).
+
+    The probe response (a `Range: bytes=0-` request) is reused for the first range, so a file
+    small enough for one connection costs no extra request.
+    """
+    etag = probe.headers.get('etag')
+    validator = probe.headers.get('last-modified') if not etag or etag.startswith('W/') else etag
+    validator = {'If-Range': validator} if validator else {}
+
+    connections = DOWNLOAD_PARALLEL_CONNECTIONS if total_size >= DOWNLOAD_PARALLEL_MIN_SIZE else 1
+    part_size = -(-total_size // max(1, connections))
+    bounds = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+
+    sink = RangeFile(path, total_size)
+    tasks = [
+        asyncio.create_task(_download_range(url, validator, sink, start, end, total_size, progress, probe if i == 0 else None))
+        for i, (start, end) in enumerate(bounds)
+    ]
     try:
-        response = await asyncio.to_thread(gemini_model.generate_content, query)
-        return response.text
-    except Exception as e:
-        logger.error(f"Error calling Gemini AI: {e}")
-        return "AI ප්‍රතිචාරයක් ලබාගැනීමේ දෝෂයක් සිදුවිය. කරුණාකර පසුව උත්සාහ කරන්න."
+        await asyncio.gather(*tasks)
+        if progress.downloaded != total_size:
+            raise DownloadIntegrityError(f'received {progress.downloaded} of {total_size} bytes')
+        return sink.md5()
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        sink.close()
+
+async def _stream_body(response: httpx.Response, target, total_size: int, size_limit: int,
+                       progress: DownloadProgress, in_memory_up_to: int = 0) -> str:
+    """Writes an unranged response body to `target` and returns its MD5 (base64). Writes past the first
+    `in_memory_up_to` bytes run in a worker thread, as they go to disk."""
+    digest = hashlib.md5()
+    async for chunk in response.aiter_bytes(_chunk_size_for(total_size)):
+        end = progress.downloaded + len(chunk)
+        # Enforced while streaming: content-length may be missing or wrong.
+        if end > size_limit:
+            raise DownloadTooLarge(end)
+        if end > in_memory_up_to:
+            await asyncio.to_thread(target.write, chunk)
+        else:
+            target.write(chunk)
+        digest.update(chunk)
+        await progress.add(len(chunk))
+    if total_size and progress.downloaded != total_size:
+        raise DownloadIntegrityError(f'received {progress.downloaded} of {total_size} bytes')
+    return base64.b64encode(digest.digest()).decode()
 
-# --- External URL Download Function ---
 async def download_file_from_url(url: str, chat_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await context.bot.send_message(chat_id=chat_id, text='File එක download කරමින් සිටී. කරුණාකර මොහොතක් රැඳී සිටින්න...')
+    cache_key = f"url:{normalize_url(url)}"
+    status = StatusMessage(context.bot, chat_id)
+    if await send_cached_download(context.bot, chat_id, cache_key):
+        await status.finish('✅ **File එක සාර්ථකව යවන ලදී!**', quiet=True)
+        return
+
+    status.set('File එක download කරමින් සිටී. කරුණාකර මොහොතක් රැඳී සිටින්න...')
     logger.info(f"Attempting to download file from URL: {url}")
 
-    temp_dir = tempfile.mkdtemp()
+    client = get_http_client()
+    # Ranged downloads are resumable, so they are written to a file in a work dir, as is media that
+    # ffmpeg may have to read back. Anything else is spooled in memory up to DOWNLOAD_SPOOL_MAX_MEMORY,
+    # which keeps most downloads off the disk.
+    work_dir = None
+    spool = None
     try:
-        response = requests.get(url, stream=True, timeout=30)
-        response.raise_for_status()
+        # A 206 answer shows the origin honours ranges, and Content-Range carries the full size.
+        request = client.build_request('GET', url, headers={'Range': 'bytes=0-'}, timeout=30)
+        response = await client.send(request, stream=True, follow_redirects=True)
+        try:
+            response.raise_for_status()
+            filename = _filename_from_response(url, response)
+            expected_md5 = _expected_md5(response)
+            range_start, total_size = _content_range(response)
+            if response.status_code != 206 or range_start != 0:
+                total_size = int(response.headers.get('content-length', 0))
+            # Oversized media can still be transcoded or split to fit, so more of it is accepted.
+            transcode = transcoding_available() and is_media_file(filename, response.headers.get('content-type'))
+            size_limit = max(MAX_UPLOAD_SIZE, TRANSCODE_MAX_INPUT_SIZE) if transcode else MAX_UPLOAD_SIZE
+            if total_size > size_limit:
+                raise DownloadTooLarge(total_size)
+            progress = DownloadProgress(status, total_size)
+            ranged = response.status_code == 206 and range_start == 0 and total_size
+            path = None
+            if ranged or transcode:
+                work_dir = tempfile.mkdtemp()
+                local_name = os.path.basename(filename)
+                path = os.path.join(work_dir, local_name if local_name not in ('', '.', '..') else 'downloaded_file')
 
-        filename = None
-        if "Content-Disposition" in response.headers:
-            filename = response.headers["Content-Disposition"].split("filename=")[-1].strip('"\'')
-        if not filename:
-            filename = os.path.basename(url.split('?')[0])
-            if not filename:
-                filename = "downloaded_file"
+            if ranged:
+                md5 = await download_ranges(url, response, total_size, progress, path)
+            elif path is not None:
+                with open(path, 'wb') as target:
+                    md5 = await _stream_body(response, target, total_size, size_limit, progress)
+            else:
+                spool = tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_MAX_MEMORY)
+                md5 = await _stream_body(response, spool, total_size, size_limit, progress, DOWNLOAD_SPOOL_MAX_MEMORY)
+            downloaded = progress.downloaded
+        finally:
+            await response.aclose()
+        if expected_md5 and md5 != expected_md5:
+            raise DownloadIntegrityError('MD5 checksum mismatch')
 
-        file_path = os.path.join(temp_dir, filename)
-        
-        total_size = int(response.headers.get('content-length', 0))
-        if total_size > 50 * 1024 * 1024:
-            await context.bot.send_message(chat_id=chat_id, text=f'File එක ({total_size / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම යැවීමට විශාල වැඩියි. කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.')
-            logger.warning(f"File too large for direct Telegram upload: {url} ({total_size / (1024*1024):.2f} MB)")
-            return
+        metrics.add_bytes('http', 'download', 'received', downloaded)
+        logger.info(f"Downloaded file: {filename}, Size: {downloaded / (1024*1024):.2f} MB")
 
-        with open(file_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        
-        file_size = os.path.getsize(file_path)
-        logger.info(f"Downloaded file: {file_path}, Size: {file_size / (1024*1024):.2f} MB")
-
-        await context.bot.send_message(chat_id=chat_id, text='File එක යවමින් සිටී...')
-        with open(file_path, 'rb') as downloaded_file:
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=downloaded_file,
-                filename=filename,
-                caption=f"ඔබගේ file එක: {filename}"
-            )
-        await context.bot.send_message(chat_id=chat_id, text='✅ **File එක සාර්ථකව යවන ලදී!**')
+        caption = f"ඔබගේ file එක: {filename}"
+        if downloaded > MAX_UPLOAD_SIZE:
+            status.set('File එක Telegram සඳහා කුඩා කරමින් සිටී...')
+            paths = await transcoder.fit(path, work_dir)
+            status.set('File එක යවමින් සිටී...')
+            sent_message = await send_media_parts(context.bot, chat_id, paths, caption)
+            if len(paths) == 1:
+                await download_cache.put(cache_key, sent_file(sent_message), caption)
+        else:
+            status.set('File එක යවමින් සිටී...')
+            with contextlib.ExitStack() as stack:
+                if spool is not None:
+                    spool.seek(0)
+                    # PTB reads the whole upload either way, and can't take a spool that is still in
+                    # memory (its `name` is None).
+                    document = await asyncio.to_thread(spool.read)
+                else:
+                    document = stack.enter_context(open(path, 'rb'))
+                with metrics.timer('telegram', 'upload'):
+                    sent_message = await context.bot.send_document(
+                        chat_id=chat_id,
+                        document=document,
+                        filename=filename,
+                        caption=caption
+                    )
+            metrics.add_bytes('telegram', 'upload', 'sent', downloaded)
+            await download_cache.put(cache_key, sent_file(sent_message), caption)
+        await status.finish('✅ **File එක සාර්ථකව යවන ලදී!**', quiet=True)
 
-    except requests.exceptions.RequestException as e:
+    except DownloadTooLarge as e:
+        size = e.args[0]
+        await status.finish(f'File එක ({size / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම යැවීමට විශාල වැඩියි. කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.')
+        logger.warning(f"File too large for direct Telegram upload: {url} ({size / (1024*1024):.2f} MB)")
+    except TranscodeError as e:
+        logger.error(f"Could not bring {url} under the upload limit: {e}")
+        await status.finish('File එක Telegram හරහා කෙලින්ම යැවීමට විශාල වැඩියි, එය කුඩා කිරීමටද නොහැකි විය. කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.')
+    except DownloadIntegrityError as e:
+        logger.error(f"Integrity check failed for {url}: {e}")
+        await status.finish('❌ Download කළ file එක අසම්පූර්ණයි හෝ වෙනස් වී ඇත. කරුණාකර නැවත උත්සාහ කරන්න.')
+    except httpx.HTTPError as e:
         logger.error(f"Error downloading file from URL {url}: {e}")
-        await context.bot.send_message(chat_id=chat_id, text=f'❌ File එක download කිරීමේ දෝෂයක් සිදුවිය: {e}. කරුණාකර URL එක නිවැරදිදැයි පරීක්ෂා කරන්න.')
+        await status.finish(f'❌ File එක download කිරීමේ දෝෂයක් සිදුවිය: {e}. කරුණාකර URL එක නිවැරදිදැයි පරීක්ෂා කරන්න.')
     except Exception as e:
         logger.error(f"An unexpected error occurred during URL download: {e}")
-        await context.bot.send_message(chat_id=chat_id, text=f'❌ අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+        await status.finish(f'❌ අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
     finally:
-        if os.path.exists(temp_dir):
-            import shutil
-            shutil.rmtree(temp_dir)
-            logger.info(f"Cleaned up temporary directory: {temp_dir}")
+        if spool is not None:
+            spool.close()
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+# --- Resource Governor ---
+# Bounds heavy work (downloads, AI answers, WhatsApp sends) per instance: token buckets per user
+# and per chat, a cap on each user's active jobs, and a fair queue per job class. Whatever doesn't
+# fit is shed with a message instead of piling up threads, temp disk and bandwidth.
+class GovernorRejected(Exception):
+    """Raised when a request is shed; the message is meant for the user."""
+
+class FairSemaphore:
+    """Semaphore whose waiters are served round-robin across users and FIFO within a user."""
+
+    def __init__(self, limit: int, max_waiting: int):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiters = OrderedDict()  # user_id -> deque of futures
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.waiters.values())
+
+    async def acquire(self, user_id: int, on_queued=None) -> None:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        if self.waiting >= self.max_waiting:
+            raise GovernorRejected('Bot එක දැනට ඉතා කාර්යබහුලයි. කරුණාකර මිනිත්තු කිහිපයකින් නැවත උත්සාහ කරන්න.')
+        future = asyncio.get_running_loop().create_future()
+        queue = self.waiters.setdefault(user_id, deque())
+        queue.append(future)
+        # Round-robin: every other user's first len(queue) waiters are served before this one.
+        position = len(queue) + sum(min(len(other), len(queue)) for uid, other in self.waiters.items() if uid != user_id)
+        try:
+            if on_queued:
+                await on_queued(position)
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over just as we gave up
+            else:
+                future.cancel()
+                queue = self.waiters.get(user_id)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self.waiters[user_id]
+            raise
+
+    def release(self) -> None:
+        while self.waiters:
+            user_id, queue = next(iter(self.waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(user_id)
+            else:
+                del self.waiters[user_id]
+            if not future.done():
+                future.set_result(None)  # hand the slot over; `active` stays the same
+                return
+        self.active -= 1
+
+class SharedLeases:
+    """Concurrency limits for serverless instances, which share no memory: a Firestore document per job
+    class and per user maps the ids of the leases held to when they expire. A lease is taken by rewriting
+    both documents with preconditions on what was read, so two instances can't both take the last slot,
+    and given back by deleting it from both; one whose instance died expires after GOVERNOR_LEASE_SECONDS."""
+
+    ATTEMPTS = 5
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def _refs(self, job_class: str, user_id: int) -> list:
+        return [self.collection.document(f'class_{job_class}'), self.collection.document(f'user_{user_id}')]
+
+    def _acquire(self, job_class: str, user_id: int, class_limit: int, user_limit: int) -> tuple:
+        from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+        db = get_firestore()
+        refs = self._refs(job_class, user_id)
+        for _ in range(self.ATTEMPTS):
+            snapshots = {snapshot.id: snapshot for snapshot in db.get_all(refs)}
+            now = time.time()
+            held = []
+            for ref in refs:
+                leases = (snapshots[ref.id].to_dict() or {}).get('leases', {})
+                held.append({lease_id: expires_at for lease_id, expires_at in leases.items() if expires_at > now})
+            if len(held[0]) >= class_limit:
+                return None, ('class', len(held[0]))
+            if len(held[1]) >= user_limit:
+                return None, ('user', len(held[1]))
+            lease_id = f'lease_{generate_pin(12)}'
+            batch = db.batch()
+            for ref, leases in zip(refs, held):
+                # Rewriting the whole map drops the expired leases along the way.
+                leases[lease_id] = now + GOVERNOR_LEASE_SECONDS
+                snapshot = snapshots[ref.id]
+                if snapshot.exists:
+                    batch.update(ref, {'leases': leases}, option=db.write_option(last_update_time=snapshot.update_time))
+                else:
+                    batch.create(ref, {'leases': leases})
+            try:
+                batch.commit()
+                return lease_id, None
+            except (AlreadyExists, FailedPrecondition):
+                continue  # another instance took or gave back a lease in between
+        return None, ('class', class_limit)
+
+    def _release(self, job_class: str, user_id: int, lease_id: str) -> None:
+        from firebase_admin import firestore
+        batch = get_firestore().batch()
+        for ref in self._refs(job_class, user_id):
+            batch.update(ref, {f'leases.{lease_id}': firestore.DELETE_FIELD})
+        batch.commit()
+
+    async def acquire(self, job_class: str, user_id: int, class_limit: int, user_limit: int) -> tuple:
+        """Returns (lease_id, None), or (None, (kind, held)) when the 'class' or the 'user' is at its limit."""
+        return await external_call('firestore', 'governor_acquire', self._acquire, job_class, user_id, class_limit, user_limit)
+
+    async def release(self, job_class: str, user_id: int, lease_id: str) -> None:
+        try:
+            await external_call('firestore', 'governor_release', self._release, job_class, user_id, lease_id)
+        except Exception as e:
+            logger.warning(f"Could not release governor lease {lease_id}, it expires on its own: {e}")
+
+class ResourceGovernor:
+    """Per-user and per-chat rate limits plus per-class and per-user concurrency limits.
+
+    Under the ASGI server (see `app`) each worker process runs every update on one long-lived event loop,
+    and the concurrency limits are held there by FairSemaphores that queue fairly. Serverless instances
+    share no memory and may get a new loop per invocation, so there the limits are held by SharedLeases
+    in Firestore across every instance, and a full class sheds rather than keeping an invocation waiting.
+    The rate-limit buckets are per process in both cases.
+    """
+
+    def __init__(self):
+        self.user_buckets = LRUCache(10000, 3600)
+        self.chat_buckets = LRUCache(10000, 3600)
+        self.active_per_user = Counter()
+        self.semaphores = {}
+        self.loop = None
+        self._leases = None
+        self.shed = Counter()
+
+    def _bucket(self, buckets: LRUCache, key: int, per_minute: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(per_minute / 60, burst)
+        buckets.set(key, bucket)
+        return bucket
+
+    def admit(self, user_id: int, chat_id: int) -> None:
+        """Charges one request to the user's and the chat's token buckets, or raises GovernorRejected."""
+        user_bucket = self._bucket(self.user_buckets, user_id, GOVERNOR_USER_RATE_PER_MINUTE, GOVERNOR_USER_BURST)
+        chat_bucket = self._bucket(self.chat_buckets, chat_id, GOVERNOR_CHAT_RATE_PER_MINUTE, GOVERNOR_CHAT_BURST)
+        if user_bucket.wait_time() > 0:
+            self.shed['user_rate'] += 1
+            raise GovernorRejected(f'ඔබ ඉතා ඉක්මනින් ඉල්ලීම් යවයි. කරුණාකර තත්පර {math.ceil(user_bucket.wait_time())} කින් පසු නැවත උත්සාහ කරන්න.')
+        if chat_bucket.wait_time() > 0:
+            self.shed['chat_rate'] += 1
+            raise GovernorRejected(f'මෙම chat එකෙන් ඉල්ලීම් ඉතා වැඩියි. කරුණාකර තත්පර {math.ceil(chat_bucket.wait_time())} කින් පසු නැවත උත්සාහ කරන්න.')
+        user_bucket.try_acquire()
+        chat_bucket.try_acquire()
+
+    def _semaphore(self, job_class: str) -> FairSemaphore:
+        # Waiters are futures of the running loop; a new loop (a new Vercel invocation) starts afresh,
+        # which never happens under the ASGI server.
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.semaphores.clear()
+            self.active_per_user.clear()
+            self.loop = loop
+        if job_class not in self.semaphores:
+            self.semaphores[job_class] = FairSemaphore(GOVERNOR_CLASS_LIMITS.get(job_class, 4), GOVERNOR_MAX_WAITING)
+        return self.semaphores[job_class]
+
+    def _shared_leases(self):
+        """The Firestore leases holding the concurrency limits on serverless instances, or None under the
+        ASGI server or without Firestore, where the in-process semaphores hold them."""
+        if _long_lived_server:
+            return None
+        if self._leases is None:
+            collection = get_collection('governor')
+            if collection is not None:
+                self._leases = SharedLeases(collection)
+        return self._leases
+
+    @contextlib.asynccontextmanager
+    async def slot(self, job_class: str, update: Update):
+        """Admits the update's user into `job_class`: on serverless instances through a shared lease,
+        shedding when the class is full, otherwise queueing fairly and telling them their position."""
+        leases = self._shared_leases()
+        if leases is None:
+            async with self._local_slot(job_class, update):
+                yield
+            return
+        user_id = update.effective_user.id
+        self.admit(user_id, update.effective_chat.id)
+        try:
+            lease_id, limited = await leases.acquire(job_class, user_id, GOVERNOR_CLASS_LIMITS.get(job_class, 4),
+                                                     GOVERNOR_USER_MAX_ACTIVE)
+        except Exception as e:
+            logger.warning(f"Could not take a shared '{job_class}' lease, limiting this instance only: {e}")
+            async with self._local_slot(job_class, update, admitted=True):
+                yield
+            return
+        if limited is not None:
+            kind, held = limited
+            if kind == 'user':
+                self.shed['user_active'] += 1
+                raise GovernorRejected(f'ඔබගේ පෙර ඉල්ලීම් {held} ක් තවමත් ක්‍රියාත්මක වේ. ඒවා අවසන් වූ පසු නැවත උත්සාහ කරන්න.')
+            self.shed['class_busy'] += 1
+            raise GovernorRejected('Bot එක දැනට ඉතා කාර්යබහුලයි. කරුණාකර මිනිත්තු කිහිපයකින් නැවත උත්සාහ කරන්න.')
+        try:
+            yield
+        finally:
+            await leases.release(job_class, user_id, lease_id)
+
+    @contextlib.asynccontextmanager
+    async def _local_slot(self, job_class: str, update: Update, admitted: bool = False):
+        user_id, chat_id = update.effective_user.id, update.effective_chat.id
+        semaphore = self._semaphore(job_class)
+        if self.active_per_user[user_id] >= GOVERNOR_USER_MAX_ACTIVE:
+            self.shed['user_active'] += 1
+            raise GovernorRejected(f'ඔබගේ පෙර ඉල්ලීම් {self.active_per_user[user_id]} ක් තවමත් ක්‍රියාත්මක වේ. ඒවා අවසන් වූ පසු නැවත උත්සාහ කරන්න.')
+        if not admitted:
+            self.admit(user_id, chat_id)
+
+        async def on_queued(position: int) -> None:
+            await update.message.reply_text(f'ඔබගේ ඉල්ලීම පෝලිමේ {position} වන ස්ථානයේ ඇත. ඔබගේ වාරය පැමිණි විට එය ස්වයංක්‍රීයව ආරම්භ වේ.')
+
+        self.active_per_user[user_id] += 1
+        try:
+            try:
+                await semaphore.acquire(user_id, on_queued)
+            except GovernorRejected:
+                self.shed['queue_full'] += 1
+                raise
+            try:
+                yield
+            finally:
+                semaphore.release()
+        finally:
+            self.active_per_user[user_id] -= 1
+            if self.active_per_user[user_id] <= 0:
+                del self.active_per_user[user_id]
+
+    def stats(self) -> dict:
+        return {
+            'running': {name: sem.active for name, sem in self.semaphores.items()},
+            'waiting': {name: sem.waiting for name, sem in self.semaphores.items()},
+            'shed': dict(self.shed),
+        }
+
+governor = ResourceGovernor()
 
 # --- Bot Commands and State Handlers ---
 
@@ -196,11 +3120,14 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         'සහ files upload කර PIN එකකින් නැවත download කිරීමට උදව් කරන bot කෙනෙක්. \n\n'
         'Commands:\n'
         '/sendmsg - දුරකථන අංකයකට message එකක් යවන්න.\n'
+        '/broadcast - අංක රැසකට message එකක් යවන්න.\n'
         '/yt_download - YouTube video එකක් download කරන්න.\n'
+        '/yt_audio - YouTube video එකක audio එක පමණක් download කරන්න.\n'
         '/download_url - ඕනෑම URL එකකින් file එකක් download කරන්න.\n'
         '/upload_file - File එකක් upload කර PIN එකක් ලබාගන්න.\n'
         '/get_file - PIN එකක් දී file එකක් download කරන්න.\n'
         '/ask_ai - AI සමඟ කතා කරන්න.\n'
+        '/ai_chat - කලින් කතා කළ දේ මතක තබා ගන්නා AI chat එකක් ආරම්භ කරන්න.\n'
         '/cancel - ඕනෑම ක්‍රියාවලියක් අවලංගු කරන්න.'
     )
 
@@ -224,23 +3151,176 @@ async def get_sendmsg_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     message_text_input = update.message.text
     number = context.user_data.get('sendmsg_number')
 
-    logger.info(f"Received message text: {message_text_input}")
-    logger.info(f"Attempting to send message to {number}...")
+    logger.info(f"Attempting to send a {len(message_text_input or '')}-character message to {number}...")
 
     if number and message_text_input:
-        await update.message.reply_text('ඔබගේ message එක යවමින් සිටී...')
-        is_sent = await send_message_via_api(number, message_text_input)
+        try:
+            async with governor.slot('whatsapp', update):
+                status = StatusMessage(context.bot, update.message.chat_id)
+                status.set('ඔබගේ message එක යවමින් සිටී...')
+                is_sent = await send_message_via_api(number, message_text_input)
+        except GovernorRejected as e:
+            await update.message.reply_text(str(e))
+            return ConversationHandler.END
 
         if is_sent:
-            await update.message.reply_text('✅ **Message සාර්ථකව යවන ලදී!**')
+            await status.finish('✅ **Message සාර්ථකව යවන ලදී!**')
         else:
-            await update.message.reply_text('❌ **Message යැවීම අසාර්ථක විය.** කරුණාකර නැවත උත්සාහ කරන්න.')
+            await status.finish('❌ **Message යැවීම අසාර්ථක විය.** කරුණාකර නැවත උත්සාහ කරන්න.')
     else:
         await update.message.reply_text('අංකය හෝ message එක ලබාගැනීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත /sendmsg කරන්න.')
     return ConversationHandler.END
 
+# --- Broadcast Handlers ---
+def is_broadcast_allowed(user_id: int) -> bool:
+    return user_id in BROADCAST_ADMIN_IDS
+
+async def start_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if not is_broadcast_allowed(update.effective_user.id):
+        await update.message.reply_text('ඔබට broadcast යැවීමට අවසර නැත.')
+        return ConversationHandler.END
+    await update.message.reply_text(
+        'කරුණාකර message එක යැවීමට අවශ්‍ය **දුරකථන අංක ලැයිස්තුව** (පේළියකට එකක් හෝ comma වලින් වෙන් කර) '
+        'හෝ CSV file එකක් එවන්න.'
+    )
+    return BROADCAST_ASK_NUMBERS
+
+async def get_broadcast_numbers(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if update.message.document:
+        if update.message.document.file_size and update.message.document.file_size > 1024 * 1024:
+            await update.message.reply_text('CSV file එක විශාල වැඩියි (උපරිමය 1MB).')
+            return BROADCAST_ASK_NUMBERS
+        csv_file = await context.bot.get_file(update.message.document.file_id)
+        text = bytes(await csv_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+    else:
+        text = update.message.text
+
+    recipients = parse_broadcast_recipients(text)
+    if not recipients:
+        await update.message.reply_text('වලංගු දුරකථන අංක කිසිවක් හමු නොවීය. (උදා: 94712345678)')
+        return BROADCAST_ASK_NUMBERS
+    if len(recipients) > BROADCAST_MAX_RECIPIENTS:
+        await update.message.reply_text(f'එක් broadcast එකකට උපරිම අංක {BROADCAST_MAX_RECIPIENTS} කි.')
+        return BROADCAST_ASK_NUMBERS
+
+    context.user_data['broadcast_recipients'] = recipients
+    logger.info(f"Received {len(recipients)} broadcast recipients.")
+    await update.message.reply_text(
+        f'අංක {len(recipients)} ක් ලැබුණි. දැන් කරුණාකර **message template එක** ඇතුළත් කරන්න. '
+        '{number} සහ CSV column නම් (උදා: {name}) message එක තුළ භාවිතා කළ හැක.'
+    )
+    return BROADCAST_ASK_MESSAGE
+
+async def get_broadcast_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    recipients = context.user_data.pop('broadcast_recipients', None)
+    template = update.message.text
+    if not recipients or not template:
+        await update.message.reply_text('අංක හෝ message එක ලබාගැනීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත /broadcast කරන්න.')
+        return ConversationHandler.END
+
+    try:
+        job_id = await get_broadcast_store().create_job(update.effective_user.id, template, recipients)
+    except Exception as e:
+        logger.error(f"Failed to enqueue broadcast: {e}")
+        await update.message.reply_text('❌ Broadcast එක queue කිරීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+        return ConversationHandler.END
+
+    status_message = await update.message.reply_text(
+        f'Broadcast `{job_id}` queue කරන ලදී. ප්‍රගතිය බැලීමට /broadcast_status {job_id} භාවිතා කරන්න.')
+    try:
+        await get_job_queue().enqueue('broadcast', {'broadcast_id': job_id, 'chat_id': update.effective_chat.id,
+                                                    'message_id': status_message.message_id})
+    except Exception as e:
+        logger.error(f"Failed to queue delivery of broadcast {job_id}: {e}")
+        await update.message.reply_text('❌ Broadcast එක queue කිරීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+        return ConversationHandler.END
+    logger.info(f"Broadcast {job_id} enqueued with {len(recipients)} recipients.")
+    return ConversationHandler.END
+
+async def broadcast_status_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Reports a broadcast's progress; the sending is done by drain_broadcast_jobs or the broadcast worker."""
+    if not context.args:
+        await update.message.reply_text('භාවිතය: /broadcast_status <job_id>')
+        return
+    job_id = context.args[0]
+    job = await get_broadcast_store().get_job(job_id)
+    user_id = update.effective_user.id
+    if not job or (job['owner_id'] != user_id and user_id not in BROADCAST_ADMIN_IDS):
+        await update.message.reply_text('❌ එවැනි broadcast එකක් හමු නොවීය.')
+        return
+    await update.message.reply_text(format_broadcast_progress(job))
+
+# --- YouTube Format Probe ---
+# extract_info(download=False) results are cached per video ID, so picking a format that
+# fits under MAX_UPLOAD_SIZE costs one probe and oversized videos are rejected before downloading.
+_yt_probe_cache = LRUCache(YT_PROBE_CACHE_MAX_ENTRIES, YT_PROBE_CACHE_TTL)
+
+def youtube_cache_key(yt_url: str, audio_only: bool = False):
+    video_id = youtube_video_id(yt_url)
+    return f"yt:{video_id}:{'audio' if audio_only else 'video'}" if video_id else None
+
+async def probe_youtube_video(yt_url: str) -> dict:
+    video_id = youtube_video_id(yt_url)
+    info_dict = _yt_probe_cache.get(video_id) if video_id else None
+    if info_dict is None:
+        import yt_dlp
+        with yt_dlp.YoutubeDL({'noplaylist': True, 'quiet': True, 'no_warnings': True}) as ydl:
+            info_dict = await external_call('ytdlp', 'extract_info', ydl.extract_info, yt_url, download=False)
+        if video_id:
+            _yt_probe_cache.set(video_id, info_dict)
+    return copy.deepcopy(info_dict)
+
+def _estimated_size(fmt: dict, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return int(size) if size else None
+
+def select_youtube_format(info_dict: dict, audio_only: bool = False, max_size: int = MAX_UPLOAD_SIZE):
+    """Picks the best format under max_size and returns {'format', 'size'}.
+
+    'format' is None when no candidate fits ('size' is then the smallest estimate). When no sizes are
+    known at all, the fixed format string is returned with 'size' None and max_filesize guards the download.
+    """
+    duration = info_dict.get('duration')
+    formats = [f for f in info_dict.get('formats') or [] if f.get('format_id')]
+    audio = [(f, _estimated_size(f, duration)) for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    audio = [(f, size) for f, size in audio if size]
+
+    candidates = []  # (rank, size, format selector)
+    if audio_only:
+        for f, size in audio:
+            candidates.append(((f.get('ext') == 'm4a', f.get('abr') or 0), size, f['format_id']))
+    else:
+        best_m4a = max((pair for pair in audio if pair[0].get('ext') == 'm4a'), key=lambda pair: pair[0].get('abr') or 0, default=None)
+        for f in formats:
+            height = f.get('height') or 0
+            size = _estimated_size(f, duration)
+            if f.get('vcodec') in (None, 'none') or height > YT_MAX_HEIGHT or f.get('ext') != 'mp4' or not size:
+                continue
+            if f.get('acodec') not in (None, 'none'):
+                candidates.append(((height, 0), size, f['format_id']))
+            elif best_m4a:
+                candidates.append(((height, 1), size + best_m4a[1], f"{f['format_id']}+{best_m4a[0]['format_id']}"))
+
+    if not candidates:
+        return {'format': YT_AUDIO_FORMAT if audio_only else YT_DOWNLOAD_FORMAT, 'size': None}
+    fitting = [c for c in candidates if c[1] <= max_size]
+    if not fitting:
+        return {'format': None, 'size': min(c[1] for c in candidates)}
+    rank, size, selector = max(fitting, key=lambda c: (c[0], c[1]))
+    return {'format': selector, 'size': size}
+
 # --- YouTube Downloader Handlers ---
+async def start_yt_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data['yt_audio_only'] = True
+    await update.message.reply_text(
+        'කරුණාකර ඔබට audio එක පමණක් download කිරීමට අවශ්‍ය YouTube video එකේ **URL එක** ඇතුළත් කරන්න.'
+    )
+    return YT_ASK_URL
+
 async def start_yt_download(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    context.user_data.pop('yt_audio_only', None)
     await update.message.reply_text(
         'කරුණාකර ඔබට download කිරීමට අවශ්‍ය YouTube video එකේ **URL එක** ඇතුළත් කරන්න.'
     )
@@ -254,17 +3334,48 @@ async def get_yt_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text('කරුණාකර වලංගු YouTube URL එකක් ඇතුළත් කරන්න.')
         return YT_ASK_URL
 
-    await update.message.reply_text('ඔබගේ video එක download කරමින් සිටී. කරුණාකර මොහොතක් රැඳී සිටින්න...')
+    audio_only = context.user_data.pop('yt_audio_only', False)
+    cache_key = youtube_cache_key(yt_url, audio_only)
+    if cache_key and await send_cached_download(context.bot, chat_id, cache_key):
+        return ConversationHandler.END
+
+    if YT_JOB_QUEUE:
+        try:
+            # The worker bounds download concurrency; only the request rate is governed here.
+            governor.admit(update.effective_user.id, chat_id)
+            job_id = await get_job_queue().enqueue('yt_download', {'url': yt_url, 'chat_id': chat_id, 'audio_only': audio_only})
+        except GovernorRejected as e:
+            await update.message.reply_text(str(e))
+            return ConversationHandler.END
+        except Exception as e:
+            logger.error(f"Failed to enqueue YouTube job: {e}")
+            await update.message.reply_text('❌ අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+            return ConversationHandler.END
+        logger.info(f"YouTube job {job_id} queued for: {yt_url}")
+        await update.message.reply_text('ඔබගේ video එක download queue එකට එක් කරන ලදී. සූදානම් වූ විට එය එවනු ලැබේ.')
+    else:
+        try:
+            async with governor.slot('youtube', update):
+                await download_youtube_video(yt_url, chat_id, context.bot, cache_key, audio_only)
+        except GovernorRejected as e:
+            await update.message.reply_text(str(e))
+    return ConversationHandler.END
+
+async def download_youtube_video(yt_url: str, chat_id: int, bot: telegram.Bot, cache_key: str = None, audio_only: bool = False) -> None:
+    import yt_dlp
+    status = StatusMessage(bot, chat_id)
+    status.set('ඔබගේ video එක download කරමින් සිටී. කරුණාකර මොහොතක් රැඳී සිටින්න...')
     logger.info(f"Attempting to download YouTube video from: {yt_url}")
 
     temp_dir = tempfile.mkdtemp()
     output_template = os.path.join(temp_dir, '%(title)s.%(ext)s')
+    # Oversized videos can still be transcoded or split to fit, so larger formats are accepted.
+    size_limit = max(MAX_UPLOAD_SIZE, TRANSCODE_MAX_INPUT_SIZE) if transcoding_available() else MAX_UPLOAD_SIZE
 
     ydl_opts = {
-        'format': 'best[height<=720][ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best',
         'outtmpl': output_template,
         'noplaylist': True,
-        'max_filesize': 50 * 1024 * 1024,
+        'max_filesize': size_limit,
         'merge_output_format': 'mp4',
         'progress_hooks': [lambda d: logger.info(d['status'])],
         'quiet': True,
@@ -272,42 +3383,154 @@ async def get_yt_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     }
 
     try:
+        info_dict = await probe_youtube_video(yt_url)
+        selection = select_youtube_format(info_dict, audio_only)
+        if selection['format'] is None and size_limit > MAX_UPLOAD_SIZE:
+            selection = select_youtube_format(info_dict, audio_only, size_limit)
+        if selection['format'] is None:
+            estimate = selection['size']
+            logger.warning(f"No format of {yt_url} fits under the upload limit (smallest ~{estimate / (1024*1024):.2f} MB).")
+            await status.finish(
+                f'ඔබගේ video එක (~{estimate / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම යැවීමට විශාල වැඩියි. '
+                'කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.'
+            )
+            return
+        logger.info(f"Selected format {selection['format']} (~{(selection['size'] or 0) / (1024*1024):.2f} MB) for {yt_url}")
+        ydl_opts['format'] = selection['format']
+
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = await asyncio.to_thread(ydl.extract_info, yt_url, download=True)
+            # Reuses the probed info instead of extracting it a second time.
+            info_dict = await external_call('ytdlp', 'download', ydl.process_ie_result, info_dict, download=True)
             file_path = ydl.prepare_filename(info_dict)
 
         if os.path.exists(file_path):
             file_size = os.path.getsize(file_path)
             logger.info(f"Downloaded file: {file_path}, Size: {file_size / (1024*1024):.2f} MB")
 
-            if file_size > 50 * 1024 * 1024:
-                await update.message.reply_text(
+            paths = [file_path]
+            if file_size > MAX_UPLOAD_SIZE and transcoding_available():
+                status.set('Video එක Telegram සඳහා කුඩා කරමින් සිටී...')
+                try:
+                    paths = await transcoder.fit(file_path, temp_dir)
+                except TranscodeError as e:
+                    logger.error(f"Could not bring {yt_url} under the upload limit: {e}")
+
+            if any(os.path.getsize(path) > MAX_UPLOAD_SIZE for path in paths):
+                await status.finish(
                     f'ඔබගේ video එක ({file_size / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම යැවීමට විශාල වැඩියි. '
-                    'කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.')
+                    'කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.'
+                )
             else:
-                await update.message.reply_text('Video එක යවමින් සිටී...')
-                with open(file_path, 'rb') as video_file:
-                    await context.bot.send_document(
-                        chat_id=chat_id,
-                        document=video_file,
-                        caption=f"ඔබගේ video එක: {info_dict.get('title', 'YouTube Video')}"
-                    )
-                await update.message.reply_text('✅ **Video එක සාර්ථකව යවන ලදී!**')
+                status.set('Video එක යවමින් සිටී...')
+                caption = f"ඔබගේ video එක: {info_dict.get('title', 'YouTube Video')}"
+                sent_message = await send_media_parts(bot, chat_id, paths, caption, audio_only)
+                if cache_key and len(paths) == 1:
+                    await download_cache.put(cache_key, sent_file(sent_message), caption)
+                await status.finish('✅ **Video එක සාර්ථකව යවන ලදී!**', quiet=True)
         else:
-            await update.message.reply_text('❌ Video එක download කිරීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+            await status.finish('❌ Video එක download කිරීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
 
     except yt_dlp.utils.DownloadError as e:
         logger.error(f"YouTube Download Error: {e}")
-        await update.message.reply_text(f'❌ Video එක download කිරීමේ දෝෂයක් සිදුවිය: {e}. කරුණාකර URL එක නිවැරදිදැයි පරීක්ෂා කරන්න.')
+        await status.finish(f'❌ Video එක download කිරීමේ දෝෂයක් සිදුවිය: {e}. කරුණාකර URL එක නිවැරදිදැයි පරීක්ෂා කරන්න.')
     except Exception as e:
         logger.error(f"An unexpected error occurred during YouTube download: {e}")
-        await update.message.reply_text(f'❌ අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+        await status.finish(f'❌ අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
     finally:
         if os.path.exists(temp_dir):
-            import shutil
             shutil.rmtree(temp_dir)
             logger.info(f"Cleaned up temporary directory: {temp_dir}")
-    return ConversationHandler.END
+
+# --- Job Workers ---
+async def process_yt_job(job: dict) -> None:
+    payload = job['payload']
+    audio_only = payload.get('audio_only', False)
+    cache_key = youtube_cache_key(payload['url'], audio_only)
+    bot = (await get_application()).bot
+    try:
+        if not (cache_key and await send_cached_download(bot, payload['chat_id'], cache_key)):
+            await download_youtube_video(payload['url'], payload['chat_id'], bot, cache_key, audio_only)
+        await get_job_queue().finish(job['id'], 'done')
+    except Exception as e:
+        logger.error(f"YouTube job {job['id']} failed: {e}")
+        await get_job_queue().finish(job['id'], 'failed')
+
+async def process_broadcast_job(job: dict, time_budget: float = BROADCAST_TIME_BUDGET) -> None:
+    """Delivers a queued broadcast for up to `time_budget` seconds, editing the owner's progress message,
+    then queues the remainder as a new job so no job outlives its lease. When all that is left are
+    recipients another drain holds, the new job waits until their lease expires."""
+    payload = job['payload']
+    bot = (await get_application()).bot
+    last_edit = 0.0
+
+    async def on_progress(broadcast: dict) -> None:
+        nonlocal last_edit
+        if time.monotonic() - last_edit < 3:
+            return
+        last_edit = time.monotonic()
+        try:
+            await bot.edit_message_text(format_broadcast_progress(broadcast), chat_id=payload['chat_id'],
+                                        message_id=payload['message_id'])
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Could not update broadcast progress message: {e}")
+
+    try:
+        broadcast = await drain_broadcast(payload['broadcast_id'], on_progress, time_budget)
+        claimable_at = None
+        if broadcast and broadcast['sent'] + broadcast['failed'] < broadcast['total']:
+            claimable_at = await get_broadcast_store().next_claimable_at(payload['broadcast_id'], BROADCAST_LEASE_SECONDS)
+        if claimable_at is not None:
+            await get_job_queue().enqueue('broadcast', payload, max(0.0, claimable_at - time.time()))
+        elif broadcast:
+            failures = await get_broadcast_store().failures(payload['broadcast_id'])
+            summary = '✅ **Broadcast එක අවසන්!**\n' + format_broadcast_progress(broadcast)
+            if failures:
+                summary += '\n\nඅසාර්ථක අංක:\n' + '\n'.join(f'{number} ({status})' for number, status in failures)
+            await bot.send_message(chat_id=payload['chat_id'], text=summary)
+        await get_job_queue().finish(job['id'], 'done')
+    except Exception as e:
+        logger.error(f"Broadcast job {job['id']} failed: {e}")
+        await get_job_queue().finish(job['id'], 'failed')
+
+async def run_job_worker(kind: str, process, concurrency: int) -> None:
+    """Consumes queued jobs of one kind with at most `concurrency` of them in flight."""
+    queue = get_job_queue()
+    running = set()
+    application = await get_application()
+    logger.info(f"Worker for '{kind}' jobs started with concurrency {concurrency}.")
+    try:
+        while True:
+            free_slots = concurrency - len(running)
+            jobs = await queue.claim(kind, free_slots) if free_slots > 0 else []
+            for job in jobs:
+                task = asyncio.create_task(process(job))
+                running.add(task)
+                task.add_done_callback(running.discard)
+            if not jobs:
+                await queue.recover_stale(kind)
+                await queue.release_due(kind)
+                await asyncio.sleep(YT_WORKER_POLL_INTERVAL)
+    finally:
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        await write_buffer.flush()
+        await application.shutdown()
+
+async def drain_broadcast_jobs(time_budget: float) -> int:
+    """Processes queued broadcast jobs one at a time until none is claimable or the time budget is spent,
+    for Vercel, where no broadcast-worker runs (GET /api/broadcasts). Returns the number of jobs processed."""
+    queue = get_job_queue()
+    await queue.recover_stale('broadcast')
+    await queue.release_due('broadcast')
+    deadline = time.monotonic() + time_budget
+    processed = 0
+    while (remaining := deadline - time.monotonic()) > 0:
+        jobs = await queue.claim('broadcast', 1)
+        if not jobs:
+            break
+        await process_broadcast_job(jobs[0], remaining)
+        processed += 1
+    return processed
 
 # --- External URL Downloader Handlers ---
 async def start_download_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -324,12 +3547,16 @@ async def get_download_url(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text('කරුණාකර වලංගු URL එකක් ඇතුළත් කරන්න (http:// හෝ https:// වලින් ආරම්භ විය යුතුය).')
         return DOWNLOAD_ASK_URL
 
-    await download_file_from_url(url, chat_id, context)
+    try:
+        async with governor.slot('url', update):
+            await download_file_from_url(url, chat_id, context)
+    except GovernorRejected as e:
+        await update.message.reply_text(str(e))
     return ConversationHandler.END
 
 # --- File Upload with PIN Handlers ---
 async def start_upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not FILES_COLLECTION:
+    if not get_collection('files'):
         await update.message.reply_text("File upload සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න.")
         return ConversationHandler.END
     await update.message.reply_text(
@@ -338,7 +3565,7 @@ async def start_upload_file(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return UPLOAD_WAIT_FILE
 
 async def handle_uploaded_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not FILES_COLLECTION:
+    if not get_collection('files'):
         await update.message.reply_text("File upload සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න.")
         return ConversationHandler.END
 
@@ -360,136 +3587,372 @@ async def handle_uploaded_file(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text('කරුණාකර වලංගු file එකක් (document, video, audio, photo) එවන්න.')
         return UPLOAD_WAIT_FILE
 
-    if file_obj.file_size and file_obj.file_size > 50 * 1024 * 1024:
+    if file_obj.file_size and file_obj.file_size > MAX_UPLOAD_SIZE:
         await update.message.reply_text(
-            f'ඔබගේ file එක ({file_obj.file_size / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම ගබඩා කිරීමට සහ යැවීමට විශාල වැඩියි. 50MB ට අඩු files පමණක් upload කරන්න.'
+            f'ඔබගේ file එක ({file_obj.file_size / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම ගබඩා කිරීමට සහ යැවීමට විශාල වැඩියි. {MAX_UPLOAD_SIZE // (1024*1024)}MB ට අඩු files පමණක් upload කරන්න.'
         )
         return ConversationHandler.END
 
-    await update.message.reply_text('File එක ගබඩා කරමින් PIN එකක් සාදමින් සිටී...')
+    status = StatusMessage(context.bot, update.message.chat_id)
+    status.set('File එක ගබඩා කරමින් PIN එකක් සාදමින් සිටී...')
     logger.info(f"Received file for upload: {file_obj.file_id}, size: {file_obj.file_size}")
 
+    user_id = update.effective_user.id
+    file_size = file_obj.file_size or 0
+    quota_reserved = False
     try:
-        unique_pin = await generate_unique_pin()
-        
+        from firebase_admin.firestore import SERVER_TIMESTAMP
+        if not await reserve_upload_quota(user_id, file_size):
+            await status.finish(
+                '❌ ඔබගේ upload සීමාව ඉක්මවා ඇත. ඔබගේ පැරණි files කල් ඉකුත් වූ පසු නැවත උත්සාහ කරන්න.'
+            )
+            logger.info(f"Upload quota exceeded for user {user_id}.")
+            return ConversationHandler.END
+        quota_reserved = True
+
+        mime_type = getattr(file_obj, 'mime_type', None)
         file_metadata = {
             'file_id': file_obj.file_id,
-            'file_name': file_obj.file_name if hasattr(file_obj, 'file_name') else f"telegram_{file_type}_{file_obj.file_id}.{file_obj.mime_type.split('/')[-1] if file_obj.mime_type else 'bin'}",
-            'mime_type': file_obj.mime_type,
+            'file_type': file_type,
+            'file_name': file_obj.file_name if hasattr(file_obj, 'file_name') else f"telegram_{file_type}_{file_obj.file_id}.{mime_type.split('/')[-1] if mime_type else 'jpg'}",
+            'mime_type': mime_type,
             'file_size': file_obj.file_size,
-            'pin': unique_pin,
-            'uploaded_by': update.effective_user.id,
-            'upload_timestamp': firestore.SERVER_TIMESTAMP
+            'uploaded_by': user_id,
+            'upload_timestamp': SERVER_TIMESTAMP,
+            'expires_at': time.time() + UPLOAD_TTL if UPLOAD_TTL else None,
+            'max_downloads': UPLOAD_MAX_DOWNLOADS or None,
+            'downloads': 0,
         }
         
-        await asyncio.to_thread(FILES_COLLECTION.document(unique_pin).set, file_metadata)
+        unique_pin = await store_file_metadata(file_metadata)
         
-        await update.message.reply_text(
+        limits = ''
+        if UPLOAD_TTL:
+            limits += f'මෙම PIN එක දින {max(1, round(UPLOAD_TTL / 86400))} කින් කල් ඉකුත් වේ.\n'
+        if UPLOAD_MAX_DOWNLOADS:
+            limits += f'එය භාවිතා කර download කළ හැක්කේ {UPLOAD_MAX_DOWNLOADS} වතාවක් පමණි.\n'
+        await status.finish(
             f'✅ **File එක සාර්ථකව upload කරන ලදී!**\n'
             f'ඔබගේ PIN එක: `{unique_pin}`\n\n'
-            'මෙම PIN එක ඕනෑම කෙනෙකුට /get_file command එක භාවිතා කර ඔබගේ file එක download කිරීමට භාවිතා කළ හැක.'
+            'මෙම PIN එක ඕනෑම කෙනෙකුට /get_file command එක භාවිතා කර ඔබගේ file එක download කිරීමට භාවිතා කළ හැක.\n'
+            + limits
         )
         logger.info(f"File {file_obj.file_id} uploaded with PIN: {unique_pin}")
 
     except Exception as e:
+        if quota_reserved:
+            await release_upload_quota(user_id, file_size)
         logger.error(f"Error processing uploaded file or saving to Firestore: {e}")
-        await update.message.reply_text('❌ File upload කිරීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
+        await status.finish('❌ File upload කිරීමේ දෝෂයක් සිදුවිය. කරුණාකර නැවත උත්සාහ කරන්න.')
     return ConversationHandler.END
 
 # --- PIN-based Download Handlers ---
+STORED_FILE_SENDERS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'audio': ('send_audio', 'audio'),
+    'animation': ('send_animation', 'animation'),
+    'document': ('send_document', 'document'),
+}
+
+async def send_stored_file(bot: telegram.Bot, chat_id: int, file_metadata: dict) -> None:
+    """Re-sends a stored file by its file_id with the send method matching its type. Uploads only keep
+    the file_id, so there is nothing to fall back to if Telegram rejects it: getFile on the same
+    file_id fails the same way. The BadRequest is left to the caller to report."""
+    file_name = file_metadata.get('file_name', 'downloaded_file')
+    method, argument = STORED_FILE_SENDERS.get(file_metadata.get('file_type'), STORED_FILE_SENDERS['document'])
+    await getattr(bot, method)(chat_id=chat_id, caption=f"ඔබගේ file එක: {file_name}", **{argument: file_metadata['file_id']})
+
 async def start_get_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not FILES_COLLECTION:
+    if not get_collection('files'):
         await update.message.reply_text("File download සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න.")
         return ConversationHandler.END
     await update.message.reply_text('කරුණාකර ඔබට download කිරීමට අවශ්‍ය file එකේ **PIN එක** ඇතුළත් කරන්න.')
     return GETFILE_ASK_PIN
 
 async def get_file_by_pin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not FILES_COLLECTION:
+    if not get_collection('files'):
         await update.message.reply_text("File download සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න.")
         return ConversationHandler.END
 
     pin = update.message.text.strip().upper()
     chat_id = update.message.chat_id
 
-    await update.message.reply_text(f'PIN එක `{pin}` සමඟ file එක සොයමින්...')
+    status = StatusMessage(context.bot, chat_id)
+    status.set(f'PIN එක `{pin}` සමඟ file එක සොයමින්...')
     logger.info(f"Attempting to retrieve file with PIN: {pin}")
 
     try:
-        doc_ref = FILES_COLLECTION.document(pin)
-        doc = await asyncio.to_thread(doc_ref.get)
-
-        if doc.exists:
-            file_metadata = doc.to_dict()
+        file_metadata = await file_metadata_cache.get(pin)
+        if file_metadata:
             telegram_file_id = file_metadata.get('file_id')
-            file_name = file_metadata.get('file_name', 'downloaded_file')
             file_size = file_metadata.get('file_size', 0)
 
             if not telegram_file_id:
-                await update.message.reply_text('ගැටලුවක් සිදුවිය: File ID එක සොයාගත නොහැක.')
+                await status.finish('ගැටලුවක් සිදුවිය: File ID එක සොයාගත නොහැක.')
                 logger.error(f"File ID missing for PIN: {pin}")
                 return ConversationHandler.END
             
-            if file_size > 50 * 1024 * 1024:
-                 await update.message.reply_text(
+            if file_size > MAX_UPLOAD_SIZE:
+                 await status.finish(
                     f'ඔබ සොයන file එක ({file_size / (1024*1024):.2f} MB) Telegram හරහා කෙලින්ම යැවීමට විශාල වැඩියි. '
                     'කරුණාකර වෙනත් download ක්‍රමයක් භාවිතා කරන්න.'
                 )
                  logger.warning(f"File for PIN {pin} too large for direct Telegram upload.")
                  return ConversationHandler.END
 
-            await update.message.reply_text('File එක download කරමින් සිටී...')
-            logger.info(f"Downloading file from Telegram with ID: {telegram_file_id}")
+            if not await claim_download(pin, file_metadata):
+                file_metadata_cache.invalidate(pin)
+                await status.finish('❌ මෙම PIN එක කල් ඉකුත් වී ඇත හෝ එහි download සීමාව ඉක්මවා ඇත.')
+                logger.info(f"PIN {pin} has expired or used up its downloads.")
+                return ConversationHandler.END
+
+            status.set('File එක යවමින් සිටී...')
+            logger.info(f"Sending stored file with ID: {telegram_file_id}")
 
             try:
-                file_info = await context.bot.get_file(telegram_file_id)
-                downloaded_bytes = await file_info.download_as_bytearray()
-
-                await context.bot.send_document(
-                    chat_id=chat_id,
-                    document=bytes(downloaded_bytes),
-                    filename=file_name,
-                    caption=f"ඔබගේ file එක: {file_name}"
-                )
-                await update.message.reply_text('✅ **File එක සාර්ථකව යවන ලදී!**')
+                await send_stored_file(context.bot, chat_id, file_metadata)
+                await status.finish('✅ **File එක සාර්ථකව යවන ලදී!**', quiet=True)
                 logger.info(f"File for PIN {pin} sent successfully.")
 
             except telegram.error.BadRequest as e:
                 logger.error(f"Telegram BadRequest error when downloading file {telegram_file_id} for PIN {pin}: {e}")
-                await update.message.reply_text('❌ Telegram හරහා file එක ලබාගැනීමේ දෝෂයක් සිදුවිය. (File ID වලංගු නොවිය හැක හෝ කල් ඉකුත් වී ඇත).')
+                await status.finish('❌ Telegram හරහා file එක ලබාගැනීමේ දෝෂයක් සිදුවිය. (File ID වලංගු නොවිය හැක හෝ කල් ඉකුත් වී ඇත).')
             except Exception as e:
                 logger.error(f"Error downloading/sending file for PIN {pin}: {e}")
-                await update.message.reply_text('❌ File එක යැවීමේදී අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර පසුව උත්සාහ කරන්න.')
+                await status.finish('❌ File එක යැවීමේදී අනපේක්ෂිත දෝෂයක් සිදුවිය. කරුණාකර පසුව උත්සාහ කරන්න.')
 
         else:
-            await update.message.reply_text('❌ වලංගු PIN එකක් නොවේ. කරුණාකර නිවැරදි PIN එක ඇතුළත් කරන්න.')
+            await status.finish('❌ වලංගු PIN එකක් නොවේ. කරුණාකර නිවැරදි PIN එක ඇතුළත් කරන්න.')
             logger.warning(f"Invalid PIN entered: {pin}")
 
     except Exception as e:
         logger.error(f"Error retrieving file from Firestore for PIN {pin}: {e}")
-        await update.message.reply_text('❌ File සොයාගැනීමේදී දෝෂයක් සිදුවිය. කරුණාකර පසුව උත්සාහ කරන්න.')
+        await status.finish('❌ File සොයාගැනීමේදී දෝෂයක් සිදුවිය. කරුණාකර පසුව උත්සාහ කරන්න.')
     return ConversationHandler.END
 
 # --- AI Conversation Handlers ---
+ai_first_token_latencies = deque(maxlen=500)  # seconds from the query arriving to the first answer text on screen
+
+def ai_stream_stats() -> dict:
+    if not ai_first_token_latencies:
+        return {'answers': 0}
+    latencies = sorted(ai_first_token_latencies)
+    return {
+        'answers': len(latencies),
+        'time_to_first_token_p50_ms': round(latencies[len(latencies) // 2] * 1000),
+        'time_to_first_token_p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000),
+    }
+
 async def start_ask_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not gemini_model:
+    if not get_gemini_model():
         await update.message.reply_text("AI සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න.")
         return ConversationHandler.END
     await update.message.reply_text('AI සමඟ කතා කිරීමට ඔබට අවශ්‍ය ප්‍රශ්නය හෝ විමසුම ඇතුළත් කරන්න.')
     return AI_ASK_QUERY
 
+async def send_ai_reply(update: Update, answer: str, started: float) -> None:
+    """Replies with an answer that is already complete, split at Telegram's message limit, without the
+    placeholder and edits of a streamed reply. `started` is the monotonic time the query arrived."""
+    head, rest = split_message_text(answer)
+    await update.message.reply_text(head)
+    ai_first_token_latencies.append(time.monotonic() - started)
+    while rest:
+        head, rest = split_message_text(rest)
+        await update.message.reply_text(head)
+
+async def stream_ai_reply(update: Update, chunks, started: float) -> str:
+    """Streams `chunks` into a reply to the update's message and returns the whole answer. `started` is
+    the monotonic time the query arrived, so waiting for a governor slot counts towards the first text."""
+    placeholder = await update.message.reply_text('ඔබගේ ප්‍රශ්නයට AI ප්‍රතිචාරයක් සකස් කරමින් සිටී...')
+    interval = AI_STREAM_EDIT_INTERVAL if update.effective_chat.type == 'private' else AI_STREAM_GROUP_EDIT_INTERVAL
+    reply = StreamingReply(placeholder, interval)
+    answer = []
+    async for chunk in chunks:
+        answer.append(chunk)
+        await reply.append(chunk)
+    await reply.finish()
+
+    if reply.first_shown_at is not None:
+        ai_first_token_latencies.append(reply.first_shown_at - started)
+        logger.info(f"AI answer for chat {update.message.chat_id}: first text shown after {reply.first_shown_at - started:.2f}s.")
+    return ''.join(answer)
+
 async def get_ai_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    started = time.monotonic()
     user_query = update.message.text
-    chat_id = update.message.chat_id
 
     if not user_query:
         await update.message.reply_text('කරුණාකර වලංගු ප්‍රශ්නයක් ඇතුළත් කරන්න.')
         return AI_ASK_QUERY
     
-    await update.message.reply_text('ඔබගේ ප්‍රශ්නයට AI ප්‍රතිචාරයක් සකස් කරමින් සිටී...')
-    ai_response = await ask_gemini_ai(user_query)
-    
-    await update.message.reply_text(ai_response)
+    try:
+        answer = await cached_gemini_answer(user_query)
+        if answer is not None:
+            await send_ai_reply(update, answer, started)
+        else:
+            async with governor.slot('ai', update):
+                await stream_ai_reply(update, generate_gemini_ai(user_query), started)
+    except GovernorRejected as e:
+        await update.message.reply_text(str(e))
+    return ConversationHandler.END
+
+# --- AI Chat Sessions ---
+# A session is stored per user under `ai_sessions` on the chat's state document as {'summary',
+# 'turns', 'updated_at'}, where `turns` alternates user and model messages. Only the newest turns that
+# fit in half of AI_CHAT_CONTEXT_TOKENS are kept verbatim; older ones are folded into `summary`.
+# `ai_sessions_idle_at` on the document is when its most recently used session goes idle.
+AI_CHAT_TIMEOUT_TEXT = 'AI chat එක අක්‍රියව තිබූ නිසා අවසන් විය. නැවත ආරම්භ කිරීමට /ai_chat භාවිතා කරන්න.'
+
+def new_ai_session() -> dict:
+    return {'summary': '', 'turns': [], 'updated_at': time.time()}
+
+def ai_session_expired(session) -> bool:
+    return not session or session.get('updated_at', 0) + AI_CHAT_IDLE_TTL < time.time()
+
+def save_ai_session(chat_id: int, user_id: int, session) -> None:
+    """Stages the user's session (None deletes it) and pushes back when the chat's sessions go idle."""
+    idle_at = {'ai_sessions_idle_at': time.time() + AI_CHAT_IDLE_TTL} if session else {}
+    bot_persistence.set_chat_user_field(chat_id, user_id, 'ai_sessions', session, **idle_at)
+
+def _sweep_idle_ai_sessions_batch(now: float) -> int:
+    """Ends the /ai_chat conversations of up to AI_CHAT_SWEEP_BATCH_SIZE chats whose sessions have all
+    gone idle and deletes the sessions, in one batched write. Returns the number of chats."""
+    from firebase_admin import firestore
+    db = get_firestore()
+    snapshots = list(get_collection('bot_state').where('ai_sessions_idle_at', '<', now).limit(AI_CHAT_SWEEP_BATCH_SIZE).get())
+    if snapshots:
+        batch = db.batch()
+        for snapshot in snapshots:
+            # Skipped (failing the batch) if a message arrived since the query.
+            batch.update(snapshot.reference, {
+                'ai_sessions': firestore.DELETE_FIELD,
+                'ai_sessions_idle_at': firestore.DELETE_FIELD,
+                'conversations.ai_chat': firestore.DELETE_FIELD,
+            }, option=db.write_option(last_update_time=snapshot.update_time))
+        batch.commit()
+    return len(snapshots)
+
+async def sweep_idle_ai_sessions(time_budget: float = UPLOAD_SWEEP_TIME_BUDGET) -> int:
+    """Deletes idle /ai_chat sessions batch by batch until none are left or the time budget is spent.
+    Only the Firestore state store is swept; elsewhere ai_chat_message ends idle sessions on their next
+    message."""
+    if not get_collection('bot_state'):
+        return 0
+    deadline = time.monotonic() + time_budget
+    swept = failures = 0
+    while time.monotonic() < deadline:
+        try:
+            count = await external_call('firestore', 'ai_sessions_sweep', _sweep_idle_ai_sessions_batch, time.time())
+        except Exception as e:
+            failures += 1
+            logger.warning(f"AI session sweep batch failed ({failures}/{PIN_MAX_ATTEMPTS}): {e}")
+            if failures >= PIN_MAX_ATTEMPTS:
+                break
+            await asyncio.sleep(_retry_delay(failures))
+            continue
+        swept += count
+        if count < AI_CHAT_SWEEP_BATCH_SIZE:
+            break
+    logger.info(f"AI session sweep ended the idle sessions of {swept} chats.")
+    return swept
+
+def ai_session_history(session: dict) -> list:
+    history = []
+    if session['summary']:
+        history.append({'role': 'user', 'parts': [f"Summary of our conversation so far:\n{session['summary']}"]})
+        history.append({'role': 'model', 'parts': ['OK.']})
+    for i, text in enumerate(session['turns']):
+        history.append({'role': 'user' if i % 2 == 0 else 'model', 'parts': [text]})
+    return history
+
+async def summarize_ai_turns(summary: str, turns: list) -> str:
+    transcript = '\n'.join(f"{'User' if i % 2 == 0 else 'Assistant'}: {text}" for i, text in enumerate(turns))
+    prompt = (
+        "Update the running summary of a conversation with the new exchanges below. Keep names, facts, "
+        f"decisions and open questions, and stay under {AI_CHAT_SUMMARY_WORDS} words. Reply with the summary only.\n\n"
+        f"Summary so far:\n{summary or '(none)'}\n\nNew exchanges:\n{transcript}"
+    )
+    return ''.join([chunk async for chunk in generate_gemini_stream(prompt, {})]).strip()
+
+async def compact_ai_session(session: dict) -> int:
+    """Folds the oldest turns into the summary once the session exceeds its token budget. When that
+    fails the turns are kept for the next message to try again, unless the session is over twice its
+    budget; then the oldest are dropped. Returns the number of turns dropped."""
+    turns = session['turns']
+    tokens = estimate_tokens(session['summary']) + sum(estimate_tokens(text) for text in turns)
+    if tokens <= AI_CHAT_CONTEXT_TOKENS:
+        return 0
+    # Keep whole exchanges, newest first, within half the budget so compaction doesn't run every turn.
+    keep, kept_tokens = len(turns), 0
+    while keep >= 2 and kept_tokens + estimate_tokens(turns[keep - 2]) + estimate_tokens(turns[keep - 1]) <= AI_CHAT_CONTEXT_TOKENS // 2:
+        kept_tokens += estimate_tokens(turns[keep - 2]) + estimate_tokens(turns[keep - 1])
+        keep -= 2
+    try:
+        session['summary'] = await summarize_ai_turns(session['summary'], turns[:keep])
+    except Exception as e:
+        if tokens <= 2 * AI_CHAT_CONTEXT_TOKENS:
+            logger.warning(f"Could not summarize AI chat history; keeping it verbatim for now: {e}")
+            return 0
+        logger.warning(f"Could not summarize AI chat history; dropping the {keep} oldest turns: {e}")
+        session['turns'] = turns[keep:]
+        return keep
+    session['turns'] = turns[keep:]
+    return 0
+
+async def start_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    if not get_gemini_model():
+        await update.message.reply_text("AI සේවාව ලබා ගත නොහැක. කරුණාකර පසුව උත්සාහ කරන්න.")
+        return ConversationHandler.END
+    save_ai_session(update.message.chat_id, update.effective_user.id, new_ai_session())
+    await update.message.reply_text('AI chat එක ආරම්භ විය. ඔබගේ පණිවිඩ යවන්න; AI කලින් කතා කළ දේ මතක තබා ගනී. අවසන් කිරීමට /end_chat භාවිතා කරන්න.')
+    return AI_CHAT
+
+async def ai_chat_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    started = time.monotonic()
+    chat_id, user_id = update.message.chat_id, update.effective_user.id
+    user_message = update.message.text
+    session = await bot_persistence.get_chat_user_field(chat_id, user_id, 'ai_sessions')
+    # The conversation timeout: PTB's conversation_timeout needs a running JobQueue, which a frozen
+    # serverless instance can't keep, so an idle conversation is ended by its next message (or the sweep).
+    if ai_session_expired(session):
+        save_ai_session(chat_id, user_id, None)
+        await update.message.reply_text(AI_CHAT_TIMEOUT_TEXT)
+        return ConversationHandler.END
+
+    failed = False
+
+    async def chunks():
+        nonlocal failed
+        try:
+            async for chunk in generate_gemini_stream(user_message, {}, history=ai_session_history(session)):
+                yield chunk
+        except Exception as e:
+            logger.error(f"Error in AI chat for chat {chat_id}, user {user_id}: {e}")
+            failed = True
+            yield f"\n\n{AI_ERROR_TEXT}"
+
+    try:
+        async with governor.slot('ai', update):
+            answer = await stream_ai_reply(update, chunks(), started)
+    except GovernorRejected as e:
+        await update.message.reply_text(str(e))
+        return AI_CHAT
+    if failed:
+        return AI_CHAT
+
+    # The user already has the answer, so summarizing here doesn't add to their wait.
+    session['turns'] += [user_message, answer]
+    dropped = await compact_ai_session(session)
+    session['updated_at'] = time.time()
+    save_ai_session(chat_id, user_id, session)
+    if dropped:
+        await update.message.reply_text(f'⚠️ පැරණි පණිවිඩ {dropped // 2}ක් සාරාංශ කළ නොහැකි වූ නිසා AI හට තවදුරටත් මතක නැත.')
+    return AI_CHAT
+
+async def end_ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    save_ai_session(update.message.chat_id, update.effective_user.id, None)
+    await update.message.reply_text('AI chat එක අවසන් කරන ලදී.')
     return ConversationHandler.END
 
 # --- General Handlers ---
@@ -500,15 +3963,76 @@ async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def unhandled_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.message and update.message.text:
-        logger.info(f"Received unhandled message: {update.message.text}")
+        logger.info(f"Received unhandled message ({len(update.message.text)} characters).")
         await update.message.reply_text(
             "මට තේරෙන්නේ නැහැ. කරුණාකර /start command එක භාවිතා කර ලබා ගත හැකි commands බලන්න."
         )
 
 # --- Global Application Instance ---
-application = Application.builder().token(BOT_TOKEN).build()
+# Built, given its handlers and initialized on the first update, then reused for as long as the
+# instance stays warm. The bot's HTTP client is bound to the event loop, so a new loop (a new Vercel
+# invocation) only gets a new client.
+_application = None
+_application_loop = None
+
+def build_application() -> Application:
+    """Builds the Application that owns the bot and its HTTP pool."""
+    # PTB's default Bot API pool is a single connection, which serializes concurrent updates on one instance.
+    builder = (Application.builder().token(BOT_TOKEN).persistence(bot_persistence).rate_limiter(send_scheduler)
+               .connection_pool_size(HTTP_MAX_CONNECTIONS_PER_HOST).pool_timeout(HTTP_POOL_TIMEOUT))
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL).base_file_url(TELEGRAM_API_BASE_URL.replace('/bot', '/file/bot'))
+    return builder.build()
+
+async def get_application() -> Application:
+    global _application, _application_loop
+    loop = asyncio.get_running_loop()
+    if _application is None:
+        application = build_application()
+        register_handlers(application)
+        await application.initialize()
+        _application = application
+    elif _application_loop is not loop:
+        # The old client's connections belong to a loop that has gone; they are dropped, not closed.
+        _application.bot.request._client = _application.bot.request._build_client()
+    _application_loop = loop
+    return _application
+
+async def shutdown_application() -> None:
+    """Waits for in-flight background updates (and the downloads they run), flushes the write buffer,
+    then shuts the Application down, which flushes persistence, and closes the shared HTTP client."""
+    global _application
+    if _background_updates:
+        logger.info(f"Draining {len(_background_updates)} in-flight updates before shutdown.")
+        _, pending = await asyncio.wait(set(_background_updates), timeout=SERVER_SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"Cancelled {len(pending)} updates still running after {SERVER_SHUTDOWN_TIMEOUT}s.")
+    await write_buffer.flush()
+    if _application is not None:
+        await _application.shutdown()
+        _application = None
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
 
-# Register handlers once
+def instrument_handlers(app: Application) -> None:
+    """Wraps every registered callback, including those inside ConversationHandlers, with `instrumented`,
+    and command callbacks with `counted` too."""
+    def wrap(handler) -> None:
+        if isinstance(handler, ConversationHandler):
+            for inner in handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs]:
+                wrap(inner)
+        elif not hasattr(handler.callback, '__wrapped__'):
+            handler.callback = instrumented('handler')(handler.callback)
+            if isinstance(handler, CommandHandler):
+                handler.callback = counted('_'.join(sorted(handler.commands)))(handler.callback)
+
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            wrap(handler)
+
+# Registers every handler on the Application, once per instance (see get_application)
 def register_handlers(app: Application) -> None:
     app.add_handler(CommandHandler("start", start_command))
 
@@ -519,14 +4043,30 @@ def register_handlers(app: Application) -> None:
             SENDMSG_ASK_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_sendmsg_message)],
         },
         fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="sendmsg",
+        persistent=True,
     ))
     
     app.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("yt_download", start_yt_download)],
+        entry_points=[CommandHandler("broadcast", start_broadcast)],
+        states={
+            BROADCAST_ASK_NUMBERS: [MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, get_broadcast_numbers)],
+            BROADCAST_ASK_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_broadcast_message)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="broadcast",
+        persistent=True,
+    ))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+
+    app.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("yt_download", start_yt_download), CommandHandler("yt_audio", start_yt_audio)],
         states={
             YT_ASK_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_yt_url)],
         },
         fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="yt_download",
+        persistent=True,
     ))
 
     app.add_handler(ConversationHandler(
@@ -535,6 +4075,8 @@ def register_handlers(app: Application) -> None:
             DOWNLOAD_ASK_URL: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_download_url)],
         },
         fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="download_url",
+        persistent=True,
     ))
 
     app.add_handler(ConversationHandler(
@@ -544,6 +4086,8 @@ def register_handlers(app: Application) -> None:
             UPLOAD_WAIT_FILE: [MessageHandler(filters.Document.ALL | filters.VIDEO | filters.AUDIO | filters.PHOTO, handle_uploaded_file)],
         },
         fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="upload_file",
+        persistent=True,
     ))
 
     app.add_handler(ConversationHandler(
@@ -552,6 +4096,8 @@ def register_handlers(app: Application) -> None:
             GETFILE_ASK_PIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_file_by_pin)],
         },
         fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="get_file",
+        persistent=True,
     ))
 
     app.add_handler(ConversationHandler(
@@ -560,27 +4106,175 @@ def register_handlers(app: Application) -> None:
             AI_ASK_QUERY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_ai_query)],
         },
         fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        name="ask_ai",
+        persistent=True,
+    ))
+
+    app.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("ai_chat", start_ai_chat)],
+        states={
+            AI_CHAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat_message)],
+        },
+        fallbacks=[CommandHandler("end_chat", end_ai_chat), CommandHandler("cancel", end_ai_chat)],
+        name="ai_chat",
+        persistent=True,
     ))
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unhandled_message_handler))
+    instrument_handlers(app)
+
+# --- Update Processing ---
+class UpdateDeduplicator:
+    """Remembers seen update_ids so Telegram's webhook retries are dropped. Checked in memory first;
+    across instances a processed_updates/{update_id} document is created, which fails if it exists.
+    An update that fails is forgotten again, so its retry is processed rather than dropped."""
+
+    def __init__(self):
+        self.seen = LRUCache(UPDATE_DEDUP_MAX_ENTRIES, UPDATE_DEDUP_TTL)  # update_id -> 'durable' or 'memory'
+        self.duplicates = 0
+
+    async def first_seen(self, update_id, durable: bool = True) -> bool:
+        """With `durable` False the update is only remembered on this instance, sparing updates that
+        change no stored state (/start, /broadcast_status) the Firestore round-trip; a retry of one that
+        reaches another instance is answered twice."""
+        if update_id is None:
+            return True
+        if self.seen.get(update_id):
+            self.duplicates += 1
+            return False
+        self.seen.set(update_id, 'durable' if durable else 'memory')
+        if not durable:
+            return True
+        collection = get_collection('processed_updates')
+        if collection:
+            from google.api_core.exceptions import AlreadyExists
+            try:
+                await external_call('firestore', 'processed_updates_create', collection.document(str(update_id)).create,
+                                    {'expires_at': time.time() + UPDATE_DEDUP_TTL})
+            except AlreadyExists:
+                self.duplicates += 1
+                return False
+            except Exception as e:
+                logger.warning(f"Could not record update {update_id} in the idempotency store: {e}")
+        return True
+
+    async def forget(self, update_id) -> None:
+        if update_id is None:
+            return
+        durable = self.seen.get(update_id) == 'durable'
+        self.seen.pop(update_id)
+        if not durable:
+            return
+        collection = get_collection('processed_updates')
+        if collection:
+            try:
+                await external_call('firestore', 'processed_updates_delete', collection.document(str(update_id)).delete)
+            except Exception as e:
+                logger.warning(f"Could not forget failed update {update_id} in the idempotency store: {e}")
+
+update_deduplicator = UpdateDeduplicator()
+_background_updates = set()
+_chat_locks = {}
+
+async def reaches_stored_state(update_data: dict) -> bool:
+    """Whether processing the update can read or change conversation states or user_data."""
+    application = await get_application()
+    return reaches_conversation(Update.de_json(update_data, application.bot), application)
+
+async def process_telegram_update(update_data: dict) -> None:
+    application = await get_application()
+    update = Update.de_json(update_data, application.bot)
+    await bot_persistence.load_update(update, application)
+    await application.process_update(update)
+    # Write conversation state and user_data before the invocation can be frozen
+    await application.update_persistence()
+    await bot_persistence.flush()
+
+async def _process_update_in_background(update_data: dict) -> None:
+    # Updates from one chat are processed in order so their conversation steps don't race.
+    chat = (update_data.get('message') or update_data.get('edited_message') or {}).get('chat') or {}
+    chat_id = chat.get('id')
+    lock, users = _chat_locks.get(chat_id, (asyncio.Lock(), 0))
+    _chat_locks[chat_id] = (lock, users + 1)
+    try:
+        async with lock:
+            await process_telegram_update(update_data)
+    except Exception as e:
+        logger.error(f"Error processing Telegram update {update_data.get('update_id')} in background: {e}")
+        await update_deduplicator.forget(update_data.get('update_id'))
+    finally:
+        lock, users = _chat_locks[chat_id]
+        if users == 1:
+            del _chat_locks[chat_id]
+        else:
+            _chat_locks[chat_id] = (lock, users - 1)
+
+def start_background_update(update_data: dict) -> None:
+    task = asyncio.ensure_future(_process_update_in_background(update_data))
+    _background_updates.add(task)
+    task.add_done_callback(_background_updates.discard)
+
+async def process_update_job(job: dict) -> None:
+    try:
+        await process_telegram_update(job['payload'])
+        await get_job_queue().finish(job['id'], 'done')
+    except Exception as e:
+        logger.error(f"Update job {job['id']} failed: {e}")
+        await update_deduplicator.forget(job['payload'].get('update_id'))
+        await get_job_queue().finish(job['id'], 'failed')
+
+def _request_header(request, name: str) -> str:
+    for key, value in (getattr(request, 'headers', None) or {}).items():
+        if key.lower() == name.lower():
+            return value
+    return ''
+
+def _bearer_authorized(request, secret: str) -> bool:
+    """True if the request carries 'Authorization: Bearer <secret>'; always False while the secret is unset."""
+    return bool(secret) and hmac.compare_digest(_request_header(request, 'Authorization'), f'Bearer {secret}')
 
-# Register handlers when the script is loaded
-register_handlers(application)
+def _request_path(request) -> str:
+    return urlsplit(str(getattr(request, 'path', None) or getattr(request, 'url', None) or '')).path
 
 # --- Vercel Serverless Function Entry Point ---
+# Set by the ASGI lifespan startup; a Vercel invocation flushes the write buffer before it returns.
+_long_lived_server = False
+
 # This function will be called by Vercel when an HTTP request comes in.
 async def handler(request):
     """
     Vercel serverless function entry point for Telegram bot webhooks.
     """
     if request.method == 'POST':
+        if WEBHOOK_SECRET_TOKEN and not hmac.compare_digest(
+                _request_header(request, 'X-Telegram-Bot-Api-Secret-Token'), WEBHOOK_SECRET_TOKEN):
+            logger.warning("Rejected webhook request with a missing or wrong secret token.")
+            return {
+                'statusCode': 403,
+                'body': json.dumps({'error': 'Forbidden'})
+            }
+        update_data = None
         try:
             # Read the incoming JSON update from Telegram
             update_data = json.loads(request.body.decode('utf-8'))
-            update = Update.de_json(update_data, application.bot)
-            
-            # Process the update asynchronously
-            await application.process_update(update)
+            if RECORD_UPDATES_PATH:
+                with open(RECORD_UPDATES_PATH, 'a', encoding='utf-8') as recording:
+                    recording.write(json.dumps(update_data, ensure_ascii=False) + '\n')
+            # A queued update is processed elsewhere, so it is always recorded across instances.
+            durable = WEBHOOK_MODE == 'queue' or await reaches_stored_state(update_data)
+            if not await update_deduplicator.first_seen(update_data.get('update_id'), durable):
+                logger.info(f"Dropping duplicate update {update_data.get('update_id')}.")
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps({'status': 'duplicate'})
+                }
+
+            if WEBHOOK_MODE == 'background':
+                start_background_update(update_data)
+            elif WEBHOOK_MODE == 'queue':
+                await get_job_queue().enqueue('update', update_data)
+            else:
+                await process_telegram_update(update_data)
             
             # Telegram expects a 200 OK response quickly
             return {
@@ -589,15 +4283,82 @@ async def handler(request):
             }
         except Exception as e:
             logger.error(f"Error processing Telegram update: {e}")
+            # Telegram retries the update after a 500, which must not be dropped as a duplicate
+            if isinstance(update_data, dict):
+                await update_deduplicator.forget(update_data.get('update_id'))
             return {
                 'statusCode': 500,
                 'body': json.dumps({'error': str(e)})
             }
+        finally:
+            # A serverless instance may be frozen as soon as it answers, so the buffer's timer can't be
+            # relied on; the invocation commits it once it is due. A long-lived server leaves it to the timer.
+            if not _long_lived_server and write_buffer.due():
+                await write_buffer.flush()
+    elif request.method == 'GET' and _request_path(request).rstrip('/').endswith('/sweep'):
+        # Run by Vercel Cron (see vercel.json), which authenticates with CRON_SECRET.
+        if not _bearer_authorized(request, CRON_SECRET):
+            return {
+                'statusCode': 403,
+                'body': json.dumps({'error': 'Forbidden'})
+            }
+        deadline = time.monotonic() + UPLOAD_SWEEP_TIME_BUDGET
+        deleted = await sweep_expired_uploads()
+        updates = await sweep_processed_updates(max(0.0, deadline - time.monotonic()))
+        sessions = await sweep_idle_ai_sessions(max(0.0, deadline - time.monotonic()))
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'status': 'ok', 'deleted': deleted, 'processed_updates_deleted': updates,
+                                'idle_ai_sessions_deleted': sessions})
+        }
+    elif request.method == 'GET' and _request_path(request).rstrip('/').endswith('/broadcasts'):
+        # Run by Vercel Cron (see vercel.json), which authenticates with CRON_SECRET.
+        if not _bearer_authorized(request, CRON_SECRET):
+            return {
+                'statusCode': 403,
+                'body': json.dumps({'error': 'Forbidden'})
+            }
+        processed = await drain_broadcast_jobs(BROADCAST_CRON_TIME_BUDGET)
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'status': 'ok', 'broadcast_jobs': processed})
+        }
+    elif request.method == 'GET' and _request_path(request).rstrip('/').endswith('/metrics'):
+        if not _bearer_authorized(request, METRICS_SECRET):
+            return {
+                'statusCode': 403,
+                'body': json.dumps({'error': 'Forbidden'})
+            }
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'text/plain; version=0.0.4'},
+            'body': metrics.render({
+                'download_cache': download_cache.stats(),
+                'file_cache': file_metadata_cache.stats(),
+                'ai_stream': ai_stream_stats(),
+                'ai_cache': answer_cache.stats(),
+                'transcoder': transcoder.stats(),
+                'send_scheduler': send_scheduler.stats(),
+                'write_buffer': write_buffer.stats(),
+                'updates': {'duplicates': update_deduplicator.duplicates},
+            }),
+        }
     elif request.method == 'GET':
         # Simple GET request response for checking if the endpoint is alive
         return {
             'statusCode': 200,
-            'body': json.dumps({'status': 'Bot is running and ready for webhooks!'})
+            'body': json.dumps({
+                'status': 'Bot is running and ready for webhooks!',
+                'download_cache': download_cache.stats(),
+                'file_cache': file_metadata_cache.stats(),
+                'ai_stream': ai_stream_stats(),
+                'ai_cache': answer_cache.stats(),
+                'governor': governor.stats(),
+                'transcoder': transcoder.stats(),
+                'send_scheduler': send_scheduler.stats(),
+                'write_buffer': write_buffer.stats(),
+                'duplicate_updates': update_deduplicator.duplicates,
+            })
         }
     else:
         return {
@@ -605,8 +4366,78 @@ async def handler(request):
             'body': json.dumps({'error': 'Method Not Allowed'})
         }
 
+# --- ASGI Server Entry Point ---
+# Long-lived alternative to the Vercel function. Each worker process keeps one event loop, so the
+# Application, the HTTP pools and the Firestore/Gemini clients stay initialized across requests:
+#     gunicorn -w 4 -k uvicorn.workers.UvicornWorker --graceful-timeout 120 api.index:app
+# Set WEBHOOK_MODE=background so long downloads don't hold Telegram's webhook request open;
+# shutdown then drains them for up to SERVER_SHUTDOWN_TIMEOUT seconds.
+async def app(scope, receive, send):
+    global _long_lived_server
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                _long_lived_server = True
+                try:
+                    await get_application()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await shutdown_application()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    request = types.SimpleNamespace(
+        method=scope['method'],
+        path=scope['path'],
+        body=body,
+        headers={key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']},
+    )
+    response = await handler(request)
+    content_type = response.get('headers', {}).get('Content-Type', 'application/json')
+    await send({
+        'type': 'http.response.start',
+        'status': response['statusCode'],
+        'headers': [(b'content-type', content_type.encode('latin-1'))],
+    })
+    await send({'type': 'http.response.body', 'body': response['body'].encode('utf-8')})
+
+# Background worker for queued YouTube downloads (run on a long-lived host, not on Vercel):
+#     python api/index.py yt-worker
+if __name__ == '__main__' and sys.argv[1:2] == ['yt-worker']:
+    asyncio.run(run_job_worker('yt_download', process_yt_job, YT_WORKER_CONCURRENCY))
+
+# Background worker delivering queued broadcasts:
+#     python api/index.py broadcast-worker
+if __name__ == '__main__' and sys.argv[1:2] == ['broadcast-worker']:
+    asyncio.run(run_job_worker('broadcast', process_broadcast_job, BROADCAST_WORKER_CONCURRENCY))
+
+# Background worker for webhook updates when WEBHOOK_MODE=queue:
+#     python api/index.py update-worker
+if __name__ == '__main__' and sys.argv[1:2] == ['update-worker']:
+    asyncio.run(run_job_worker('update', process_update_job, UPDATE_WORKER_CONCURRENCY))
+
+# Deletes every expired upload, processed_updates marker and idle /ai_chat session (GET /api/sweep does
+# the same within UPLOAD_SWEEP_TIME_BUDGET):
+#     python api/index.py sweep-uploads
+if __name__ == '__main__' and sys.argv[1:2] == ['sweep-uploads']:
+    asyncio.run(sweep_expired_uploads(float('inf')))
+    asyncio.run(sweep_processed_updates(float('inf')))
+    asyncio.run(sweep_idle_ai_sessions(float('inf')))
+
 # For local testing (optional, not for Vercel deployment)
 # if __name__ == '__main__':
 #     logger.info("Starting bot in polling mode for local development...")
-#     application.run_polling(allowed_updates=Update.ALL_TYPES)
+#     build_application().run_polling(allowed_updates=Update.ALL_TYPES)
 #     logger.info("Bot stopped.")
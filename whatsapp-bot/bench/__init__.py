@@ -0,0 +1,31 @@
+# Shared helpers for the benchmarks in this package, which drive api.index with its external services
+# faked (see bench/fakes.py).
+import itertools
+import json
+import time
+import types
+
+from api import index
+
+def percentile(ordered: list, q: float):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+update_ids = itertools.count(1)
+
+def message_update(user_id: int, text: str) -> dict:
+    update_id = next(update_ids)
+    message = {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench'},
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+async def post_update(update_data: dict) -> None:
+    request = types.SimpleNamespace(method='POST', path='/api/index', headers={},
+                                    body=json.dumps(update_data).encode('utf-8'))
+    response = await index.handler(request)
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"update {update_data['update_id']} failed: {response['body']}")
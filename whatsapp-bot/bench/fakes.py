@@ -0,0 +1,367 @@
+# In-process stand-ins for the services api.index talks to, for the benchmarks in this package and the
+# tests. Nothing here is imported by the bot itself.
+import asyncio
+import contextlib
+import copy
+import json
+import random
+import string
+import sys
+import threading
+import time
+import types
+from collections import Counter
+from unittest import mock
+from urllib.parse import parse_qsl
+
+from api import index
+
+class FakeTelegramAPI:
+    """Minimal keep-alive HTTP server that answers Bot API calls with canned successful results. The
+    WhatsApp gateway stub answers after `gateway_latency` seconds, like a real one would, and with
+    `gateway_concurrency` serves only that many requests at a time."""
+
+    def __init__(self, gateway_latency: float = 0.0, gateway_concurrency: int = None):
+        self.calls = Counter()
+        self.message_id = 0
+        self.gateway_latency = gateway_latency
+        self.gateway_concurrency = gateway_concurrency
+        self._gateway_slots = None
+        self.gateway_messages = 0
+
+    def respond(self, path: str, body: bytes) -> tuple:
+        if path.startswith('/bytes/'):
+            # Download target for replayed /download_url updates: /bytes/<size>
+            self.calls['bytes'] += 1
+            return 'application/octet-stream', b'\0' * int(path.split('/')[2])
+        if path.startswith('/file/'):
+            # getFile download target: /file/bot<token>/bytes/<size>
+            self.calls['file'] += 1
+            return 'application/octet-stream', b'\0' * int(path.rsplit('/', 1)[-1])
+        if path.startswith('/send-message'):
+            # WhatsApp gateway stub, single or batched
+            self.calls['send-message'] += 1
+            messages = json.loads(body or b'{}').get('messages')
+            self.gateway_messages += len(messages) if messages is not None else 1
+            result = {'results': [{'status': 'success'}] * len(messages)} if messages is not None else {'status': 'success'}
+            return 'application/json', json.dumps(result).encode('utf-8')
+        method = path.rstrip('/').rsplit('/', 1)[-1]
+        self.calls[method] += 1
+        params = dict(parse_qsl(body.decode('utf-8', 'replace'))) if b'=' in body[:200] else {}
+        return 'application/json', json.dumps({'ok': True, 'result': self.result(method, params)}).encode('utf-8')
+
+    def result(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot',
+                    'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if method == 'getFile':
+            # file_ids ending in -<size> download as that many bytes, others as empty files
+            file_id = params.get('file_id', '')
+            size = file_id.rsplit('-', 1)[-1]
+            size = int(size) if size.isdigit() else 0
+            return {'file_id': file_id, 'file_unique_id': f'fake-{file_id}', 'file_size': size, 'file_path': f'bytes/{size}'}
+        if method.startswith('send') or method.startswith('edit'):
+            self.message_id += 1
+            chat_id = params.get('chat_id', '0')
+            message = {'message_id': self.message_id, 'date': int(time.time()),
+                       'chat': {'id': int(chat_id) if chat_id.lstrip('-').isdigit() else 0, 'type': 'private'},
+                       'text': params.get('text', '')}
+            attachment = {'file_id': f'fake-file-{self.message_id}', 'file_unique_id': f'fake-{self.message_id}'}
+            if method == 'sendDocument':
+                message['document'] = attachment
+            elif method == 'sendVideo':
+                message['video'] = dict(attachment, width=640, height=360, duration=1)
+            elif method == 'sendAudio':
+                message['audio'] = dict(attachment, duration=1)
+            return message
+        return True
+
+    async def gateway_delay(self) -> None:
+        if not self.gateway_concurrency:
+            await asyncio.sleep(self.gateway_latency)
+            return
+        if self._gateway_slots is None:
+            self._gateway_slots = asyncio.Semaphore(self.gateway_concurrency)
+        async with self._gateway_slots:
+            await asyncio.sleep(self.gateway_latency)
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                headers = dict(line.split(': ', 1) for line in header_lines if ': ' in line)
+                length = int({k.lower(): v for k, v in headers.items()}.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+                path = request_line.split(' ')[1]
+                if self.gateway_latency and path.startswith('/send-message'):
+                    await self.gateway_delay()
+                content_type, payload = self.respond(path, body)
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: ' + content_type.encode() + b'\r\n'
+                             b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8081) -> None:
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        print(f"Fake Bot API listening on http://{host}:{port}/bot<token>/<method>")
+        async with server:
+            await server.serve_forever()
+
+class FakeFirestore:
+    """In-memory stand-in for the Firestore client calls this module makes: document reads and writes,
+    equality/'in'/range queries with limit, batches, update-time preconditions and the SERVER_TIMESTAMP,
+    DELETE_FIELD and Increment transforms."""
+
+    def __init__(self):
+        self.docs = {}  # path -> (data, update_time)
+        self.lock = threading.RLock()
+        self.clock = 0
+        self.calls = Counter()  # round-trips by kind
+
+    def collection(self, path: str):
+        return FakeCollectionReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write_option(self, last_update_time=None):
+        return last_update_time
+
+    def get_all(self, refs):
+        self.calls['get_all'] += 1
+        return [ref.snapshot() for ref in refs]
+
+    def _resolve(self, current, value):
+        from firebase_admin import firestore
+        if value is firestore.SERVER_TIMESTAMP:
+            return time.time()
+        if isinstance(value, firestore.Increment):
+            return (current or 0) + value.value
+        if isinstance(value, dict):
+            return {key: self._resolve(None, item) for key, item in value.items() if item is not firestore.DELETE_FIELD}
+        return copy.deepcopy(value)
+
+    def _merge(self, target: dict, fields: dict) -> None:
+        from firebase_admin import firestore
+        for key, value in fields.items():
+            if value is firestore.DELETE_FIELD:
+                target.pop(key, None)
+            elif isinstance(value, dict) and isinstance(target.get(key), dict):
+                self._merge(target[key], value)
+            else:
+                target[key] = self._resolve(target.get(key), value)
+
+    def write(self, path: str, fields: dict, mode: str, option=None) -> None:
+        from firebase_admin import firestore
+        from google.api_core.exceptions import AlreadyExists, NotFound, FailedPrecondition
+        with self.lock:
+            current = self.docs.get(path)
+            if mode == 'create' and current is not None:
+                raise AlreadyExists(f"Document already exists: {path}")
+            if mode == 'update' and current is None:
+                raise NotFound(f"No document to update: {path}")
+            if option is not None and (current is None or current[1] != option):
+                raise FailedPrecondition(f"Update time precondition failed: {path}")
+            if mode == 'delete':
+                self.docs.pop(path, None)
+                return
+            data = copy.deepcopy(current[0]) if current is not None and mode in ('merge', 'update') else {}
+            if mode == 'update':
+                for field_path, value in fields.items():
+                    *parents, leaf = field_path.split('.')
+                    target = data
+                    for parent in parents:
+                        target = target.setdefault(parent, {})
+                    # update() replaces the field at each path, where set(merge=True) merges into maps.
+                    if value is not firestore.DELETE_FIELD and isinstance(value, dict):
+                        target[leaf] = {}
+                    self._merge(target, {leaf: value})
+            else:
+                self._merge(data, fields)
+            self.clock += 1
+            self.docs[path] = (data, self.clock)
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self.exists else None
+
+    def get(self, field_path: str):
+        value = self._data
+        for part in field_path.split('.'):
+            value = value[part]
+        return copy.deepcopy(value)
+
+class FakeDocumentReference:
+    def __init__(self, db: FakeFirestore, path: str):
+        self.db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+
+    def collection(self, name: str):
+        return FakeCollectionReference(self.db, f"{self.path}/{name}")
+
+    def snapshot(self):
+        data, update_time = self.db.docs.get(self.path, (None, None))
+        return FakeDocumentSnapshot(self, copy.deepcopy(data), update_time)
+
+    def get(self):
+        self.db.calls['get'] += 1
+        return self.snapshot()
+
+    def set(self, data: dict, merge: bool = False) -> None:
+        self.db.calls['set'] += 1
+        self.db.write(self.path, data, 'merge' if merge else 'set')
+
+    def create(self, data: dict) -> None:
+        self.db.calls['create'] += 1
+        self.db.write(self.path, data, 'create')
+
+    def update(self, fields: dict, option=None) -> None:
+        self.db.calls['update'] += 1
+        self.db.write(self.path, fields, 'update', option)
+
+    def delete(self) -> None:
+        self.db.calls['delete'] += 1
+        self.db.write(self.path, {}, 'delete')
+
+class FakeQuery:
+    # Like Firestore, range filters only match values of the same type, so null expires_at never sorts as expired.
+    _OPERATORS = {'==': lambda a, b: a == b, 'in': lambda a, b: a in b,
+                  '<': lambda a, b: a is not None and a < b, '>': lambda a, b: a is not None and a > b}
+
+    def __init__(self, db: FakeFirestore, path: str, filters: tuple = (), max_results: int = None):
+        self.db = db
+        self.path = path
+        self.filters = filters
+        self.max_results = max_results
+
+    def where(self, field: str, op: str, value):
+        return FakeQuery(self.db, self.path, self.filters + ((field, op, value),), self.max_results)
+
+    def limit(self, count: int):
+        return FakeQuery(self.db, self.path, self.filters, count)
+
+    def get(self) -> list:
+        self.db.calls['query'] += 1
+        prefix = self.path + '/'
+        results = []
+        with self.db.lock:
+            for path, (data, update_time) in self.db.docs.items():
+                if not path.startswith(prefix) or '/' in path[len(prefix):]:
+                    continue
+                if all(field in data and self._OPERATORS[op](data[field], value) for field, op, value in self.filters):
+                    results.append(FakeDocumentSnapshot(FakeDocumentReference(self.db, path), copy.deepcopy(data), update_time))
+                    if self.max_results is not None and len(results) >= self.max_results:
+                        break
+        return results
+
+    stream = get
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, db: FakeFirestore, path: str):
+        super().__init__(db, path)
+
+    def document(self, document_id: str = None):
+        document_id = document_id or ''.join(random.choices(string.ascii_letters + string.digits, k=20))
+        return FakeDocumentReference(self.db, f"{self.path}/{document_id}")
+
+class FakeWriteBatch:
+    def __init__(self, db: FakeFirestore):
+        self.db = db
+        self.writes = []
+
+    def create(self, reference, data: dict) -> None:
+        self.writes.append((reference.path, data, 'create'))
+
+    def set(self, reference, data: dict, merge: bool = False) -> None:
+        self.writes.append((reference.path, data, 'merge' if merge else 'set'))
+
+    def update(self, reference, fields: dict, option=None) -> None:
+        self.writes.append((reference.path, fields, 'update', option))
+
+    def delete(self, reference, option=None) -> None:
+        self.writes.append((reference.path, {}, 'delete', option))
+
+    def commit(self) -> None:
+        from google.api_core.exceptions import AlreadyExists, FailedPrecondition, NotFound
+        self.db.calls['batch'] += 1
+        with self.db.lock:
+            # All-or-nothing like a Firestore batch: preconditions are checked before anything is written.
+            for path, data, mode, *option in self.writes:
+                if option and option[0] is not None and self.db.docs.get(path, (None, None))[1] != option[0]:
+                    raise FailedPrecondition(f"Update time precondition failed: {path}")
+                if mode == 'update' and path not in self.db.docs:
+                    raise NotFound(f"No document to update: {path}")
+                if mode == 'create' and path in self.db.docs:
+                    raise AlreadyExists(f"Document already exists: {path}")
+            for path, data, mode, *option in self.writes:
+                self.db.write(path, data, mode)
+
+class StubGeminiModel:
+    """Streams a canned answer in a few chunks, spread over `latency` seconds."""
+
+    def __init__(self, latency: float = 0.05, chunks: int = 5):
+        self.latency = latency
+        self.chunks = chunks
+
+    def generate_content(self, query: str, stream: bool = False):
+        return self._answer(query)
+
+    def start_chat(self, history: list = None):
+        return types.SimpleNamespace(send_message=lambda query, stream=False: self._answer(query))
+
+    def _answer(self, query: str):
+        for part in range(self.chunks):
+            time.sleep(self.latency / self.chunks)
+            yield types.SimpleNamespace(text=f"Stub answer {part + 1}/{self.chunks} to '{query[:40]}'. ", usage_metadata=None)
+
+@contextlib.contextmanager
+def fake_services(base_url: str, firestore: FakeFirestore = None, model: StubGeminiModel = None):
+    """Points api.index at fakes for the duration: the Bot API and the WhatsApp gateway at a fake server
+    listening on `base_url`, Firestore and Gemini at in-process stand-ins."""
+    firestore = firestore or FakeFirestore()
+    model = model or StubGeminiModel()
+    with contextlib.ExitStack() as stack:
+        for name, value in {
+            'TELEGRAM_API_BASE_URL': f"{base_url}/bot",
+            'SEND_MESSAGE_API_URL': f"{base_url}/send-message",
+            'SEND_MESSAGE_BATCH_URL': None,
+            'get_firestore': lambda: firestore,
+            'get_gemini_model': lambda: model,
+        }.items():
+            stack.enter_context(mock.patch.object(index, name, value))
+        # Collections and the state store are looked up once per process, so they are dropped on the
+        # way in and out to pick up the fake and forget it again.
+        stack.enter_context(mock.patch.object(index.bot_persistence, '_store', None))
+        index.get_collection.cache_clear()
+        stack.callback(index.get_collection.cache_clear)
+        yield firestore
+
+@contextlib.contextmanager
+def without_rate_limits():
+    """Lifts the governor's per-user and per-chat request rates and the Bot API send pacing. A benchmark
+    is a burst from a few users; the rate limits would shed most of it, and the pacing would time the
+    Telegram limits instead of the bot."""
+    with contextlib.ExitStack() as stack:
+        for name in ('GOVERNOR_USER_RATE_PER_MINUTE', 'GOVERNOR_CHAT_RATE_PER_MINUTE', 'TELEGRAM_CHAT_RATE',
+                     'TELEGRAM_GROUP_RATE_PER_MINUTE', 'TELEGRAM_CHAT_BURST'):
+            stack.enter_context(mock.patch.object(index, name, 1e9))
+        stack.enter_context(mock.patch.object(index.send_scheduler, 'global_bucket', index.TokenBucket(1e9, 1e9)))
+        yield
+
+# Serves the fake Bot API on its own, for load tests against a separately started server (see
+# bench/loadtest.py):
+#     python -m bench.fakes [port]
+if __name__ == '__main__':
+    asyncio.run(FakeTelegramAPI().serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8081))
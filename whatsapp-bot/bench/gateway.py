@@ -0,0 +1,87 @@
+# WhatsApp gateway throughput: messages/s delivered by 1, 10 and 100 users at once, one message per
+# send and with SEND_MESSAGE_BATCH_URL batching, against the fake Bot API and gateway. 'client only'
+# calls send_message_via_api directly; 'through the webhook handler' runs whole /sendmsg conversations,
+# three updates per message, so there the handler's own cost per update is part of what is timed.
+# From the whatsapp-bot directory:
+#     python -m bench.gateway [--conversations 20] [--gateway-ms 50] [--gateway-concurrency 4]
+# The governor's 'whatsapp' class limit is lifted along with the rate limits, since it would cap both
+# modes at the same number of sends in flight and time the governor rather than the client. The fake
+# gateway serves --gateway-concurrency requests at a time, which is what batching saves on; a lone
+# sender pays the SEND_MESSAGE_BATCH_WINDOW wait on every message instead.
+import argparse
+import asyncio
+import contextlib
+import time
+from unittest import mock
+
+from api import index
+from bench import message_update, percentile, post_update
+from bench.fakes import FakeTelegramAPI, fake_services, without_rate_limits
+
+async def run_conversations(user_id: int, count: int, latencies: list) -> None:
+    for number in range(count):
+        await post_update(message_update(user_id, '/sendmsg'))
+        await post_update(message_update(user_id, '94712345678'))
+        started = time.perf_counter()
+        await post_update(message_update(user_id, f'Benchmark message {number}'))
+        latencies.append(time.perf_counter() - started)
+
+async def measure(fake_api: FakeTelegramAPI, users: int, conversations: int) -> None:
+    fake_api.gateway_messages = 0
+    latencies = []
+    base = 1_000_000 * users
+    started = time.perf_counter()
+    await asyncio.gather(*(run_conversations(base + user, conversations, latencies) for user in range(users)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{users:>6}{fake_api.gateway_messages:>10}{elapsed:>9.2f}{fake_api.gateway_messages / elapsed:>12.1f}"
+          f"{percentile(latencies, 0.5) * 1000:>11.1f}{percentile(latencies, 0.99) * 1000:>11.1f}")
+
+async def client_sends(number: str, count: int, latencies: list) -> None:
+    for sequence in range(count):
+        started = time.perf_counter()
+        if not await index.send_message_via_api(number, f'Benchmark message {sequence}'):
+            raise RuntimeError(f"send {sequence} to {number} failed")
+        latencies.append(time.perf_counter() - started)
+
+async def measure_client(fake_api: FakeTelegramAPI, users: int, messages: int) -> None:
+    """send_message_via_api alone, without the webhook handler around it."""
+    fake_api.gateway_messages = 0
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(client_sends(f'9471{user:07}', messages, latencies) for user in range(users)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{users:>6}{fake_api.gateway_messages:>10}{elapsed:>9.2f}{fake_api.gateway_messages / elapsed:>12.1f}"
+          f"{percentile(latencies, 0.5) * 1000:>11.1f}{percentile(latencies, 0.99) * 1000:>11.1f}")
+
+async def main(conversations: int, gateway_latency: float, gateway_concurrency: int) -> None:
+    fake_api = FakeTelegramAPI(gateway_latency, gateway_concurrency)
+    server = await asyncio.start_server(fake_api.serve_connection, '127.0.0.1', 0)
+    base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    for mode, batch_url in (('single', None), ('batched', f"{base_url}/send-message/batch")):
+        print(f"{mode} sends, gateway latency {gateway_latency * 1000:.0f} ms, {gateway_concurrency or 'unlimited'} requests at a time")
+        print(f"{'users':>6}{'messages':>10}{'secs':>9}{'messages/s':>12}{'p50 ms':>11}{'p99 ms':>11}")
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(fake_services(base_url))
+            stack.enter_context(without_rate_limits())
+            stack.enter_context(mock.patch.dict(index.GOVERNOR_CLASS_LIMITS, {'whatsapp': 1_000_000}))
+            stack.enter_context(mock.patch.object(index.governor, 'semaphores', {}))
+            for name, value in {'WEBHOOK_MODE': 'inline', 'SEND_MESSAGE_BATCH_URL': batch_url, 'GOVERNOR_MAX_WAITING': 1000}.items():
+                stack.enter_context(mock.patch.object(index, name, value))
+            print('client only')
+            for users in (1, 10, 100):
+                await measure_client(fake_api, users, conversations)
+            print('through the webhook handler')
+            for users in (1, 10, 100):
+                await measure(fake_api, users, conversations)
+            await index.shutdown_application()
+    server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--conversations', type=int, default=20, help='/sendmsg conversations per user')
+    parser.add_argument('--gateway-ms', type=float, default=50, help='fake gateway response time')
+    parser.add_argument('--gateway-concurrency', type=int, default=4, help='requests the fake gateway serves at once, 0 for unlimited')
+    args = parser.parse_args()
+    asyncio.run(main(args.conversations, args.gateway_ms / 1000, args.gateway_concurrency))
@@ -0,0 +1,82 @@
+# Import-time profile of api.index from `python -X importtime`: the module as imported on a cold start,
+# with the SDKs it defers to first use (yt_dlp, firebase_admin, google.generativeai) imported too,
+# which is what a cold start paid before they were deferred, and a cold instance answering its first
+# /start end to end. Each case runs in a fresh interpreter.
+# From the whatsapp-bot directory, with the bytecode cache current so compiling api/index.py isn't timed:
+#     python -m compileall -q api && python -m bench.importtime [--runs 5] [--top 15] > bench/importtime.txt
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# The first /start through the webhook handler against the fake Bot API, served in-process. Firestore
+# is configured (with a key it can't use), so anything on the path that reaches it imports firebase_admin.
+# Only the Application is shut down afterwards: the usage counter stays buffered, as it does across warm
+# invocations, rather than being flushed by shutdown_application(). Prints the handling time in ms.
+FIRST_START = '''
+import asyncio, sys, time
+from unittest import mock
+from api import index
+from bench import message_update, post_update
+from bench.fakes import FakeTelegramAPI
+
+async def main():
+    fake_api = FakeTelegramAPI()
+    server = await asyncio.start_server(fake_api.serve_connection, '127.0.0.1', 0)
+    base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    with mock.patch.object(index, 'TELEGRAM_API_BASE_URL', f"{base_url}/bot"), mock.patch.object(index, 'WEBHOOK_MODE', 'inline'):
+        started = time.perf_counter()
+        await post_update(message_update(1, '/start'))
+        print((time.perf_counter() - started) * 1000, 'firebase_admin' in sys.modules, dict(fake_api.calls))
+        await (await index.get_application()).shutdown()
+    server.close()
+
+asyncio.run(main())
+'''
+
+CASES = {
+    'api.index': 'import api.index',
+    'api.index + deferred SDKs': 'import api.index, yt_dlp, firebase_admin, firebase_admin.firestore, google.generativeai',
+    'first /start end to end': FIRST_START,
+}
+
+def profile(statement: str) -> tuple:
+    """Returns ({module: (self_us, cumulative_us, depth)}, stdout) for one fresh interpreter."""
+    env = dict(os.environ, BOT_TOKEN=os.environ.get('BOT_TOKEN', '123:abc'), FIREBASE_SERVICE_ACCOUNT_KEY='{}')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            env=env, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us), (len(name) - len(name.lstrip())) // 2)
+    return modules, result.stdout
+
+def main(runs: int, top: int) -> None:
+    print(f"Python {sys.version.split()[0]} -X importtime, median of {runs} fresh interpreters")
+    for label, statement in CASES.items():
+        profiles, outputs = zip(*(profile(statement) for _ in range(runs)))
+        total = statistics.median(sum(cumulative for _, cumulative, depth in p.values() if depth == 0) for p in profiles)
+        print(f"\n{label}: {total / 1000:.1f} ms, {len(profiles[0])} modules")
+        if outputs[0].strip():
+            _, firebase_imported, calls = outputs[0].strip().split(' ', 2)
+            handled_ms = statistics.median(float(output.split()[0]) for output in outputs)
+            print(f"handled in {handled_ms:.1f} ms, imports made while handling included; firebase_admin imported: {firebase_imported}; Bot API calls: {calls}")
+        # Self time summed per top-level package, so a package is charged for its own modules however
+        # deep in the import tree they were first pulled in.
+        rows = []
+        for package in {name.split('.')[0] for name in profiles[0]}:
+            times = [sum(self_us for name, (self_us, _, _) in p.items() if name.split('.')[0] == package) for p in profiles]
+            rows.append((statistics.median(times), package))
+        print(f"{'self ms':>9}  package")
+        for self_us, package in sorted(rows, reverse=True)[:top]:
+            print(f"{self_us / 1000:>9.1f}  {package}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per case')
+    parser.add_argument('--top', type=int, default=15, help='packages listed per case')
+    args = parser.parse_args()
+    main(args.runs, args.top)
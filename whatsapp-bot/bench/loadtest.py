@@ -0,0 +1,76 @@
+# Measures webhook throughput against a local fake Bot API instead of Telegram. From the whatsapp-bot
+# directory:
+#     python -m bench.fakes 8081
+#     TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot TELEGRAM_GLOBAL_RATE=1e9 gunicorn -w 4 -k uvicorn.workers.UvicornWorker api.index:app
+#     python -m bench.loadtest 2000 50 http://127.0.0.1:8000/api/index
+# Without a URL, the handler is called directly on a fresh event loop per update, as a cold serverless
+# invocation would, so the two request rates can be compared:
+#     TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot python -m bench.loadtest 2000
+import asyncio
+import json
+import statistics
+import sys
+import time
+import types
+
+import httpx
+
+from api import index
+from bench import percentile
+
+def loadtest_update(update_id: int) -> dict:
+    user_id = 100000 + update_id
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': '/start',
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+def report_loadtest(label: str, latencies: list, elapsed: float, errors: int) -> None:
+    latencies = sorted(latencies)
+    print(f"{label}: {len(latencies)} updates in {elapsed:.2f}s = {len(latencies) / elapsed:.1f} req/s, "
+          f"{errors} errors, p50 {percentile(latencies, 0.5) * 1000:.1f}ms p95 {percentile(latencies, 0.95) * 1000:.1f}ms "
+          f"mean {statistics.mean(latencies) * 1000:.1f}ms")
+
+async def loadtest_server(url: str, total: int, concurrency: int) -> None:
+    latencies, errors = [], 0
+    update_ids = iter(range(1, total + 1))
+    base_id = int(time.time())  # fresh update_ids per run so the deduplicator doesn't drop them
+
+    async def worker(client: httpx.AsyncClient) -> None:
+        nonlocal errors
+        headers = {'X-Telegram-Bot-Api-Secret-Token': index.WEBHOOK_SECRET_TOKEN} if index.WEBHOOK_SECRET_TOKEN else {}
+        for update_id in update_ids:
+            started = time.perf_counter()
+            response = await client.post(url, json=loadtest_update(base_id * 10000 + update_id), headers=headers)
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code != 200
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    report_loadtest(f"ASGI server {url}", latencies, time.perf_counter() - started, errors)
+
+def loadtest_serverless(total: int) -> None:
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for update_id in range(1, total + 1):
+        request = types.SimpleNamespace(method='POST', path='/api/index', headers={},
+                                        body=json.dumps(loadtest_update(update_id)).encode('utf-8'))
+        request_started = time.perf_counter()
+        response = asyncio.run(index.handler(request))
+        latencies.append(time.perf_counter() - request_started)
+        errors += response['statusCode'] != 200
+    report_loadtest("Serverless handler (new event loop per update)", latencies, time.perf_counter() - started, errors)
+
+if __name__ == '__main__':
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    if len(sys.argv) > 3:
+        asyncio.run(loadtest_server(sys.argv[3], total, int(sys.argv[2])))
+    else:
+        loadtest_serverless(total)
@@ -0,0 +1,109 @@
+# PIN allocation: create() attempts per PIN, collisions and failed allocations as the PIN space
+# fills, and allocations/s with create_with_unique_pin on the upload path vs taking from PinPool.
+# Collisions are measured on 3-character PINs (36^3 = 46,656) so the space can be filled in memory;
+# the rates depend only on the fill fraction, which is translated to stored uploads for 6 characters.
+# From the whatsapp-bot directory:
+#     python -m bench.pins [--allocations 200] [--firestore-ms 20]
+import argparse
+import asyncio
+import itertools
+import random
+import string
+import time
+from unittest import mock
+
+from api import index
+from bench.fakes import FakeDocumentReference, FakeFirestore
+
+PIN_CHARACTERS = string.ascii_uppercase + string.digits
+FILL_FRACTIONS = (0.0, 0.5, 0.9, 0.95, 0.99)
+
+def prefilled_firestore(length: int, fill: float) -> FakeFirestore:
+    db = FakeFirestore()
+    space = [''.join(chars) for chars in itertools.product(PIN_CHARACTERS, repeat=length)]
+    for pin in random.sample(space, int(len(space) * fill)):
+        db.docs[f"files/{pin}"] = ({'pin': pin}, 0)
+    return db
+
+async def measure_collisions(fill: float, allocations: int, length: int = 3) -> None:
+    db = prefilled_firestore(length, fill)
+    collection = db.collection('files')
+    generated = 0
+    generate_pin = index.generate_pin
+
+    def counting_generate_pin(length):
+        nonlocal generated
+        generated += 1
+        return generate_pin(length)
+
+    failures = 0
+    with mock.patch.object(index, 'generate_pin', counting_generate_pin):
+        for _ in range(allocations):
+            try:
+                await index.create_with_unique_pin(collection, {}, length)
+            except RuntimeError:
+                failures += 1
+    attempts = generated / allocations
+    uploads = int(fill * len(PIN_CHARACTERS) ** 6)
+    print(f"{fill:>6.2f}{uploads:>15,}{attempts:>10.2f}{1 / (1 - fill):>10.2f}"
+          f"{generated - allocations + failures:>12}{failures / allocations:>10.4f}{fill ** index.PIN_MAX_ATTEMPTS:>10.4f}")
+
+async def measure_rate(allocations: int, concurrency: int) -> None:
+    collection = FakeFirestore().collection('files')
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def allocate():
+        async with semaphore:
+            started = time.perf_counter()
+            await index.create_with_unique_pin(collection, {})
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(allocate() for _ in range(allocations)))
+    elapsed = time.perf_counter() - started
+    print(f"{'direct':>8}{concurrency:>13}{allocations / elapsed:>15.1f}{sum(latencies) / len(latencies) * 1000:>17.2f}")
+
+async def measure_pool(allocations: int) -> None:
+    db = FakeFirestore()
+    pool = index.PinPool(allocations)
+    with mock.patch.object(index, 'get_collection', db.collection):
+        started = time.perf_counter()
+        await pool.refill()
+        elapsed = time.perf_counter() - started
+        # Only take() is timed here, so the background refill it would start is held off.
+        pool._refilling = True
+        taken = []
+        take_started = time.perf_counter()
+        while (pin := pool.take()) is not None:
+            taken.append(pin)
+        take_elapsed = time.perf_counter() - take_started
+    print(f"{'refill':>8}{allocations:>13}{allocations / elapsed:>15.1f}{'':>17}")
+    print(f"{'take':>8}{'-':>13}{len(taken) / take_elapsed:>15.0f}{take_elapsed / len(taken) * 1000:>17.4f}")
+
+async def main(allocations: int, firestore_latency: float) -> None:
+    print(f"Collisions: {allocations} allocations per row on 3-character PINs, "
+          f"{index.PIN_MAX_ATTEMPTS} attempts before an upload fails")
+    print(f"{'fill':>6}{'6-char uploads':>15}{'attempts':>10}{'1/(1-f)':>10}{'collisions':>12}{'failed':>10}{'f^max':>10}")
+    for fill in FILL_FRACTIONS:
+        await measure_collisions(fill, allocations)
+
+    create = FakeDocumentReference.create
+
+    def slow_create(self, data):
+        time.sleep(firestore_latency)
+        return create(self, data)
+
+    print(f"\nAllocation rate with a {firestore_latency * 1000:.0f} ms Firestore create(), 6-character PINs")
+    print(f"{'path':>8}{'concurrency':>13}{'allocations/s':>15}{'upload wait ms':>17}")
+    with mock.patch.object(FakeDocumentReference, 'create', slow_create):
+        for concurrency in (1, 10):
+            await measure_rate(allocations, concurrency)
+        await measure_pool(allocations)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--allocations', type=int, default=200, help='allocations per measurement')
+    parser.add_argument('--firestore-ms', type=float, default=20, help='fake Firestore create() latency')
+    args = parser.parse_args()
+    asyncio.run(main(args.allocations, args.firestore_ms / 1000))
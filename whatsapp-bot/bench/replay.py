@@ -0,0 +1,86 @@
+# Replays recorded updates (see RECORD_UPDATES_PATH) through the webhook handler with every external
+# service faked in-process, and reports latency and peak memory per command. From the whatsapp-bot
+# directory:
+#     python -m bench.replay updates.jsonl [repeat]
+# The corpus is one Update JSON object per line (or a JSON array); '{fake_api}' in message text is
+# replaced by the fake server's base URL, e.g. '{fake_api}/bytes/1048576' for /download_url.
+import asyncio
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+import types
+from unittest import mock
+
+from api import index
+from bench import percentile
+from bench.fakes import FakeTelegramAPI, fake_services, without_rate_limits
+
+def load_replay_corpus(path: str) -> list:
+    with open(path, encoding='utf-8') as corpus:
+        text = corpus.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+def replay_command(update_data: dict, last_commands: dict) -> str:
+    """Names the command an update belongs to: its own /command, or the chat's last one for replies."""
+    message = update_data.get('message') or update_data.get('edited_message') or {}
+    chat_id = (message.get('chat') or {}).get('id')
+    text = message.get('text') or ''
+    if text.startswith('/'):
+        last_commands[chat_id] = text.split()[0].split('@')[0]
+        return last_commands[chat_id]
+    kind = 'text' if text else next((key for key in ('document', 'photo', 'video', 'audio') if key in message), 'other')
+    return f"{last_commands.get(chat_id, '(none)')} {kind}"
+
+async def replay_updates(path: str, repeat: int = 1) -> None:
+    fake_api = FakeTelegramAPI()
+    server = await asyncio.start_server(fake_api.serve_connection, '127.0.0.1', 0)
+    fake_base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    corpus = [json.loads(json.dumps(update).replace('{fake_api}', fake_base_url)) for update in load_replay_corpus(path)]
+    users = {(update.get('message') or {}).get('from', {}).get('id') for update in corpus}
+
+    samples = {}  # command -> [(seconds, peak bytes, failed)]
+    last_commands = {}
+    update_id = 0
+    with contextlib.ExitStack() as stack:
+        fake_firestore = stack.enter_context(fake_services(fake_base_url))
+        stack.enter_context(without_rate_limits())
+        stack.enter_context(mock.patch.object(index, 'WEBHOOK_MODE', 'inline'))
+        # so recorded /broadcast updates are replayed rather than refused
+        stack.enter_context(mock.patch.object(index, 'BROADCAST_ADMIN_IDS', index.BROADCAST_ADMIN_IDS | users))
+        tracemalloc.start()
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for update_data in corpus:
+                update_id += 1
+                request = types.SimpleNamespace(method='POST', path='/api/index', headers={},
+                                                body=json.dumps(dict(update_data, update_id=update_id)).encode('utf-8'))
+                command = replay_command(update_data, last_commands)
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                request_started = time.perf_counter()
+                response = await index.handler(request)
+                seconds = time.perf_counter() - request_started
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                samples.setdefault(command, []).append((seconds, peak, response['statusCode'] != 200))
+        elapsed = time.perf_counter() - started
+        tracemalloc.stop()
+        await index.shutdown_application()
+    server.close()
+
+    print(f"Replayed {update_id} updates in {elapsed:.2f}s = {update_id / elapsed:.1f} updates/s (tracemalloc on)")
+    print(f"{'command':<28}{'count':>7}{'upd/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak KiB':>10}{'errors':>8}")
+    for command, results in sorted(samples.items()):
+        latencies = sorted(seconds for seconds, _, _ in results)
+        print(f"{command:<28}{len(results):>7}{len(results) / sum(latencies):>9.1f}"
+              f"{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.95) * 1000:>9.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>9.1f}{max(peak for _, peak, _ in results) / 1024:>10.1f}"
+              f"{sum(failed for _, _, failed in results):>8}")
+    print(f"Fake service calls: {dict(fake_api.calls)}")
+    print(f"Fake Firestore round-trips: {sum(fake_firestore.calls.values())} {dict(fake_firestore.calls)}")
+
+if __name__ == '__main__':
+    asyncio.run(replay_updates(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1))
@@ -0,0 +1,91 @@
+# Peak RSS per /get_file retrieval: the current path, which re-sends the stored file_id, against the
+# one it replaced, which downloaded the file with getFile and uploaded it again with send_document.
+# Each retrieval runs through the webhook handler in a fresh interpreter, against a fake Bot API in
+# another process so its buffers don't count. From the whatsapp-bot directory:
+#     python -m bench.retrieval [--sizes-mb 1 10 20 50]
+import argparse
+import asyncio
+import contextlib
+import resource
+import socket
+import subprocess
+import sys
+import time
+from unittest import mock
+
+from api import index
+from bench import message_update, post_update
+from bench.fakes import fake_services, without_rate_limits
+
+MB = 1024 * 1024
+
+async def download_and_resend(bot, chat_id: int, file_metadata: dict) -> None:
+    """The retrieval path before file_ids were re-sent: the whole file in memory, then copied again."""
+    file_name = file_metadata.get('file_name', 'downloaded_file')
+    file_info = await bot.get_file(file_metadata['file_id'])
+    downloaded_bytes = await file_info.download_as_bytearray()
+    await bot.send_document(chat_id=chat_id, document=bytes(downloaded_bytes), filename=file_name,
+                            caption=f"ඔබගේ file එක: {file_name}")
+
+def stored_file(size: int) -> dict:
+    return {'file_id': f'bench-file-{size}', 'file_type': 'document', 'file_name': 'bench.bin',
+            'file_size': size, 'expires_at': None, 'max_downloads': None, 'downloads': 0}
+
+def peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kilobytes on Linux
+
+async def retrieve(pin: str, user_id: int) -> None:
+    await post_update(message_update(user_id, '/get_file'))
+    await post_update(message_update(user_id, pin))
+
+async def child(base_url: str, path: str, size: int) -> None:
+    """One retrieval after a warm-up, reporting how far it raised the process's peak RSS."""
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(fake_services(base_url))
+        stack.enter_context(without_rate_limits())
+        stack.enter_context(mock.patch.object(index, 'WEBHOOK_MODE', 'inline'))
+        if path == 'download':
+            stack.enter_context(mock.patch.object(index, 'send_stored_file', download_and_resend))
+        index.get_collection('files').document('WARMUP').set(stored_file(1024))
+        index.get_collection('files').document('BENCH1').set(stored_file(size))
+        await retrieve('WARMUP', 1)
+        before = peak_rss()
+        started = time.perf_counter()
+        await retrieve('BENCH1', 2)
+        elapsed = time.perf_counter() - started
+        print(peak_rss() - before, elapsed)
+        await index.shutdown_application()
+
+def run_child(base_url: str, path: str, size: int) -> tuple:
+    result = subprocess.run([sys.executable, '-m', 'bench.retrieval', '--child', base_url, path, str(size)],
+                            capture_output=True, text=True, check=True)
+    rss_growth, elapsed = result.stdout.split()[-2:]
+    return int(rss_growth), float(elapsed)
+
+def main(sizes_mb: list) -> None:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen([sys.executable, '-m', 'bench.fakes', str(port)], stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+                break
+            time.sleep(0.05)
+        base_url = f"http://127.0.0.1:{port}"
+        print(f"{'file MB':>8}{'path':>10}{'peak RSS +MB':>14}{'secs':>8}")
+        for size_mb in sizes_mb:
+            for path in ('download', 'file_id'):
+                rss_growth, elapsed = run_child(base_url, path, int(size_mb * MB))
+                print(f"{size_mb:>8g}{path:>10}{rss_growth / MB:>14.1f}{elapsed:>8.2f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        asyncio.run(child(sys.argv[2], sys.argv[3], int(sys.argv[4])))
+    else:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 10, 20, 50], help='stored file sizes')
+        main(parser.parse_args().sizes_mb)
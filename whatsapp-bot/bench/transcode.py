@@ -0,0 +1,52 @@
+# Encode time against output size for the x264 presets, plus a stream-copy split, on sample clips. From
+# the whatsapp-bot directory:
+#     python -m bench.transcode clip.mp4 [clip2.mkv ...] [--target-mb 50]
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from api import index
+
+async def transcode_benchmark(paths: list, target_size: int) -> None:
+    presets = ('ultrafast', 'superfast', 'veryfast', 'faster', 'medium')
+    print(f"{'clip':<24}{'in MB':>8}{'secs':>7}  {'mode':<10}{'out MB':>8}{'encode s':>10}{'x realtime':>12}")
+    for path in paths:
+        probe = await index.transcoder.probe(path)
+        duration = probe['duration']
+        if not duration:
+            print(f"{os.path.basename(path)[:23]:<24} not readable by ffmpeg")
+            continue
+        label = f"{os.path.basename(path)[:23]:<24}{os.path.getsize(path) / (1024*1024):>8.1f}{duration:>7.0f}  "
+        work_dir = tempfile.mkdtemp()
+        try:
+            for preset in presets + ('split',):
+                started = time.perf_counter()
+                try:
+                    if preset == 'split':
+                        outputs = await index.transcoder.split(path, 'bench', work_dir, duration, target_size)
+                    else:
+                        output = os.path.join(work_dir, f"bench.{preset}{'.mp4' if probe['video'] else '.m4a'}")
+                        outputs = [await index.transcoder.encode(path, output, duration, target_size, probe['video'], preset)]
+                except index.TranscodeError as e:
+                    print(f"{label}{preset:<10} failed: {e}")
+                    continue
+                elapsed = time.perf_counter() - started
+                size = sum(os.path.getsize(output) for output in outputs)
+                mode = f"{preset}/{len(outputs)}" if preset == 'split' else preset
+                print(f"{label}{mode:<10}{size / (1024*1024):>8.1f}{elapsed:>10.2f}{duration / elapsed:>12.1f}")
+                for output in outputs:
+                    os.remove(output)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    paths = sys.argv[1:]
+    target_size = index.MAX_UPLOAD_SIZE
+    if '--target-mb' in paths:
+        position = paths.index('--target-mb')
+        target_size = int(float(paths[position + 1]) * 1024 * 1024)
+        del paths[position:position + 2]
+    asyncio.run(transcode_benchmark(paths, target_size))
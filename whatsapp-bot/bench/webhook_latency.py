@@ -0,0 +1,73 @@
+# Webhook latency for light updates (/start) while YouTube downloads are requested at the same time:
+# none, 5 run inline in the webhook process, and 5 queued for the yt-worker (YT_JOB_QUEUE), plus how
+# long the webhook request carrying each download's URL takes. The
+# downloader is a stub that keeps a thread busy in Python code for --download-secs, as yt-dlp's
+# extraction and merge do, so it contends for the GIL like the real one. From the whatsapp-bot
+# directory:
+#     python -m bench.webhook_latency [--updates 200] [--download-secs 5]
+import argparse
+import asyncio
+import contextlib
+import time
+from unittest import mock
+
+from api import index
+from bench import message_update, percentile, post_update
+from bench.fakes import FakeTelegramAPI, fake_services, without_rate_limits
+
+YT_JOBS = 5
+
+def busy(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+async def measure_start_updates(count: int, latencies: list) -> None:
+    for number in range(count):
+        started = time.perf_counter()
+        await post_update(message_update(2_000_000 + number % 50, '/start'))
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.005)
+
+async def request_download(user_id: int, latencies: list) -> None:
+    await post_update(message_update(user_id, '/yt_download'))
+    started = time.perf_counter()
+    await post_update(message_update(user_id, 'https://youtu.be/dQw4w9WgXcQ'))
+    latencies.append(time.perf_counter() - started)
+
+async def scenario(label: str, updates: int, jobs: int, queued: bool, download_secs: float) -> None:
+    async def stub_download(yt_url, chat_id, bot, cache_key=None, audio_only=False):
+        await asyncio.to_thread(busy, download_secs)
+
+    latencies, download_latencies = [], []
+    with mock.patch.object(index, 'YT_JOB_QUEUE', queued), mock.patch.object(index, 'download_youtube_video', stub_download):
+        await asyncio.gather(measure_start_updates(updates, latencies),
+                             *(request_download(3_000_000 + job, download_latencies) for job in range(jobs)))
+    latencies.sort()
+    slowest_download = f"{max(download_latencies) * 1000:.1f}" if download_latencies else '-'
+    print(f"{label:<28}{len(latencies):>8}{percentile(latencies, 0.5) * 1000:>9.1f}"
+          f"{percentile(latencies, 0.95) * 1000:>9.1f}{percentile(latencies, 0.99) * 1000:>9.1f}{slowest_download:>13}")
+
+async def main(updates: int, download_secs: float) -> None:
+    fake_api = FakeTelegramAPI()
+    server = await asyncio.start_server(fake_api.serve_connection, '127.0.0.1', 0)
+    base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(fake_services(base_url))
+        stack.enter_context(without_rate_limits())
+        stack.enter_context(mock.patch.object(index, 'WEBHOOK_MODE', 'inline'))
+        # Every download gets a slot, as it would on an instance sized for them.
+        stack.enter_context(mock.patch.dict(index.GOVERNOR_CLASS_LIMITS, youtube=YT_JOBS))
+        print(f"{'/start latency with':<28}{'updates':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'URL req ms':>13}")
+        await scenario('no YouTube jobs', updates, 0, False, download_secs)
+        await scenario(f'{YT_JOBS} inline YouTube jobs', updates, YT_JOBS, False, download_secs)
+        await scenario(f'{YT_JOBS} queued YouTube jobs', updates, YT_JOBS, True, download_secs)
+        await index.shutdown_application()
+    server.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=200, help='/start updates per scenario')
+    parser.add_argument('--download-secs', type=float, default=5, help='CPU time of each stubbed download')
+    args = parser.parse_args()
+    asyncio.run(main(args.updates, args.download_secs))
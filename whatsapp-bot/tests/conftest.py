@@ -0,0 +1,22 @@
+# api.index reads BOT_TOKEN at import and is imported as `api.index` from the whatsapp-bot directory,
+# the same way the bench package uses it.
+import os
+import sys
+
+os.environ.setdefault('BOT_TOKEN', '123:abc')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def firestore():
+    """Points api.index at an in-process FakeFirestore for one test."""
+    from unittest import mock
+
+    from api import index
+    from bench.fakes import FakeFirestore
+    db = FakeFirestore()
+    with mock.patch.object(index, 'get_firestore', lambda: db), mock.patch.object(index.bot_persistence, '_store', None):
+        index.get_collection.cache_clear()
+        yield db
+    index.get_collection.cache_clear()
@@ -0,0 +1,39 @@
+import asyncio
+import types
+from unittest import mock
+
+from api import index
+
+def test_split_message_text_keeps_short_text_whole():
+    assert index.split_message_text('hello', limit=10) == ('hello', '')
+
+def test_split_message_text_prefers_paragraph_then_line_then_word_boundaries():
+    assert index.split_message_text('aaaa bbbb\n\ncccc dddd', limit=15) == ('aaaa bbbb', 'cccc dddd')
+    assert index.split_message_text('aaaa bbbb\ncccc dddd', limit=15) == ('aaaa bbbb', 'cccc dddd')
+    assert index.split_message_text('aaaa bbbb cccc dddd', limit=15) == ('aaaa bbbb cccc', 'dddd')
+
+def test_split_message_text_cuts_hard_without_a_boundary_in_the_second_half():
+    assert index.split_message_text('a ' + 'b' * 20, limit=10) == ('a ' + 'b' * 8, 'b' * 12)
+
+def test_split_message_text_parts_fit_the_limit():
+    text = ' '.join(f'word{number}' for number in range(3000))
+    parts = []
+    while text:
+        head, text = index.split_message_text(text)
+        parts.append(head)
+    assert all(len(part) <= index.TELEGRAM_MESSAGE_LIMIT for part in parts)
+    assert ' '.join(parts) == ' '.join(f'word{number}' for number in range(3000))
+
+def test_cached_answer_latency_is_recorded_at_the_first_part(monkeypatch):
+    monkeypatch.setattr(index, 'ai_first_token_latencies', index.deque(maxlen=10))
+    recorded_when_sent = []
+
+    async def reply_text(text):
+        recorded_when_sent.append(len(index.ai_first_token_latencies))
+
+    update = types.SimpleNamespace(message=types.SimpleNamespace(reply_text=mock.AsyncMock(side_effect=reply_text)))
+    started = index.time.monotonic() - 2
+    asyncio.run(index.send_ai_reply(update, 'word ' * 2000, started))
+    assert recorded_when_sent == [0, 1, 1]
+    assert len(index.ai_first_token_latencies) == 1
+    assert index.ai_first_token_latencies[0] >= 2
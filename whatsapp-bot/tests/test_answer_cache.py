@@ -0,0 +1,68 @@
+import asyncio
+from unittest import mock
+
+from api import index
+
+class FakeGemini:
+    """Stands in for generate_gemini_stream: answers in two chunks, holding the first until `release`."""
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self, query: str, usage: dict, history: list = None):
+        self.calls += 1
+        yield f'Answer to {query}.'
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError('quota exceeded')
+        usage['tokens'] = 10
+        yield ' The end.'
+
+def run(scenario, gemini):
+    with mock.patch.object(index, 'generate_gemini_stream', gemini), \
+            mock.patch.object(index, 'get_gemini_model', lambda: object()), \
+            mock.patch.object(index, 'answer_cache', index.AnswerCache(similarity=0)):
+        asyncio.run(scenario())
+
+def test_identical_queries_in_flight_share_one_gemini_call(firestore):
+    gemini = FakeGemini()
+
+    async def scenario():
+        first = asyncio.ensure_future(index.ask_gemini_ai('What is Python?'))
+        second = asyncio.ensure_future(index.ask_gemini_ai('  what is   PYTHON? '))
+        await asyncio.sleep(0.01)
+        gemini.release.set()
+        assert await first == await second == 'Answer to What is Python?. The end.'
+        assert gemini.calls == 1
+        stats = index.answer_cache.stats()
+        assert stats['misses'] == 1 and stats['coalesced'] == 1 and stats['saved_tokens'] == 10
+
+        # Answered afterwards from the cache, and on another instance from Firestore.
+        assert await index.ask_gemini_ai('what is python?') == 'Answer to What is Python?. The end.'
+        await asyncio.gather(*index.answer_cache._tasks)  # the answer is stored after its readers are done
+        index.answer_cache.memory = index.LRUCache(10, index.AI_CACHE_TTL)
+        assert await index.ask_gemini_ai('What is Python?') == 'Answer to What is Python?. The end.'
+        assert gemini.calls == 1
+        assert index.answer_cache.stats()['remote_hits'] == 1
+
+    run(scenario, gemini)
+
+def test_failed_answer_reaches_every_reader_and_is_not_cached(firestore):
+    gemini = FakeGemini(fail=True)
+
+    async def scenario():
+        readers = [asyncio.ensure_future(index.ask_gemini_ai('What is Python?')) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        gemini.release.set()
+        for answer in await asyncio.gather(*readers):
+            assert answer == f'Answer to What is Python?.\n\n{index.AI_ERROR_TEXT}'
+        await asyncio.gather(*index.answer_cache._tasks)
+        assert not firestore.docs
+
+        gemini.fail = False
+        assert await index.ask_gemini_ai('What is Python?') == 'Answer to What is Python?. The end.'
+        assert gemini.calls == 2
+
+    run(scenario, gemini)
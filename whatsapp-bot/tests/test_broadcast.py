@@ -0,0 +1,114 @@
+import asyncio
+import json
+import types
+from unittest import mock
+
+import pytest
+
+from api import index
+
+@pytest.fixture
+def queues(tmp_path, monkeypatch):
+    """Local broadcast store and job queue, an unlimited send rate, a stub bot, and the WhatsApp numbers
+    sent to in `sent`."""
+    store = index.SqliteBroadcastStore(str(tmp_path / 'broadcasts.db'))
+    jobs = index.SqliteJobQueue(str(tmp_path / 'jobs.db'))
+    bot = mock.AsyncMock()
+    sent = []
+
+    async def send_message_via_api(number, text):
+        sent.append(number)
+        return True
+
+    monkeypatch.setattr(index, '_broadcast_store', store)
+    monkeypatch.setattr(index, '_job_queue', jobs)
+    monkeypatch.setattr(index, '_broadcast_bucket', index.TokenBucket(1e9, 1e9))
+    monkeypatch.setattr(index, 'send_message_via_api', send_message_via_api)
+    monkeypatch.setattr(index, 'get_application', mock.AsyncMock(return_value=types.SimpleNamespace(bot=bot)))
+    return types.SimpleNamespace(store=store, jobs=jobs, bot=bot, sent=sent)
+
+async def queue_broadcast(queues, numbers: list) -> str:
+    broadcast_id = await queues.store.create_job(1, 'Hello {number}', [{'number': number} for number in numbers])
+    await queues.jobs.enqueue('broadcast', {'broadcast_id': broadcast_id, 'chat_id': 1, 'message_id': 1})
+    return broadcast_id
+
+def test_token_bucket_refills_at_its_rate(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(index.time, 'monotonic', lambda: now[0])
+    bucket = index.TokenBucket(rate=10, capacity=2)
+    assert bucket.try_acquire() and bucket.try_acquire()
+    assert not bucket.try_acquire()
+    assert bucket.wait_time() == pytest.approx(0.1)
+    now[0] += 0.05
+    assert not bucket.try_acquire()
+    now[0] += 0.06
+    assert bucket.try_acquire()
+    now[0] += 60
+    assert bucket.wait_time(2) == 0.0
+    assert bucket.try_acquire(2) and not bucket.try_acquire()
+
+def test_parse_broadcast_recipients_from_a_number_list():
+    text = '+94 71 234 5678\n94712345678, 0771234567\n\nnot-a-number 123'
+    assert index.parse_broadcast_recipients(text) == [{'number': '94712345678'}, {'number': '0771234567'}]
+
+def test_parse_broadcast_recipients_from_a_csv_with_a_header():
+    text = 'Name,Number,City\nNimal,+94712345678,Kandy\nBad,123,Galle\nShort\nSaman,94770000000,Colombo\n'
+    assert index.parse_broadcast_recipients(text) == [
+        {'name': 'Nimal', 'number': '94712345678', 'city': 'Kandy'},
+        {'name': 'Saman', 'number': '94770000000', 'city': 'Colombo'},
+    ]
+
+def test_interrupted_broadcast_resumes_without_sending_twice(queues, monkeypatch):
+    async def scenario():
+        numbers = [f'9471000000{number}' for number in range(6)]
+        broadcast_id = await queue_broadcast(queues, numbers)
+        # A drain that died after two sends, while two more were in flight
+        claimed = [recipient['number'] for recipient in await queues.store.claim(broadcast_id, 4)]
+        for number in claimed[:2]:
+            await queues.store.finish(broadcast_id, number, 'sent')
+        monkeypatch.setattr(index, 'BROADCAST_LEASE_SECONDS', 0)
+
+        assert await index.drain_broadcast_jobs(5) == 1
+        assert sorted(queues.sent) == sorted(set(numbers) - set(claimed))
+        broadcast = await queues.store.get_job(broadcast_id)
+        assert (broadcast['sent'], broadcast['failed']) == (4, 2)
+        assert sorted(await queues.store.failures(broadcast_id)) == sorted((number, 'interrupted') for number in claimed[2:])
+        queues.bot.send_message.assert_awaited_once()
+        assert await index.drain_broadcast_jobs(5) == 0
+
+    asyncio.run(scenario())
+
+def test_broadcast_held_by_another_drain_waits_for_its_lease(queues, monkeypatch):
+    async def scenario():
+        broadcast_id = await queue_broadcast(queues, ['94710000000', '94710000001'])
+        await queues.store.claim(broadcast_id, 2)
+
+        assert await index.drain_broadcast_jobs(5) == 1
+        (status, available_at), = queues.jobs.conn.execute("SELECT status, available_at FROM jobs WHERE status != 'done'").fetchall()
+        assert status == 'waiting'
+        assert available_at == pytest.approx(index.time.time() + index.BROADCAST_LEASE_SECONDS, abs=5)
+        assert await index.drain_broadcast_jobs(5) == 0
+
+        now = index.time.time() + index.BROADCAST_LEASE_SECONDS + 1
+        monkeypatch.setattr(index.time, 'time', lambda: now)
+        assert await index.drain_broadcast_jobs(5) == 1
+        assert queues.sent == []
+        broadcast = await queues.store.get_job(broadcast_id)
+        assert (broadcast['sent'], broadcast['failed']) == (0, 2)
+        queues.bot.send_message.assert_awaited_once()
+
+    asyncio.run(scenario())
+
+def test_broadcast_cron_requires_the_cron_secret(queues, monkeypatch):
+    def get(authorization: str = None) -> dict:
+        headers = {'Authorization': authorization} if authorization else {}
+        request = types.SimpleNamespace(method='GET', path='/api/broadcasts', headers=headers, body=b'')
+        return asyncio.run(index.handler(request))
+
+    monkeypatch.setattr(index, 'CRON_SECRET', None)
+    assert get()['statusCode'] == 403
+    monkeypatch.setattr(index, 'CRON_SECRET', 'cron')
+    assert get('Bearer wrong')['statusCode'] == 403
+    response = get('Bearer cron')
+    assert response['statusCode'] == 200
+    assert json.loads(response['body'])['broadcast_jobs'] == 0
@@ -0,0 +1,52 @@
+import asyncio
+import json
+import types
+from unittest import mock
+
+from api import index
+
+def post(update_data: dict) -> dict:
+    request = types.SimpleNamespace(method='POST', path='/api/index', headers={},
+                                    body=json.dumps(update_data).encode('utf-8'))
+    return asyncio.run(index.handler(request))
+
+def test_retry_is_dropped_on_this_and_other_instances(firestore):
+    async def scenario():
+        instance, other_instance = index.UpdateDeduplicator(), index.UpdateDeduplicator()
+        assert await instance.first_seen(101)
+        assert not await instance.first_seen(101)
+        assert not await other_instance.first_seen(101)
+        assert instance.duplicates == other_instance.duplicates == 1
+
+    asyncio.run(scenario())
+
+def test_forgotten_update_is_processed_again(firestore):
+    async def scenario():
+        instance, other_instance = index.UpdateDeduplicator(), index.UpdateDeduplicator()
+        assert await instance.first_seen(102)
+        await instance.forget(102)
+        assert await other_instance.first_seen(102)
+
+    asyncio.run(scenario())
+
+def test_updates_without_stored_state_are_remembered_in_memory_only(firestore):
+    async def scenario():
+        deduplicator = index.UpdateDeduplicator()
+        assert await deduplicator.first_seen(103, durable=False)
+        assert not await deduplicator.first_seen(103, durable=False)
+        await deduplicator.forget(103)
+        assert not firestore.calls
+
+    asyncio.run(scenario())
+
+def test_failed_update_is_processed_on_retry_and_then_dropped(firestore):
+    update_data = {'update_id': 104, 'message': {'message_id': 1, 'date': 0, 'text': 'hi', 'chat': {'id': 9, 'type': 'private'}}}
+    process = mock.AsyncMock(side_effect=[RuntimeError('Bot API unavailable'), None])
+    with mock.patch.object(index, 'update_deduplicator', index.UpdateDeduplicator()), \
+            mock.patch.object(index, 'reaches_stored_state', mock.AsyncMock(return_value=True)), \
+            mock.patch.object(index, 'process_telegram_update', process), \
+            mock.patch.object(index, 'WEBHOOK_MODE', 'inline'):
+        assert post(update_data)['statusCode'] == 500
+        assert post(update_data)['statusCode'] == 200
+        assert json.loads(post(update_data)['body']) == {'status': 'duplicate'}
+    assert process.await_count == 2
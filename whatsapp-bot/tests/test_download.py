@@ -0,0 +1,152 @@
+import asyncio
+import base64
+import hashlib
+import re
+import types
+from unittest import mock
+
+import httpx
+import pytest
+
+from api import index
+
+# Big enough that a dropped quarter of a range spans whole 64 KiB reads, which is what gets written.
+DATA = bytes(range(256)) * 4096  # 1 MiB
+
+def md5_of(data: bytes) -> str:
+    return base64.b64encode(hashlib.md5(data).digest()).decode()
+
+class DroppedBody(httpx.AsyncByteStream):
+    """A response body whose connection drops after `sent` bytes."""
+
+    def __init__(self, data: bytes, sent: int):
+        self.data = data
+        self.sent = sent
+
+    async def __aiter__(self):
+        yield self.data[:self.sent]
+        raise httpx.ReadError('connection reset by peer')
+
+class Origin:
+    """Serves DATA with Range support. With `drop`, the first answer for each range drops a quarter of
+    the way through; with `changes`, the file is replaced when that happens, so an If-Range request
+    gets the whole new file with a 200."""
+
+    def __init__(self, data: bytes = DATA, md5: str = None, drop: bool = True, changes: bool = False):
+        self.data = data
+        self.md5 = md5 or md5_of(data)
+        self.drop = drop
+        self.changes = changes
+        self.changed = False
+        self.ranges = []
+        self.resumes = set()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers['range']).groups()
+        start, end = int(start), int(end or len(self.data) - 1)
+        self.ranges.append((start, end, request.headers.get('if-range')))
+        headers = {'etag': '"v1"', 'x-goog-hash': f'crc32c=AAAAAA==,md5={self.md5}'}
+        if self.changed and request.headers.get('if-range'):
+            return httpx.Response(200, headers=headers, content=b'new' + self.data)
+        body = self.data[start:end + 1]
+        headers['content-range'] = f'bytes {start}-{end}/{len(self.data)}'
+        if self.drop and start not in self.resumes:
+            self.resumes.add(start + len(body) // 4)
+            self.changed = self.changes
+            return httpx.Response(206, headers=headers, stream=DroppedBody(body, len(body) // 4))
+        return httpx.Response(206, headers=headers, content=body)
+
+def run_download(origin, tmp_path, connections: int = 2):
+    """Downloads through download_ranges() from `origin`, returning the MD5 and the file's bytes."""
+    async def scenario():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(origin))
+        with mock.patch.object(index, 'get_http_client', lambda: client), \
+                mock.patch.object(index, '_retry_delay', lambda failures: 0):
+            probe = await client.send(client.build_request('GET', 'https://files.example/a.bin', headers={'Range': 'bytes=0-'}), stream=True)
+            progress = index.DownloadProgress(mock.Mock(), len(origin.data))
+            path = str(tmp_path / 'a.bin')
+            md5 = await index.download_ranges('https://files.example/a.bin', probe, len(origin.data), progress, path)
+        await client.aclose()
+        with open(path, 'rb') as f:
+            return md5, f.read()
+
+    with mock.patch.object(index, 'DOWNLOAD_PARALLEL_CONNECTIONS', connections), \
+            mock.patch.object(index, 'DOWNLOAD_PARALLEL_MIN_SIZE', 0):
+        return asyncio.run(scenario())
+
+def test_dropped_ranges_resume_from_the_last_byte_received(tmp_path):
+    origin = Origin()
+    md5, data = run_download(origin, tmp_path)
+    assert data == DATA and md5 == md5_of(DATA)
+    # The probe serves the first range; each range is asked for again from where its connection
+    # dropped, on condition that the file is unchanged.
+    size, half = len(DATA), len(DATA) // 2
+    assert sorted(origin.ranges) == [(0, size - 1, None), (size // 4, half - 1, '"v1"'),
+                                     (half, size - 1, '"v1"'), (half + half // 4, size - 1, '"v1"')]
+
+def test_file_changed_between_ranges_fails_the_download(tmp_path):
+    origin = Origin(changes=True)
+    with pytest.raises(index.DownloadIntegrityError):
+        run_download(origin, tmp_path)
+
+class FakeBot:
+    def __init__(self):
+        self.documents = []
+
+    async def send_document(self, chat_id, document, filename, caption):
+        self.documents.append((document, filename))
+        return types.SimpleNamespace(document=types.SimpleNamespace(file_id='fake-file'), video=None, audio=None, animation=None)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.documents.append(('message', text))
+        return types.SimpleNamespace(edit_text=mock.AsyncMock())
+
+def download_url(handler, url: str = 'https://files.example/a.bin') -> tuple:
+    """Runs download_file_from_url() against `handler`, returning what the bot sent and the work dirs made."""
+    bot = FakeBot()
+    mkdtemp = mock.Mock(wraps=index.tempfile.mkdtemp)
+
+    async def scenario():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch.object(index, 'get_http_client', lambda: client), \
+                mock.patch.object(index.tempfile, 'mkdtemp', mkdtemp), \
+                mock.patch.object(index, 'download_cache', index.DownloadCache()):
+            await index.download_file_from_url(url, 1, types.SimpleNamespace(bot=bot))
+        await client.aclose()
+
+    asyncio.run(scenario())
+    return bot.documents, mkdtemp.call_count
+
+def test_unranged_download_is_uploaded_from_memory(firestore):
+    sent, work_dirs = download_url(lambda request: httpx.Response(200, content=DATA, headers={'content-md5': md5_of(DATA)}))
+    assert sent == [(DATA, 'a.bin')]
+    assert work_dirs == 0
+
+def test_ranged_download_is_resumed_on_disk(firestore):
+    sent, work_dirs = download_url(Origin())
+    assert work_dirs == 1
+    [(document, filename)] = [item for item in sent if item[0] != 'message']
+    assert filename == 'a.bin' and document.name.endswith('a.bin')
+
+def test_checksum_mismatch_is_reported_instead_of_sent(firestore):
+    sent, _ = download_url(Origin(md5=md5_of(b'something else'), drop=False))
+    assert len(sent) == 1 and sent[0][0] == 'message' and 'අසම්පූර්ණයි' in sent[0][1]
+
+def media_response(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, content=DATA, headers={'content-type': 'video/mp4'})
+
+def test_oversized_media_is_refused_without_transcoding(firestore):
+    with mock.patch.object(index, 'MAX_UPLOAD_SIZE', len(DATA) // 2), \
+            mock.patch.object(index, 'transcoding_available', lambda: False):
+        sent, _ = download_url(media_response, 'https://files.example/clip.mp4')
+    assert len(sent) == 1 and sent[0][0] == 'message' and 'විශාල වැඩියි' in sent[0][1]
+
+def test_media_that_cannot_be_shrunk_is_reported(firestore):
+    fit = mock.AsyncMock(side_effect=index.TranscodeError('ffmpeg encode exited with 1'))
+    with mock.patch.object(index, 'MAX_UPLOAD_SIZE', len(DATA) // 2), \
+            mock.patch.object(index, 'transcoding_available', lambda: True), \
+            mock.patch.object(index.transcoder, 'fit', fit):
+        sent, work_dirs = download_url(media_response, 'https://files.example/clip.mp4')
+    # The whole file was downloaded to disk for ffmpeg before it gave up.
+    assert fit.await_count == 1 and work_dirs == 1
+    assert len(sent) == 1 and sent[0][0] == 'message' and 'කුඩා කිරීමටද නොහැකි' in sent[0][1]
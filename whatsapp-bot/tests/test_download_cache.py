@@ -0,0 +1,9 @@
+from api import index
+
+def test_normalize_url_drops_tracking_parameters_and_fragment():
+    assert (index.normalize_url(' HTTPS://Example.COM/a?utm_source=x&b=2&a=1&fbclid=y#top ')
+            == 'https://example.com/a?a=1&b=2')
+
+def test_normalize_url_gives_one_key_per_resource():
+    assert index.normalize_url('http://example.com') == index.normalize_url('http://EXAMPLE.com/')
+    assert index.normalize_url('http://example.com/?a=') == 'http://example.com/?a='
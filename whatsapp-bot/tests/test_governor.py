@@ -0,0 +1,125 @@
+import asyncio
+import contextlib
+import types
+from unittest import mock
+
+import pytest
+
+from api import index
+
+def test_fair_semaphore_serves_users_round_robin():
+    async def scenario():
+        semaphore = index.FairSemaphore(limit=1, max_waiting=10)
+        await semaphore.acquire('holder')
+        served = []
+
+        async def waiter(user_id, label):
+            await semaphore.acquire(user_id)
+            served.append(label)
+
+        tasks = [asyncio.ensure_future(waiter(user, label)) for user, label in (('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1'))]
+        await asyncio.sleep(0)
+        assert semaphore.waiting == 4
+        for _ in tasks:
+            semaphore.release()
+            await asyncio.sleep(0)
+        assert served == ['a1', 'b1', 'a2', 'a3']
+
+    asyncio.run(scenario())
+
+def test_fair_semaphore_rejects_past_max_waiting_and_forgets_cancelled_waiters():
+    async def scenario():
+        semaphore = index.FairSemaphore(limit=1, max_waiting=1)
+        await semaphore.acquire(1)
+        queued = asyncio.ensure_future(semaphore.acquire(2))
+        await asyncio.sleep(0)
+        with pytest.raises(index.GovernorRejected):
+            await semaphore.acquire(3)
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert semaphore.waiting == 0 and not semaphore.waiters
+        semaphore.release()
+        assert semaphore.active == 0
+
+    asyncio.run(scenario())
+
+def test_fair_semaphore_reports_queue_position():
+    async def scenario():
+        semaphore = index.FairSemaphore(limit=1, max_waiting=10)
+        await semaphore.acquire(1)
+        positions = []
+
+        async def on_queued(position):
+            positions.append(position)
+
+        waiters = [asyncio.ensure_future(semaphore.acquire(user, on_queued)) for user in (2, 2, 3)]
+        await asyncio.sleep(0)
+        assert positions == [1, 2, 2]
+        for _ in waiters:
+            semaphore.release()
+        await asyncio.gather(*waiters)
+
+    asyncio.run(scenario())
+
+def update_from(user_id: int):
+    async def reply_text(text):
+        pass
+
+    return types.SimpleNamespace(effective_user=types.SimpleNamespace(id=user_id), effective_chat=types.SimpleNamespace(id=user_id),
+                                 message=types.SimpleNamespace(reply_text=reply_text))
+
+@contextlib.asynccontextmanager
+async def held(governor, job_class, user_id):
+    """Enters governor.slot() and stays in it until the block exits."""
+    async with governor.slot(job_class, update_from(user_id)):
+        yield
+
+def test_class_limit_is_shared_across_instances(firestore):
+    async def scenario():
+        instance, other_instance = index.ResourceGovernor(), index.ResourceGovernor()
+        async with held(instance, 'youtube', 1), held(other_instance, 'youtube', 2):
+            with pytest.raises(index.GovernorRejected):
+                async with other_instance.slot('youtube', update_from(3)):
+                    pass
+            assert other_instance.shed['class_busy'] == 1
+        async with held(other_instance, 'youtube', 3):
+            pass
+        assert index.get_collection('governor').document('class_youtube').get().to_dict() == {'leases': {}}
+
+    with mock.patch.dict(index.GOVERNOR_CLASS_LIMITS, {'youtube': 2}):
+        asyncio.run(scenario())
+
+def test_user_limit_is_shared_across_instances(firestore):
+    async def scenario():
+        instance, other_instance = index.ResourceGovernor(), index.ResourceGovernor()
+        async with held(instance, 'url', 1):
+            with pytest.raises(index.GovernorRejected):
+                async with other_instance.slot('ai', update_from(1)):
+                    pass
+            assert other_instance.shed['user_active'] == 1
+            async with held(other_instance, 'ai', 2):
+                pass
+
+    with mock.patch.object(index, 'GOVERNOR_USER_MAX_ACTIVE', 1):
+        asyncio.run(scenario())
+
+def test_lease_of_a_dead_instance_expires(firestore):
+    async def scenario():
+        with mock.patch.object(index.time, 'time', return_value=1000.0):
+            lease_id, limited = await index.SharedLeases(index.get_collection('governor')).acquire('youtube', 1, 1, 2)
+        assert lease_id and limited is None
+        async with held(index.ResourceGovernor(), 'youtube', 2):
+            leases = index.get_collection('governor').document('class_youtube').get().to_dict()['leases']
+            assert lease_id not in leases and len(leases) == 1
+
+    asyncio.run(scenario())
+
+def test_long_lived_server_queues_in_process(firestore):
+    async def scenario():
+        governor = index.ResourceGovernor()
+        async with held(governor, 'youtube', 1):
+            assert governor.stats()['running'] == {'youtube': 1}
+        assert not firestore.calls
+
+    with mock.patch.object(index, '_long_lived_server', True):
+        asyncio.run(scenario())
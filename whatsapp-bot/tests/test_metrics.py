@@ -0,0 +1,19 @@
+import asyncio
+import types
+from unittest import mock
+
+from api import index
+
+def get(path: str, authorization: str = None) -> dict:
+    headers = {'Authorization': authorization} if authorization else {}
+    return asyncio.run(index.handler(types.SimpleNamespace(method='GET', path=path, headers=headers, body=b'')))
+
+def test_metrics_need_the_bearer_secret():
+    with mock.patch.object(index, 'METRICS_SECRET', None):
+        assert get('/api/metrics')['statusCode'] == 403
+    with mock.patch.object(index, 'METRICS_SECRET', 'scrape'):
+        assert get('/api/metrics')['statusCode'] == 403
+        assert get('/api/metrics', 'Bearer wrong')['statusCode'] == 403
+        response = get('/api/metrics', 'Bearer scrape')
+        assert response['statusCode'] == 200
+        assert response['headers']['Content-Type'].startswith('text/plain')
@@ -0,0 +1,84 @@
+import asyncio
+from unittest import mock
+
+from api import index
+from bench import message_update, post_update
+from bench.fakes import FakeTelegramAPI, fake_services, without_rate_limits
+
+def run_with_bot(scenario):
+    """Runs `scenario(fake_api, firestore)` with the webhook handler pointed at an in-process fake Bot API
+    and FakeFirestore, processing updates inline."""
+    async def main():
+        fake_api = FakeTelegramAPI()
+        server = await asyncio.start_server(fake_api.serve_connection, '127.0.0.1', 0)
+        base_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        with fake_services(base_url) as db, without_rate_limits(), \
+                mock.patch.object(index, 'WEBHOOK_MODE', 'inline'), \
+                mock.patch.object(index.bot_persistence, '_user_data', {}):
+            try:
+                await scenario(fake_api, db)
+            finally:
+                await index.shutdown_application()
+        server.close()
+
+    asyncio.run(main())
+
+def stored_state(doc_id: str) -> dict:
+    return index.get_collection('bot_state').document(doc_id).get().to_dict() or {}
+
+async def new_instance() -> None:
+    """Forgets everything this process holds in memory, as a request landing on another instance would."""
+    await index.shutdown_application()
+    index.bot_persistence._user_data.clear()
+
+def test_conversation_continues_on_another_instance():
+    async def scenario(fake_api, db):
+        await post_update(message_update(5, '/sendmsg'))
+        assert stored_state('chat_5')['conversations']['sendmsg'] == {'5': index.SENDMSG_ASK_NUMBER}
+
+        await new_instance()
+        await post_update(message_update(5, '94712345678'))
+        assert stored_state('chat_5')['conversations']['sendmsg'] == {'5': index.SENDMSG_ASK_MESSAGE}
+        assert stored_state('user_5')['user_data'] == {'sendmsg_number': '94712345678'}
+
+        await new_instance()
+        await post_update(message_update(5, 'hello'))
+        assert fake_api.gateway_messages == 1
+        assert stored_state('chat_5')['conversations']['sendmsg'] == {}
+
+    run_with_bot(scenario)
+
+def test_state_ended_elsewhere_is_not_resumed_from_memory():
+    async def scenario(fake_api, db):
+        await post_update(message_update(6, '/sendmsg'))
+        # Another instance ends the conversation; this one still holds the old state in memory.
+        index.get_collection('bot_state').document('chat_6').delete()
+        await post_update(message_update(6, '94712345678'))
+        assert 'user_6' not in {path.rsplit('/', 1)[-1] for path in db.docs}
+        assert stored_state('chat_6') == {}
+
+    run_with_bot(scenario)
+
+def test_updates_outside_conversations_make_no_firestore_calls():
+    async def scenario(fake_api, db):
+        await post_update(message_update(7, '/sendmsg'))
+        await post_update(message_update(7, '/cancel'))
+        db.calls.clear()
+        await post_update(message_update(7, '/start'))
+        assert fake_api.calls['sendMessage'] == 3
+        # The usage counter stays buffered and the dedup marker is kept in memory only.
+        assert not db.calls
+
+    run_with_bot(scenario)
+
+def test_unchanged_state_is_not_written():
+    async def scenario(fake_api, db):
+        await post_update(message_update(8, '/sendmsg'))
+        db.calls.clear()
+        # An invalid number keeps the conversation in its state and leaves user_data alone.
+        await post_update(message_update(8, '123'))
+        assert db.calls['get_all'] == 1
+        assert 'batch' not in db.calls
+        assert stored_state('chat_8')['conversations']['sendmsg'] == {'8': index.SENDMSG_ASK_NUMBER}
+
+    run_with_bot(scenario)
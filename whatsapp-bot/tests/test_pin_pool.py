@@ -0,0 +1,69 @@
+import asyncio
+from unittest import mock
+
+from api import index
+from bench.fakes import FakeFirestore
+
+def run_with_files(coroutine_function):
+    db = FakeFirestore()
+    with mock.patch.object(index, 'get_collection', db.collection):
+        asyncio.run(coroutine_function(db.collection('files')))
+
+def test_refill_reserves_placeholders_and_take_hands_them_out_once():
+    async def scenario(files):
+        pool = index.PinPool(4)
+        await pool.refill()
+        with mock.patch.object(pool, 'refill', mock.AsyncMock()):
+            pins = [pool.take() for _ in range(4)]
+            assert pool.take() is None
+        assert len(set(pins)) == 4
+        for pin in pins:
+            placeholder = files.document(pin).get().to_dict()
+            assert placeholder['reserved'] and placeholder['pin'] == pin
+            assert placeholder['expires_at'] == placeholder['reserved_at'] + index.PIN_RESERVATION_TTL
+
+    run_with_files(scenario)
+
+async def wait_for_pins(pool, count):
+    while len(pool._pins) < count:
+        await asyncio.sleep(0.01)
+
+def test_take_refills_in_the_background_below_half():
+    async def scenario(files):
+        pool = index.PinPool(4)
+        await pool.refill()
+        pool.take()
+        pool.take()
+        await asyncio.sleep(0.05)
+        assert len(pool._pins) == 2
+        pool.take()
+        await asyncio.wait_for(wait_for_pins(pool, 4), timeout=5)
+        assert len(files.get()) == 4 + 3
+
+    run_with_files(scenario)
+
+def test_take_skips_placeholders_close_to_being_swept():
+    async def scenario(files):
+        pool = index.PinPool(4)
+        pool._pins = [('FRESH1', index.time.time()), ('STALE1', index.time.time() - index.PIN_RESERVATION_TTL)]
+        pool._refilling = True  # keeps take() from starting a refill
+        assert pool.take() == 'FRESH1'
+        assert pool.take() is None
+
+    run_with_files(scenario)
+
+def test_collisions_retry_with_another_pin():
+    async def scenario(files):
+        files.document('TAKEN1').set({'pin': 'TAKEN1'})
+        with mock.patch.object(index, 'generate_pin', side_effect=['TAKEN1', 'FREE01']):
+            assert await index.create_with_unique_pin(files, {'file_id': 'x'}) == 'FREE01'
+        assert files.document('TAKEN1').get().to_dict() == {'pin': 'TAKEN1'}
+        with mock.patch.object(index, 'generate_pin', return_value='TAKEN1'):
+            try:
+                await index.create_with_unique_pin(files, {})
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('expected RuntimeError')
+
+    run_with_files(scenario)
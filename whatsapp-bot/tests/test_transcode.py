@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+import pytest
+
+from api import index
+
+MB = 1024 * 1024
+
+def make_file(path: str, size: int) -> str:
+    with open(path, 'wb') as f:
+        f.truncate(size)  # sparse, so large media costs no disk
+    return path
+
+class FakeFFmpeg:
+    """Stands in for MediaTranscoder._ffmpeg: probes report `media[path]`, and each encode or split
+    writes its output at the next size from `sizes`."""
+
+    def __init__(self, media: dict, sizes: list):
+        self.media = media
+        self.sizes = list(sizes)
+        self.runs = []
+
+    async def __call__(self, op: str, *args) -> tuple:
+        self.runs.append((op, args))
+        if op == 'probe':
+            duration, streams = self.media.get(os.path.basename(args[-1]), (None, ()))
+            hours, seconds = divmod(duration or 0, 3600)
+            lines = [f'  Duration: {int(hours):02d}:{int(seconds // 60):02d}:{seconds % 60:05.2f}, start: 0.000000'] if duration else []
+            lines += [f'  Stream #0:{number}(und): {stream}: codec' for number, stream in enumerate(streams)]
+            return 1, '\n'.join(lines)
+        make_file(args[-1], self.sizes.pop(0))
+        return 0, ''
+
+def fit(tmp_path, ffmpeg: FakeFFmpeg, name: str, size: int) -> list:
+    transcoder = index.MediaTranscoder(1)
+    transcoder._ffmpeg = ffmpeg
+    path = make_file(str(tmp_path / name), size)
+    return [os.path.basename(part) for part in asyncio.run(transcoder.fit(path, str(tmp_path), max_size=50 * MB))]
+
+def bitrate_of(args: tuple) -> int:
+    return int(args[args.index('-b:v') + 1])
+
+def test_file_under_the_limit_is_sent_as_it_is(tmp_path):
+    ffmpeg = FakeFFmpeg({}, [])
+    assert fit(tmp_path, ffmpeg, 'clip.mp4', 10 * MB) == ['clip.mp4']
+    assert not ffmpeg.runs
+
+def test_video_is_re_encoded_again_when_it_overshoots(tmp_path):
+    ffmpeg = FakeFFmpeg({'clip.mp4': (600, ('Video', 'Audio'))}, [55 * MB, 45 * MB])
+    assert fit(tmp_path, ffmpeg, 'clip.mp4', 80 * MB) == ['clip.small.mp4']
+    first, second = [args for op, args in ffmpeg.runs if op == 'encode']
+    assert bitrate_of(second) < bitrate_of(first)
+
+def test_long_video_is_split_and_an_oversized_part_re_encoded(tmp_path):
+    # Two hours in 50 MB leaves too little bitrate for video, so it is cut by stream copy instead.
+    media = {'film.mp4': (7200, ('Video', 'Audio')), 'film.part2of3.mp4': (2400, ('Video', 'Audio'))}
+    ffmpeg = FakeFFmpeg(media, [40 * MB, 60 * MB, 45 * MB, 40 * MB])
+    assert fit(tmp_path, ffmpeg, 'film.mp4', 120 * MB) == ['film.part1of3.mp4', 'film.part2of3.enc.mp4', 'film.part3of3.mp4']
+    assert [op for op, _ in ffmpeg.runs] == ['probe', 'split', 'split', 'probe', 'encode', 'split']
+
+def test_audio_is_re_encoded_without_video(tmp_path):
+    ffmpeg = FakeFFmpeg({'talk.mp3': (3600, ('Audio',))}, [40 * MB])
+    assert fit(tmp_path, ffmpeg, 'talk.mp3', 120 * MB) == ['talk.small.m4a']
+    [(_, args)] = [run for run in ffmpeg.runs if run[0] == 'encode']
+    assert '-vn' in args
+
+def test_file_ffmpeg_cannot_read_is_refused(tmp_path):
+    with pytest.raises(index.TranscodeError):
+        fit(tmp_path, FakeFFmpeg({}, []), 'archive.mp4', 80 * MB)
+
+def test_too_many_parts_are_refused(tmp_path):
+    ffmpeg = FakeFFmpeg({'film.mp4': (36000, ('Video', 'Audio'))}, [])
+    with pytest.raises(index.TranscodeError):
+        fit(tmp_path, ffmpeg, 'film.mp4', 600 * MB)
+    assert [op for op, _ in ffmpeg.runs] == ['probe']
@@ -0,0 +1,75 @@
+import asyncio
+import time
+import types
+from unittest import mock
+
+from api import index
+
+def get(path: str, authorization: str = None) -> dict:
+    headers = {'Authorization': authorization} if authorization else {}
+    request = types.SimpleNamespace(method='GET', path=path, headers=headers, body=b'')
+    return asyncio.run(index.handler(request))
+
+def upload(pin: str, user_id: int, size: int, expires_at, **fields) -> dict:
+    return dict({'pin': pin, 'file_id': f'file-{pin}', 'uploaded_by': user_id, 'file_size': size,
+                 'expires_at': expires_at, 'downloads': 0, 'max_downloads': None}, **fields)
+
+def test_sweep_is_refused_without_a_configured_secret(firestore):
+    with mock.patch.object(index, 'CRON_SECRET', None):
+        assert get('/api/sweep')['statusCode'] == 403
+        assert get('/api/sweep', 'Bearer ')['statusCode'] == 403
+    with mock.patch.object(index, 'CRON_SECRET', 'cron'):
+        assert get('/api/sweep', 'Bearer wrong')['statusCode'] == 403
+        assert get('/api/sweep', 'Bearer cron')['statusCode'] == 200
+
+def test_quota_refuses_uploads_past_either_limit_and_release_gives_it_back(firestore):
+    async def scenario():
+        with mock.patch.object(index, 'UPLOAD_USER_MAX_FILES', 2), mock.patch.object(index, 'UPLOAD_USER_MAX_BYTES', 100):
+            assert await index.reserve_upload_quota(7, 60)
+            assert not await index.reserve_upload_quota(7, 50)
+            assert await index.reserve_upload_quota(7, 40)
+            assert not await index.reserve_upload_quota(7, 0)
+            await index.release_upload_quota(7, 40)
+            assert index._quota_ref(7).get().to_dict() == {'files': 1, 'bytes': 60}
+
+    asyncio.run(scenario())
+
+def test_sweep_deletes_expired_uploads_and_releases_their_quota(firestore):
+    async def scenario():
+        files = index.get_collection('files')
+        now = time.time()
+        files.document('OLD001').set(upload('OLD001', 7, 30, now - 10))
+        files.document('OLD002').set(upload('OLD002', 7, 20, now - 5))
+        files.document('NEW001').set(upload('NEW001', 7, 50, now + 3600))
+        files.document('KEEP01').set(upload('KEEP01', 8, 10, None))
+        index._quota_ref(7).set({'files': 3, 'bytes': 100})
+        with mock.patch.object(index, 'UPLOAD_USER_MAX_FILES', 10):
+            assert await index.sweep_expired_uploads() == 2
+        assert sorted(snapshot.id for snapshot in files.get()) == ['KEEP01', 'NEW001']
+        assert index._quota_ref(7).get().to_dict() == {'files': 1, 'bytes': 50}
+
+    asyncio.run(scenario())
+
+def test_sweep_batches_until_nothing_is_left(firestore):
+    async def scenario():
+        files = index.get_collection('files')
+        for number in range(7):
+            files.document(f'OLD{number:03}').set(upload(f'OLD{number:03}', None, 1, time.time() - 1))
+        with mock.patch.object(index, 'UPLOAD_SWEEP_BATCH_SIZE', 3):
+            assert await index.sweep_expired_uploads() == 7
+        assert files.get() == []
+
+    asyncio.run(scenario())
+
+def test_limited_downloads_expire_the_upload_on_the_last_one(firestore):
+    async def scenario():
+        files = index.get_collection('files')
+        metadata = upload('LIMIT1', 7, 10, None, max_downloads=2)
+        files.document('LIMIT1').set(metadata)
+        assert await index.claim_download('LIMIT1', metadata)
+        assert await index.claim_download('LIMIT1', metadata)
+        assert not await index.claim_download('LIMIT1', metadata)
+        stored = files.document('LIMIT1').get().to_dict()
+        assert stored['downloads'] == 2 and index.upload_expired(stored)
+
+    asyncio.run(scenario())
@@ -0,0 +1,102 @@
+import asyncio
+from unittest import mock
+
+from api import index
+from bench.fakes import FakeFirestore
+
+def run_with_firestore(coroutine_function):
+    db = FakeFirestore()
+    with mock.patch.object(index, 'get_firestore', lambda: db):
+        asyncio.run(coroutine_function(db))
+    return db
+
+def test_increments_to_one_document_are_coalesced():
+    async def scenario(db):
+        buffer = index.WriteBuffer(max_writes=10, interval=60)
+        ref = db.collection('usage').document('day')
+        buffer.increment(ref, {'commands.start': 1})
+        buffer.increment(ref, {'commands.start': 2, 'downloads': 1})
+        assert buffer.stats()['pending'] == 1
+        await buffer.flush()
+        assert buffer.stats() == {'pending': 0, 'buffered': 2, 'committed': 1, 'batches': 1, 'failed_batches': 0}
+        assert ref.get().to_dict() == {'commands': {'start': 3}, 'downloads': 1}
+
+    run_with_firestore(scenario)
+
+def test_failed_commit_is_restored_and_merged_with_newer_counts():
+    async def scenario(db):
+        buffer = index.WriteBuffer(max_writes=10, interval=60)
+        ref = db.collection('usage').document('day')
+        buffer.increment(ref, {'downloads': 2})
+        with mock.patch.object(buffer, '_commit', side_effect=RuntimeError('unavailable')):
+            await buffer.flush()
+        assert buffer.failed_batches == 1
+        assert not ref.get().exists
+        buffer.increment(ref, {'downloads': 1})
+        assert buffer.stats()['pending'] == 1
+        await buffer.flush()
+        assert ref.get().to_dict() == {'downloads': 3}
+
+    run_with_firestore(scenario)
+
+def test_must_exist_counts_for_a_deleted_document_are_dropped():
+    async def scenario(db):
+        buffer = index.WriteBuffer(max_writes=10, interval=60)
+        kept = db.collection('files').document('KEPT')
+        kept.set({'downloads': 0})
+        deleted = db.collection('files').document('GONE')
+        buffer.increment(kept, {'downloads': 1}, must_exist=True)
+        buffer.increment(deleted, {'downloads': 1}, must_exist=True)
+        await buffer.flush()
+        assert kept.get().to_dict() == {'downloads': 1}
+        assert not deleted.get().exists
+        assert buffer.stats()['pending'] == 0
+
+    run_with_firestore(scenario)
+
+def test_take_leaves_must_exist_writes_and_restore_gives_back():
+    async def scenario(db):
+        buffer = index.WriteBuffer(max_writes=10, interval=60)
+        usage = db.collection('usage').document('day')
+        upload = db.collection('files').document('PIN123')
+        buffer.increment(usage, {'downloads': 1})
+        buffer.increment(upload, {'downloads': 1}, must_exist=True)
+        taken = buffer.take(10)
+        assert [entry['ref'].path for entry in taken] == [usage.path]
+        buffer.increment(usage, {'downloads': 4})
+        buffer.restore(taken)
+        assert buffer.stats()['pending'] == 2
+        assert buffer._pending[usage.path]['counts'] == {'downloads': 5}
+
+    run_with_firestore(scenario)
+
+def test_usage_is_buffered_without_setting_up_firestore():
+    async def scenario():
+        with mock.patch.object(index, 'write_buffer', index.WriteBuffer(max_writes=10, interval=60)), \
+                mock.patch.object(index, 'get_firestore', side_effect=AssertionError('Firestore set up')):
+            index.get_collection.cache_clear()
+            index.record_usage({'commands.start': 1})
+            assert index.write_buffer.stats()['pending'] == 1
+
+    asyncio.run(scenario())
+    index.get_collection.cache_clear()
+
+def test_due_on_size_or_age_of_the_oldest_write():
+    async def scenario(db):
+        buffer = index.WriteBuffer(max_writes=2, interval=60)
+        assert not buffer.due()
+        buffer.increment(index.DocumentPath('usage', 'day'), {'commands.start': 1})
+        assert not buffer.due()
+        buffer.increment(db.collection('files').document('PIN123'), {'downloads': 1})
+        assert buffer.due()
+        await buffer.flush()
+        buffer.increment(index.DocumentPath('usage', 'day'), {'commands.start': 1})
+        with mock.patch.object(index.time, 'monotonic', return_value=index.time.monotonic() + 61):
+            assert buffer.due()
+
+    db = FakeFirestore()
+    with mock.patch.object(index, 'get_firestore', lambda: db):
+        index.get_collection.cache_clear()
+        asyncio.run(scenario(db))
+    index.get_collection.cache_clear()
+    assert db.docs[index.DocumentPath('usage', 'day').path][0] == {'commands': {'start': 1}}
@@ -0,0 +1,31 @@
+from api import index
+
+MB = 1024 * 1024
+
+INFO = {
+    'duration': 100,
+    'formats': [
+        {'format_id': '18', 'ext': 'mp4', 'height': 360, 'vcodec': 'avc1', 'acodec': 'mp4a', 'filesize': 10 * MB},
+        {'format_id': '136', 'ext': 'mp4', 'height': 720, 'vcodec': 'avc1', 'acodec': 'none', 'filesize': 30 * MB},
+        {'format_id': '137', 'ext': 'mp4', 'height': 1080, 'vcodec': 'avc1', 'acodec': 'none', 'filesize': 60 * MB},
+        {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a', 'abr': 128, 'filesize': 5 * MB},
+        {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus', 'abr': 160, 'tbr': 160},
+    ],
+}
+
+def test_picks_the_highest_format_that_fits():
+    assert index.select_youtube_format(INFO, max_size=50 * MB) == {'format': '136+140', 'size': 35 * MB}
+    assert index.select_youtube_format(INFO, max_size=20 * MB) == {'format': '18', 'size': 10 * MB}
+
+def test_reports_the_smallest_estimate_when_nothing_fits():
+    assert index.select_youtube_format(INFO, max_size=1 * MB) == {'format': None, 'size': 10 * MB}
+
+def test_audio_only_prefers_m4a_and_estimates_from_bitrate():
+    assert index.select_youtube_format(INFO, audio_only=True, max_size=50 * MB) == {'format': '140', 'size': 5 * MB}
+    webm_only = {'duration': 100, 'formats': [INFO['formats'][4]]}
+    assert index.select_youtube_format(webm_only, audio_only=True) == {'format': '251', 'size': 2_000_000}
+
+def test_falls_back_to_the_fixed_format_without_sizes():
+    info = {'formats': [{'format_id': '18', 'ext': 'mp4', 'height': 360, 'vcodec': 'avc1', 'acodec': 'mp4a'}]}
+    assert index.select_youtube_format(info) == {'format': index.YT_DOWNLOAD_FORMAT, 'size': None}
+    assert index.select_youtube_format(info, audio_only=True) == {'format': index.YT_AUDIO_FORMAT, 'size': None}